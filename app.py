@@ -12,14 +12,13 @@ import base64
 import logging
 import time
 import threading
+import mimetypes
+import html
 from datetime import datetime, timedelta
 from functools import wraps
 from PIL import Image
 import io
-from filelock import FileLock
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for
-from werkzeug.utils import secure_filename
-from google import genai
+from flask import Flask, Response, render_template, request, jsonify, send_file, session, redirect, url_for
 from google.genai import types, errors as genai_errors
 from dotenv import load_dotenv
 from flask_wtf.csrf import CSRFProtect
@@ -27,6 +26,11 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_talisman import Talisman
 from flask_compress import Compress
+import assets
+import retention
+import scheduler
+import session_store
+from session_store import SESSIONS_DIR, IMAGES_DIR, THUMBNAILS_DIR, SessionConflict
 
 # 配置日志（根据环境动态设置级别）
 _log_level = logging.DEBUG if os.getenv('FLASK_ENV') != 'production' else logging.INFO
@@ -37,9 +41,16 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # 导入需要环境变量的模块
-from database import create_user, verify_user, get_user_by_id, get_all_users, delete_user, toggle_admin, update_user_credits, generate_card_keys, get_all_card_keys, use_card_key, create_verification_code, verify_email_code, cleanup_expired_codes
-from email_service import generate_verification_code, send_verification_email
-from werkzeug.security import generate_password_hash
+from database import init_db, create_user, verify_user, get_user_by_id, get_users_page, get_usage_stats, record_generation_usage, get_user_ids_without_usage, get_meta, set_meta, remove_session_data, get_retention_job, get_recent_retention_jobs, cancel_retention_job, delete_user, toggle_admin, update_user_credits, generate_card_keys, create_card_key_batch, generate_card_key_batch, abort_card_key_batch, revoke_card_key_batch, get_card_key_batches, get_card_keys_page, get_card_key_stats, use_card_key, create_verification_code, verify_email_code, cleanup_expired_codes, purge_outbox, search_messages, SEARCH_HIGHLIGHT_START, SEARCH_HIGHLIGHT_END, get_gallery_page, set_user_model_fallback, record_model_routing, get_model_routing_log, purge_model_routing_log, record_generation, get_generation_stats, get_top_generation_users, purge_generation_log, get_recompression_stats
+import email_service
+import client_pool
+import circuit_breaker
+import model_routing
+import image_storage
+import image_recompress
+import chat_prewarm
+from email_service import generate_verification_code
+from password_hashing import hash_secret, HashingBusy
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
@@ -84,6 +95,11 @@ compress.init_app(app)
 def ratelimit_handler(e):
     return jsonify({"error": "请求过于频繁，请稍后再试"}), 429
 
+@app.errorhandler(HashingBusy)
+def hashing_busy_handler(e):
+    # 哈希进程池排队已满（登录/注册高峰），让客户端稍后重试
+    return jsonify({"error": "error_server_busy", "error_code": "HASHING_BUSY"}), 503
+
 # 安全响应头（仅在生产环境启用HTTPS强制）
 if os.getenv('FLASK_ENV') == 'production':
     Talisman(app, 
@@ -97,19 +113,12 @@ if os.getenv('FLASK_ENV') == 'production':
                  'img-src': ["'self'", "data:"],
              })
 
-# 配置
-API_KEY = os.getenv("GEMINI_API_KEY")
-if not API_KEY:
-    raise ValueError("请设置环境变量 GEMINI_API_KEY 或在 .env 文件中配置")
-
-# 自定义 API 端点（可选）
-API_BASE_URL = os.getenv("GEMINI_API_BASE_URL")
+# 配置（API 密钥和自定义端点由 client_pool 读取，支持 GEMINI_API_KEYS 配置多个密钥）
+if not client_pool.KEYS:
+    raise ValueError("请设置环境变量 GEMINI_API_KEY（或 GEMINI_API_KEYS）或在 .env 文件中配置")
 
 # 默认模型（可通过环境变量 GEMINI_MODEL 自定义）
 DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "gemini-3.1-flash-image-preview")
-SESSIONS_DIR = "data/sessions"  # 改为目录，每个用户一个文件
-IMAGES_DIR = "static/images"
-THUMBNAILS_DIR = "static/thumbnails"
 
 # 安全配置常量
 ALLOWED_ASPECT_RATIOS = ["auto", "1:1", "16:9", "9:16", "4:3", "3:4", "21:9", "3:2", "2:3"]
@@ -118,36 +127,67 @@ ALLOWED_MODELS = {
     "gemini-3-pro-image-preview": "Nano Banana Pro",
     "gemini-3.1-flash-image-preview": "Nano Banana 2",
 }
+# 每次生成消耗的点数（按模型和分辨率），可通过 MODEL_COSTS 以 JSON 覆盖，
+# 例如 {"gemini-3-pro-image-preview": {"1K": 2, "2K": 3, "4K": 6}}；模型路由切换后按实际使用的模型计费
+DEFAULT_IMAGE_COSTS = {"1K": 1, "2K": 2, "4K": 4}
+MODEL_COSTS = {model_id: dict(DEFAULT_IMAGE_COSTS) for model_id in ALLOWED_MODELS}
+for _model_id, _costs in json.loads(os.getenv("MODEL_COSTS", "{}")).items():
+    MODEL_COSTS.setdefault(_model_id, dict(DEFAULT_IMAGE_COSTS)).update(_costs)
 MAX_PROMPT_LENGTH = 100000  # 支持长提示词
 MAX_REFERENCE_IMAGES = 14
+CARD_KEY_EXPORT_MAX = int(os.getenv("CARD_KEY_EXPORT_MAX", 50000))  # 单次批量导出卡密上限
+GENERATION_LOG_DAYS = int(os.getenv("GENERATION_LOG_DAYS", 90))  # 生成记录保留天数
+GENERATION_HOURLY_ROLLUP_DAYS = int(os.getenv("GENERATION_HOURLY_ROLLUP_DAYS", 14))  # 按小时汇总保留天数（按天汇总长期保留）
 ALLOWED_IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico'}
+_IMAGE_FILENAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+# 图片文件传输方式：留空由应用直接发送；x-accel 交给 Nginx（X-Accel-Redirect）；
+# x-sendfile 交给 Apache/lighttpd（X-Sendfile）。应用只负责校验和缓存头
+IMAGE_SENDFILE_MODE = os.getenv("IMAGE_SENDFILE_MODE", "").strip().lower()
+IMAGE_ACCEL_PREFIX = os.getenv("IMAGE_ACCEL_PREFIX", "/_protected/")  # Nginx internal location 前缀
+IMAGE_CACHE_MAX_AGE = 31536000  # 图片文件名唯一且内容不变，缓存一年
+
+# 静态资源指纹化（内容哈希文件名 + 预压缩 + immutable 缓存），生产环境默认开启
+ASSET_FINGERPRINT = os.getenv("ASSET_FINGERPRINT", "true" if os.getenv('FLASK_ENV') == 'production' else "false").lower() == "true"
+STATIC_ASSET_MAX_AGE = 31536000  # 指纹文件内容不变，缓存一年
+
+_app_version = None
+
 
-# 确保目录存在
-os.makedirs("data", exist_ok=True)
-os.makedirs(SESSIONS_DIR, exist_ok=True)
-os.makedirs(IMAGES_DIR, exist_ok=True)
-os.makedirs(THUMBNAILS_DIR, exist_ok=True)
+def get_app_version():
+    """
+    静态资源版本号（首次使用时计算并缓存，导入模块时不读取 manifest）
+    开启指纹化时按内容计算，所有 worker 和重启前后保持一致；否则使用进程启动时间
+    """
+    global _app_version
+    if _app_version is None:
+        _app_version = assets.load_manifest()["version"] if ASSET_FINGERPRINT else str(int(time.time()))
+    return _app_version
+
+
+def asset_url(path):
+    """模板中引用静态资源：优先返回指纹文件地址，否则回退到 ?v= 版本参数"""
+    if ASSET_FINGERPRINT:
+        dist_path = assets.asset_path(path)
+        if dist_path:
+            return f"/static/{assets.DIST_DIRNAME}/{dist_path}"
+        return f"/static/{path.lstrip('/')}?v={get_app_version()}"
+    # 开发环境：使用文件修改时间作为版本号，修改后刷新即可生效
+    try:
+        mtime = int(os.path.getmtime(os.path.join(app.static_folder, path.lstrip('/'))))
+    except OSError:
+        mtime = get_app_version()
+    return f"/static/{path.lstrip('/')}?v={mtime}"
 
-# 静态文件版本号（用于缓存刷新，每次启动时更新）
-APP_VERSION = str(int(time.time()))
 
 @app.context_processor
 def inject_version():
-    """向所有模板注入版本号，用于静态文件缓存刷新"""
-    return {"v": APP_VERSION}
-
-# Gemini 客户端（增加超时时间以支持长提示词）
-# 如果配置了自定义 API 端点，则使用自定义端点
-_http_kwargs = {"timeout": 300000}  # 300秒超时（毫秒）
-if API_BASE_URL:
-    _http_kwargs["base_url"] = API_BASE_URL
-    logger.info(f"使用自定义 API 端点: {API_BASE_URL}")
-http_options = types.HttpOptions(**_http_kwargs)
-
-client = genai.Client(
-    api_key=API_KEY,
-    http_options=http_options
-)
+    """向所有模板注入版本号和静态资源地址函数，用于静态文件缓存刷新"""
+    return {"v": get_app_version(), "asset_url": asset_url}
+
+def get_client(key_id=None):
+    """获取当前进程中指定密钥的 Gemini 客户端（未指定时为第一个密钥），见 client_pool"""
+    return client_pool.get_client(key_id)
 
 # 存储活跃的聊天会话（内存中）
 active_chats = {}
@@ -159,7 +199,7 @@ CHAT_IDLE_TIMEOUT = int(os.getenv("CHAT_IDLE_TIMEOUT", 1800))  # 默认30分钟
 CHAT_CLEANUP_INTERVAL = int(os.getenv("CHAT_CLEANUP_INTERVAL", 600))  # 默认10分钟检查一次
 
 def cleanup_inactive_chats():
-    """后台线程：定期清理长时间未使用的聊天会话，释放内存，并清理过期验证码"""
+    """后台线程：定期清理当前进程中长时间未使用的聊天会话，释放内存（数据库维护由调度器执行）"""
     while True:
         try:
             time.sleep(CHAT_CLEANUP_INTERVAL)
@@ -171,21 +211,10 @@ def cleanup_inactive_chats():
                     del active_chats[sid]
             if expired:
                 logger.info(f"已清理 {len(expired)} 个闲置聊天会话")
-            
-            # 定期清理过期的邮箱验证码
-            try:
-                deleted = cleanup_expired_codes()
-                if deleted > 0:
-                    logger.info(f"已清理 {deleted} 条过期验证码")
-            except Exception as e:
-                logger.error(f"清理过期验证码失败: {e}")
         except Exception as e:
             logger.error(f"清理线程错误: {e}")
             time.sleep(60)  # 错误后等待60秒再重试，避免循环崩溃
 
-cleanup_thread = threading.Thread(target=cleanup_inactive_chats, daemon=True)
-cleanup_thread.start()
-logger.info(f"会话自动清理已启动（闲置超时: {CHAT_IDLE_TIMEOUT}s, 检查间隔: {CHAT_CLEANUP_INTERVAL}s）")
 
 
 def login_required(f):
@@ -217,67 +246,48 @@ def admin_required(f):
     return decorated_function
 
 
-def get_user_sessions_file(user_id):
-    """获取用户的会话文件路径"""
-    return os.path.join(SESSIONS_DIR, f"user_{user_id}.json")
-
-
+def backfill_session_data():
+    """
+    后台回填：把旧版 user_<id>.json 拆分为独立会话文件，并为缺少用量记录的用户重新同步索引
+    首次完成后才允许保留任务清理孤儿文件（此前媒体索引不完整）
+    """
+    failed = 0
+    try:
+        legacy_ids = session_store.legacy_user_ids()
+        missing_ids = get_user_ids_without_usage()
+    except Exception as e:
+        logger.error(f"查询待回填的用户失败: {e}")
+        return
 
-def _get_session_lock(user_id):
-    """获取用户会话文件的文件锁"""
-    sessions_file = get_user_sessions_file(user_id)
-    return FileLock(sessions_file + ".lock", timeout=10)
+    for user_id in legacy_ids:
+        try:
+            session_store.migrate_legacy(user_id)
+        except Exception as e:
+            failed += 1
+            logger.warning(f"迁移用户 {user_id} 的会话文件失败: {e}")
 
+    for user_id in set(missing_ids) - set(legacy_ids):
+        try:
+            session_store.resync_user(user_id)
+        except Exception as e:
+            failed += 1
+            logger.warning(f"回填用户 {user_id} 用量计数和索引失败: {e}")
 
-def load_sessions(user_id):
-    """加载指定用户的会话数据（带文件锁防止并发问题）"""
-    sessions_file = get_user_sessions_file(user_id)
-    lock = _get_session_lock(user_id)
-    with lock:
-        if os.path.exists(sessions_file):
-            try:
-                with open(sessions_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, ValueError) as e:
-                # JSON 文件损坏，备份并返回空数据
-                logger.error(f"会话文件损坏 (user {user_id}): {e}")
-                backup_file = f"{sessions_file}.corrupt.{int(time.time())}"
-                try:
-                    import shutil
-                    shutil.copy2(sessions_file, backup_file)
-                    logger.info(f"已备份损坏的会话文件到: {backup_file}")
-                except Exception as backup_error:
-                    logger.error(f"备份失败: {backup_error}")
-                # 删除损坏的文件，让系统重新开始
-                try:
-                    os.remove(sessions_file)
-                except Exception as remove_error:
-                    logger.error(f"删除损坏文件失败: {remove_error}")
-                return {}
-    return {}
-
-
-def save_sessions(user_id, sessions):
-    """保存指定用户的会话数据（原子写入 + 文件锁，防止并发和文件损坏）"""
-    sessions_file = get_user_sessions_file(user_id)
-    lock = _get_session_lock(user_id)
-    with lock:
-        tmp_file = sessions_file + ".tmp"
-        with open(tmp_file, "w", encoding="utf-8") as f:
-            json.dump(sessions, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_file, sessions_file)
+    if not failed and get_meta(retention.MEDIA_INDEX_READY_KEY) != "1":
+        set_meta(retention.MEDIA_INDEX_READY_KEY, "1")
+    if legacy_ids or missing_ids:
+        logger.info(f"已回填 {len(set(legacy_ids) | set(missing_ids)) - failed} 个用户的会话数据和索引")
 
 
 def _delete_message_files(msg):
-    """删除消息关联的所有图片文件（生成图片、缩略图、参考图片）"""
+    """删除消息关联的所有图片文件（生成图片、缩略图、参考图片，原图同时删除冷存储副本）"""
     # 删除生成的图片
     if msg.get("image"):
         image_path = os.path.join(IMAGES_DIR, os.path.basename(msg["image"]))
-        if os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-            except Exception as e:
-                logger.warning(f"删除图片失败 {image_path}: {e}")
+        try:
+            image_storage.delete(image_path)
+        except Exception as e:
+            logger.warning(f"删除图片失败 {image_path}: {e}")
     # 删除缩略图
     if msg.get("thumbnail"):
         thumb_path = os.path.join(THUMBNAILS_DIR, os.path.basename(msg["thumbnail"]))
@@ -290,11 +300,10 @@ def _delete_message_files(msg):
     if msg.get("reference_images"):
         for ref_img in msg["reference_images"]:
             ref_path = os.path.join(IMAGES_DIR, os.path.basename(ref_img))
-            if os.path.exists(ref_path):
-                try:
-                    os.remove(ref_path)
-                except Exception as e:
-                    logger.warning(f"删除参考图片失败 {ref_path}: {e}")
+            try:
+                image_storage.delete(ref_path)
+            except Exception as e:
+                logger.warning(f"删除参考图片失败 {ref_path}: {e}")
 
 
 def _get_json_data():
@@ -305,13 +314,41 @@ def _get_json_data():
         return {}
 
 
-def _validate_session_id(session_id):
-    """验证 session_id 是否是合法的 UUID 格式"""
+def _parse_date_arg(name):
+    """解析 YYYY-MM-DD 格式的查询参数，为空返回 None，格式不正确时抛出 ValueError"""
+    value = request.args.get(name, "").strip()
+    if not value:
+        return None
     try:
-        uuid.UUID(session_id)
-        return True
-    except (ValueError, TypeError, AttributeError):
-        return False
+        return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        raise ValueError("日期格式应为 YYYY-MM-DD")
+
+
+def _validate_session_id(session_id):
+    """验证 session_id 是否是标准 36 位 UUID 格式（与会话文件路径的校验规则一致）"""
+    return session_store.is_valid_session_id(session_id)
+
+
+def _bump_session_revision(session_data, truncated=False):
+    """
+    会话内容变更时递增修订号（用于 ETag 和增量同步）
+    truncated=True 表示已有消息被删除或修改，此前的增量同步基准全部失效
+    """
+    session_data["revision"] = session_data.get("revision", 0) + 1
+    if truncated:
+        session_data["base_revision"] = session_data["revision"]
+
+
+def _session_etag(session_id, session_data):
+    """
+    基于会话修订号生成 ETag（有未写入文件的元数据修改时附加其版本戳）
+    以弱 ETag 发送：Flask-Compress 会给压缩响应的强 ETag 追加 ":gzip" 等后缀，浏览器回传后无法在加载会话前比对
+    """
+    etag = f"{session_id}.{session_data.get('revision', 0)}"
+    if session_data.get("pending_stamp"):
+        etag += f".{session_data['pending_stamp']}"
+    return etag
 
 
 def create_thumbnail(image_path, thumbnail_filename, max_size=400, quality=60):
@@ -348,12 +385,12 @@ def create_thumbnail(image_path, thumbnail_filename, max_size=400, quality=60):
 
 
 def rebuild_chat_history(user_id, session_id):
-    """从保存的消息历史重建 Gemini Chat 的 history 参数"""
-    sessions = load_sessions(user_id)
-    if session_id not in sessions:
+    """从保存的消息历史重建 Gemini Chat 的 history 参数（已迁移到冷存储的原图会先取回本地）"""
+    session_data = session_store.get_session(user_id, session_id)
+    if session_data is None:
         return []
     
-    messages = sessions[session_id].get("messages", [])
+    messages = session_data.get("messages", [])
     if not messages:
         return []
     
@@ -375,7 +412,7 @@ def rebuild_chat_history(user_id, session_id):
             ref_images = msg.get("reference_images") or []
             for ref_img in ref_images:
                 ref_path = os.path.join(IMAGES_DIR, os.path.basename(ref_img))
-                if os.path.exists(ref_path):
+                if image_storage.ensure_hot(ref_path):
                     try:
                         with open(ref_path, "rb") as f:
                             image_data = f.read()
@@ -410,7 +447,7 @@ def rebuild_chat_history(user_id, session_id):
             if msg.get("image"):
                 image_filename = os.path.basename(msg["image"])
                 image_path = os.path.join(IMAGES_DIR, image_filename)
-                if os.path.exists(image_path):
+                if image_storage.ensure_hot(image_path):
                     try:
                         with open(image_path, "rb") as f:
                             image_data = f.read()
@@ -439,8 +476,13 @@ def rebuild_chat_history(user_id, session_id):
     return history
 
 
-def create_chat(session_id, aspect_ratio="auto", image_size="2K", model=DEFAULT_MODEL, user_id=None):
-    """创建新的聊天实例，如果有历史消息则自动恢复上下文"""
+def create_chat(session_id, aspect_ratio="auto", image_size="2K", model=DEFAULT_MODEL, user_id=None, aio=False,
+                key_id=None, history=None, revision=None):
+    """
+    创建新的聊天实例，返回 (chat, 密钥 id)（aio=True 时创建异步聊天实例）
+    未指定密钥时按 client_pool 的策略选择；未传入 history 时从保存的消息自动恢复上下文
+    （传入会话修订号时优先使用打开会话时预热好的历史）
+    """
     if aspect_ratio == "auto":
         image_config = types.ImageConfig(
             image_size=image_size,
@@ -456,43 +498,95 @@ def create_chat(session_id, aspect_ratio="auto", image_size="2K", model=DEFAULT_
         image_config=image_config
     )
     
-    # 从保存的消息历史重建 Chat 上下文
-    history = []
-    if user_id:
-        try:
-            history = rebuild_chat_history(user_id, session_id)
-            if history:
-                logger.info(f"为会话 {session_id} 重建了 {len(history)} 条历史消息")
-        except Exception as e:
-            logger.error(f"重建聊天历史失败: {e}", exc_info=True)
-            history = []
+    # 使用预热结果，或从保存的消息历史重建 Chat 上下文
+    if history is None and user_id and revision is not None:
+        history = chat_prewarm.take(user_id, session_id, revision)
+        if history is not None:
+            logger.info(f"会话 {session_id} 使用预热的 {len(history)} 条历史消息")
+    if history is None:
+        history = []
+        if user_id:
+            try:
+                history = rebuild_chat_history(user_id, session_id)
+                if history:
+                    logger.info(f"为会话 {session_id} 重建了 {len(history)} 条历史消息")
+            except Exception as e:
+                logger.error(f"重建聊天历史失败: {e}", exc_info=True)
+                history = []
     
-    chat = client.chats.create(model=model, config=config, history=history)
+    if key_id is None:
+        key_id = client_pool.select()
+    client = get_client(key_id)
+    chats = client.aio.chats if aio else client.chats
+    chat = chats.create(model=model, config=config, history=history)
     with active_chats_lock:
         active_chats[session_id] = {
             "chat": chat,
+            "key_id": key_id,
             "aspect_ratio": aspect_ratio,
             "image_size": image_size,
             "model": model,
+            "aio": aio,
             "last_access": time.time()
         }
-    return chat
+    return chat, key_id
+
+
+def _move_chat(session_id, chat, key_id, aspect_ratio, image_size, model, aio, exclude=()):
+    """
+    把聊天迁移到另一个可用密钥（优先同一端点，保证历史中的思维签名等上下文兼容）
+    直接复用内存中的对话历史，不重新读取会话文件；没有其他可用密钥时返回 None
+    """
+    exclude = set(exclude) | {key_id}
+    new_key_id = client_pool.select(near=key_id, exclude=exclude)
+    if new_key_id in exclude or not client_pool.is_available(new_key_id):
+        return None
+    logger.info(f"会话 {session_id} 的聊天从密钥 {key_id} 迁移到 {new_key_id}")
+    return create_chat(session_id, aspect_ratio, image_size, model, aio=aio,
+                       key_id=new_key_id, history=chat.get_history())
 
 
-def get_or_create_chat(session_id, aspect_ratio="auto", image_size="2K", model=DEFAULT_MODEL, user_id=None):
-    """获取或创建聊天实例"""
+def get_or_create_chat(session_id, aspect_ratio="auto", image_size="2K", model=DEFAULT_MODEL, user_id=None, aio=False,
+                       revision=None):
+    """获取或创建聊天实例，返回 (chat, 密钥 id)；已有聊天固定使用创建时的密钥，密钥冷却时迁移"""
+    previous_key_id = None
+    pinned_chat = None
     with active_chats_lock:
         if session_id in active_chats:
             chat_data = active_chats[session_id]
             chat_data["last_access"] = time.time()  # 更新最后访问时间
+            previous_key_id = chat_data["key_id"]
             # 如果配置变了，重新创建
             if (chat_data["aspect_ratio"] != aspect_ratio or 
                 chat_data["image_size"] != image_size or 
-                chat_data.get("model") != model):
+                chat_data.get("model") != model or
+                chat_data.get("aio", False) != aio):
                 pass  # 需要重建，退出锁后处理
+            elif client_pool.is_available(previous_key_id):
+                return chat_data["chat"], previous_key_id
             else:
-                return chat_data["chat"]
-    return create_chat(session_id, aspect_ratio, image_size, model, user_id)
+                pinned_chat = chat_data["chat"]
+
+    if pinned_chat is not None:
+        # 固定的密钥冷却中或超出 rpm：迁移到其他密钥，没有可用密钥时继续使用原密钥
+        moved = _move_chat(session_id, pinned_chat, previous_key_id, aspect_ratio, image_size, model, aio)
+        return moved or (pinned_chat, previous_key_id)
+
+    key_id = None
+    if previous_key_id is not None:
+        key_id = client_pool.select(near=previous_key_id)
+    return create_chat(session_id, aspect_ratio, image_size, model, user_id, aio, key_id=key_id, revision=revision)
+
+
+def _prewarm_chat(user_id, session_id, session_data):
+    """当前进程没有该会话的聊天实例时，在后台预热聊天历史（用户输入提示词期间完成）"""
+    if not session_data.get("messages"):
+        return False
+    with active_chats_lock:
+        if session_id in active_chats:
+            return False
+    return chat_prewarm.schedule(user_id, session_id, session_data.get("revision", 0),
+                                 lambda: rebuild_chat_history(user_id, session_id))
 
 
 @app.route("/")
@@ -501,7 +595,8 @@ def index():
     user = None
     if "user_id" in session:
         user = get_user_by_id(session["user_id"])
-    return render_template("index.html", user=user, default_model=DEFAULT_MODEL)
+    return render_template("index.html", user=user, default_model=DEFAULT_MODEL, model_costs=MODEL_COSTS,
+                           model_routing=model_routing.MODEL_ROUTING_ENABLED)
 
 
 @app.route("/api/models", methods=["GET"])
@@ -509,12 +604,24 @@ def index():
 def get_models():
     """获取可用的图像生成模型列表"""
     models = [
-        {"id": model_id, "name": name, "default": model_id == DEFAULT_MODEL}
+        {"id": model_id, "name": name, "default": model_id == DEFAULT_MODEL, "costs": MODEL_COSTS[model_id]}
         for model_id, name in ALLOWED_MODELS.items()
     ]
     return jsonify({"models": models, "default": DEFAULT_MODEL})
 
 
+@app.route("/api/user/preferences", methods=["PUT"])
+@login_required
+@csrf.exempt
+def update_user_preferences():
+    """更新用户偏好：model_fallback（所选模型繁忙时允许已有会话自动切换到更快的模型）"""
+    data = _get_json_data()
+    if not isinstance(data.get("model_fallback"), bool):
+        return jsonify({"error": "model_fallback 参数无效"}), 400
+    set_user_model_fallback(session["user_id"], data["model_fallback"])
+    return jsonify({"success": True, "model_fallback": data["model_fallback"]})
+
+
 @app.route("/login")
 def login():
     """登录页（重定向到主页，主页自带登录功能）"""
@@ -559,24 +666,27 @@ def send_verification_code_route():
     if not re.match(email_pattern, email):
         return jsonify({"error": "error_invalid_email"}), 400
     
+    if not email_service.is_configured():
+        logger.error("邮件服务未配置")
+        return jsonify({"error": "error_email_not_configured"}), 500
+    
     # 生成验证码
     code = generate_verification_code(6)
-    code_hash = generate_password_hash(code)
+    code_hash = hash_secret("verification_code", code)
     
     # 设置过期时间（10分钟）
-    expires_at = (datetime.now() + timedelta(minutes=10)).isoformat()
+    expires = datetime.now() + timedelta(minutes=10)
     
-    # 保存到数据库
-    success, message = create_verification_code(email, code_hash, expires_at)
+    # 保存验证码，并在同一事务中写入发件箱，由后台线程发送
+    success, message = create_verification_code(
+        email, code_hash, expires.isoformat(),
+        outbox_payload={"code": code, "expires_at": expires.timestamp()}
+    )
     if not success:
         return jsonify({"error": message}), 500
     
-    # 发送邮件
-    success, message = send_verification_email(email, code)
-    if success:
-        return jsonify({"success": True, "message": message})
-    else:
-        return jsonify({"error": message}), 500
+    email_service.notify_outbox()
+    return jsonify({"success": True, "message": "success"})
 
 
 @app.route("/api/register", methods=["POST"])
@@ -622,19 +732,69 @@ def api_logout():
 def get_sessions():
     """获取当前用户的所有会话列表"""
     user_id = session["user_id"]
-    sessions = load_sessions(user_id)
-    session_list = []
-    for sid, data in sessions.items():
-        session_list.append({
-            "id": sid,
-            "title": data.get("title", "新对话"),
-            "created_at": data.get("created_at"),
-            "updated_at": data.get("updated_at"),
-            "message_count": len(data.get("messages", []))
-        })
-    # 按更新时间排序
-    session_list.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
-    return jsonify(session_list)
+    # 会话列表来自数据库中的会话索引（按更新时间排序），不读取会话文件
+    return jsonify(session_store.list_sessions(user_id))
+
+
+SEARCH_MAX_QUERY_LENGTH = 200
+SEARCH_MAX_RESULTS = 50
+
+
+def _highlight_html(snippet):
+    """转义搜索摘要中的 HTML，再把高亮标记替换为 <mark>"""
+    return (html.escape(snippet)
+            .replace(SEARCH_HIGHLIGHT_START, "<mark>")
+            .replace(SEARCH_HIGHLIGHT_END, "</mark>"))
+
+
+@app.route("/api/search", methods=["GET"])
+@login_required
+@csrf.exempt
+def search_sessions():
+    """
+    在当前用户的全部会话中搜索提示词和模型回复
+    参数: q 搜索词（空格分隔，需全部匹配），limit 返回条数
+    返回的 snippet 是已转义的 HTML，匹配部分用 <mark> 标记
+    """
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return jsonify({"error": "请输入搜索内容"}), 400
+    if len(query) > SEARCH_MAX_QUERY_LENGTH:
+        return jsonify({"error": f"搜索内容不能超过 {SEARCH_MAX_QUERY_LENGTH} 个字符"}), 400
+    limit = min(max(request.args.get("limit", 20, type=int) or 20, 1), SEARCH_MAX_RESULTS)
+
+    results = search_messages(session["user_id"], query, limit=limit)
+    for result in results:
+        result["snippet"] = _highlight_html(result["snippet"])
+    return jsonify({
+        "results": results,
+        "index_ready": session_store.index_version() >= session_store.SEARCH_INDEX_VERSION
+    })
+
+
+GALLERY_PAGE_SIZE = 60
+GALLERY_MAX_PAGE_SIZE = 200
+
+
+@app.route("/api/gallery", methods=["GET"])
+@login_required
+@csrf.exempt
+def get_gallery():
+    """
+    按时间倒序分页获取当前用户所有会话中生成的图片（来自图片索引，不读取会话文件和原图）
+    参数: cursor 上一页返回的 next_cursor，limit 每页数量
+    """
+    limit = min(max(request.args.get("limit", GALLERY_PAGE_SIZE, type=int) or GALLERY_PAGE_SIZE, 1),
+                GALLERY_MAX_PAGE_SIZE)
+    try:
+        images, next_cursor = get_gallery_page(session["user_id"], limit, request.args.get("cursor") or None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "images": images,
+        "next_cursor": next_cursor,
+        "index_ready": session_store.index_version() >= session_store.IMAGE_INDEX_VERSION
+    })
 
 
 @app.route("/api/sessions", methods=["POST"])
@@ -643,17 +803,17 @@ def get_sessions():
 def create_session_route():
     """创建新会话"""
     user_id = session["user_id"]
-    sessions = load_sessions(user_id)
     session_id = str(uuid.uuid4())
     now = datetime.now().isoformat()
-    sessions[session_id] = {
+    session_store.create_session(user_id, session_id, {
         "title": "新对话",
         "created_at": now,
         "updated_at": now,
         "messages": [],
-        "settings": None  # 首次生成后会锁定分辨率和纵横比
-    }
-    save_sessions(user_id, sessions)
+        "settings": None,  # 首次生成后会锁定分辨率和纵横比
+        "revision": 0,
+        "base_revision": 0
+    }, deferred=True)
     return jsonify({
         "id": session_id,
         "title": "新对话",
@@ -667,29 +827,86 @@ def create_session_route():
 @login_required
 @csrf.exempt
 def get_session_route(session_id):
-    """获取单个会话详情"""
+    """
+    获取单个会话详情
+    支持 If-None-Match 条件请求（未变化返回 304），
+    以及 ?since=<消息数>&since_revision=<修订号> 增量同步，只返回新增消息
+    """
     if not _validate_session_id(session_id):
         return jsonify({"error": "无效的会话ID"}), 400
     user_id = session["user_id"]
-    sessions = load_sessions(user_id)
-    if session_id not in sessions:
+    session_data = session_store.get_session(user_id, session_id)
+    if session_data is None:
         return jsonify({"error": "会话不存在"}), 404
-    session_data = sessions[session_id]
+    messages = session_data.get("messages", [])
+    revision = session_data.get("revision", 0)
+    _prewarm_chat(user_id, session_id, session_data)
+
+    etag = _session_etag(session_id, session_data)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    # 增量同步：客户端的基准修订号之后没有删除过消息，才能只返回新增部分
+    start = 0
+    delta = False
+    since = request.args.get("since", type=int)
+    since_revision = request.args.get("since_revision", type=int)
+    if (since is not None and since_revision is not None
+            and since_revision >= session_data.get("base_revision", 0)
+            and 0 <= since <= len(messages)):
+        start = since
+        delta = True
 
     # 过滤掉 thought_signature，前端不需要，避免传输大量数据
     filtered_messages = []
-    for msg in session_data.get("messages", []):
+    for msg in messages[start:]:
         filtered_msg = {k: v for k, v in msg.items() if k not in ("thought_signature", "text_thought_signature")}
         filtered_messages.append(filtered_msg)
 
-    return jsonify({
+    response = jsonify({
         "id": session_id,
         "title": session_data.get("title"),
         "created_at": session_data.get("created_at"),
         "updated_at": session_data.get("updated_at"),
         "messages": filtered_messages,
         "settings": session_data.get("settings"),
+        "revision": revision,
+        "message_count": len(messages),
+        "delta": delta,
+        "since": start,
     })
+    response.set_etag(etag, weak=True)
+    # 浏览器缓存响应，但每次都用 ETag 重新验证
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/sessions/<session_id>/prewarm", methods=["POST"])
+@login_required
+@csrf.exempt
+def prewarm_session_chat(session_id):
+    """在后台预热会话的聊天历史（打开会话时已自动预热，也可以在用户开始输入时显式调用）"""
+    if not _validate_session_id(session_id):
+        return jsonify({"error": "无效的会话ID"}), 400
+    session_data = session_store.get_session(session["user_id"], session_id)
+    if session_data is None:
+        return jsonify({"error": "会话不存在"}), 404
+    return jsonify({"scheduled": _prewarm_chat(session["user_id"], session_id, session_data)}), 202
+
+
+@app.route("/api/sessions/<session_id>/prewarm", methods=["DELETE"])
+@login_required
+@csrf.exempt
+def cancel_session_prewarm(session_id):
+    """取消会话的预热（用户离开会话时调用）"""
+    if not _validate_session_id(session_id):
+        return jsonify({"error": "无效的会话ID"}), 400
+    return jsonify({"cancelled": chat_prewarm.cancel(session["user_id"], session_id)})
 
 
 @app.route("/api/sessions/<session_id>", methods=["DELETE"])
@@ -700,13 +917,11 @@ def delete_session_route(session_id):
     if not _validate_session_id(session_id):
         return jsonify({"error": "无效的会话ID"}), 400
     user_id = session["user_id"]
-    sessions = load_sessions(user_id)
-    if session_id in sessions:
+    session_data = session_store.delete_session(user_id, session_id)
+    if session_data is not None:
         # 删除相关图片、缩略图和参考图片
-        for msg in sessions[session_id].get("messages", []):
+        for msg in session_data.get("messages", []):
             _delete_message_files(msg)
-        del sessions[session_id]
-        save_sessions(user_id, sessions)
         # 清除活跃聊天
         with active_chats_lock:
             if session_id in active_chats:
@@ -722,13 +937,13 @@ def update_session_title(session_id):
     if not _validate_session_id(session_id):
         return jsonify({"error": "无效的会话ID"}), 400
     user_id = session["user_id"]
-    sessions = load_sessions(user_id)
-    if session_id not in sessions:
-        return jsonify({"error": "会话不存在"}), 404
     data = _get_json_data()
-    sessions[session_id]["title"] = data.get("title", "新对话")
-    sessions[session_id]["updated_at"] = datetime.now().isoformat()
-    save_sessions(user_id, sessions)
+    title = data.get("title", "新对话")
+
+    # 标题修改合并后延迟写入会话文件（会话列表和会话详情立即可见）
+    if not session_store.update_session_metadata(user_id, session_id, title=title,
+                                                 updated_at=datetime.now().isoformat()):
+        return jsonify({"error": "会话不存在"}), 404
     return jsonify({"success": True})
 
 
@@ -777,7 +992,8 @@ def _process_reference_images(reference_images, session_id, message_index):
                 data=base64.b64decode(image_data),
                 mime_type=mime_type
             ))
-            ref_filename = f"ref_{session_id}_{message_index}_{i}.png"
+            # 附加随机后缀，保证文件名永不重复（图片以 immutable 方式长期缓存）
+            ref_filename = f"ref_{session_id}_{message_index}_{i}_{uuid.uuid4().hex[:8]}.png"
             ref_path = os.path.join(IMAGES_DIR, ref_filename)
             with open(ref_path, "wb") as f:
                 f.write(base64.b64decode(image_data))
@@ -786,13 +1002,14 @@ def _process_reference_images(reference_images, session_id, message_index):
 
 
 def _process_gemini_response(response, session_id):
-    """处理 Gemini API 响应：提取文本、图片、缩略图和签名"""
+    """处理 Gemini API 响应：提取文本、图片（及其尺寸和大小）、缩略图和签名"""
     if response.parts is None:
         return None
 
     result_text = ""
     result_image = None
     result_thumbnail = None
+    result_image_info = None
     image_thought_signature = None
     text_thought_signature = None
 
@@ -812,6 +1029,8 @@ def _process_gemini_response(response, session_id):
             image = part.as_image()
             image.save(image_path)
             result_image = f"/static/images/{image_filename}"
+            # 保存时记录尺寸和大小，图库浏览直接读取图片索引，不再打开原图
+            result_image_info = session_store.read_image_info(image_path)
 
             if hasattr(part, 'thought_signature') and part.thought_signature:
                 if isinstance(part.thought_signature, bytes):
@@ -826,125 +1045,296 @@ def _process_gemini_response(response, session_id):
         "text": result_text,
         "image": result_image,
         "thumbnail": result_thumbnail,
+        "image_info": result_image_info,
         "thought_signature": image_thought_signature,
         "text_thought_signature": text_thought_signature
     }
 
 
-@app.route("/api/generate", methods=["POST"])
-@login_required
-@limiter.limit("20 per hour")  # 限制生成频率
-@csrf.exempt
-def generate_image():
-    """生成或修改图像"""
-    user_id = session["user_id"]
-    data = _get_json_data()
+# ASGI 异步服务模式（asgi.py）下，/api/generate 的上游调用由事件循环等待，
+# 视图只负责准备工作，并把待执行的生成任务放入 WSGI environ 交给 asgi.py
+ASYNC_UPSTREAM_ENVIRON_KEY = "nano.async_upstream"
+PENDING_GENERATION_ENVIRON_KEY = "nano.pending_generation"
+
 
+def generation_cost(model, image_size):
+    """本次生成消耗的点数"""
+    return MODEL_COSTS.get(model, DEFAULT_IMAGE_COSTS).get(image_size, DEFAULT_IMAGE_COSTS["2K"])
+
+
+def _refund_generation(job):
+    """退还生成任务已扣除的点数"""
+    if job["cost"] > 0 and job["user"] and not job["user"].get("is_admin"):
+        update_user_credits(job["user_id"], job["cost"])
+
+
+def _prepare_generation(user_id, data, aio=False):
+    """
+    生成前准备：参数校验、锁定会话设置、扣除点数、获取聊天实例、处理参考图片
+    返回: (job: dict or None, error_response or None)
+    """
+    started = time.monotonic()
     # 1. 验证输入参数
     error = _validate_generate_params(data)
     if error:
-        return error
+        return None, error
 
     session_id = data.get("session_id")
     if not _validate_session_id(session_id):
-        return jsonify({"error": "无效的会话ID"}), 400
+        return None, (jsonify({"error": "无效的会话ID"}), 400)
     prompt = data.get("prompt", "")
     aspect_ratio = data.get("aspect_ratio", "auto")
     image_size = data.get("image_size", "2K")
     model = data.get("model", DEFAULT_MODEL)
     reference_images = data.get("reference_images", [])
 
-    sessions = load_sessions(user_id)
-    if session_id not in sessions:
-        return jsonify({"error": "会话不存在"}), 404
+    session_data = session_store.get_session(user_id, session_id)
+    if session_data is None:
+        return None, (jsonify({"error": "会话不存在"}), 404)
 
     # 强制使用会话锁定的设置
-    if sessions[session_id].get("settings"):
-        settings = sessions[session_id]["settings"]
+    if session_data.get("settings"):
+        settings = session_data["settings"]
         aspect_ratio = settings.get("aspect_ratio", aspect_ratio)
         image_size = settings.get("image_size", image_size)
         model = settings.get("model", model)
 
-    # 预初始化变量，确保异常处理块中可以安全访问
-    cost = 0
-    user = None
+    # 模型路由：所选模型拥堵时切换到更快的备用模型（新会话，或允许自动切换的用户）
+    user = get_user_by_id(user_id)
+    requested_model = model
+    endpoints = client_pool.endpoints()
+    model, route_reason, route_health = model_routing.route(
+        model, endpoints, new_session=not session_data.get("settings"),
+        opted_in=bool(user and user.get("model_fallback"))
+    )
 
+    # 预初始化任务状态，确保异常处理中可以安全退还点数
+    job = {
+        "user_id": user_id,
+        "session_id": session_id,
+        "prompt": prompt,
+        "aspect_ratio": aspect_ratio,
+        "image_size": image_size,
+        "model": model,
+        "requested_model": requested_model,
+        "cost": 0,
+        "user": None,
+        "started": started,
+        "created_at": datetime.now().isoformat(),
+    }
+
+    # 该模型在所有端点上都处于熔断时直接失败（不扣点数、不读取聊天历史）
     try:
-        # 2. 检查并扣除点数（管理员免消耗）
-        user = get_user_by_id(user_id)
-        credits_after_deduct = user["credits"]  # 记录扣除后的点数
+        circuit_breaker.check(model, endpoints)
+    except circuit_breaker.CircuitOpen as e:
+        return None, _generation_error_response(job, e)
+
+    if route_reason:
+        try:
+            record_model_routing(user_id, session_id, requested_model, model, route_reason,
+                                 route_health["p95_seconds"], route_health["error_rate"])
+        except Exception as e:
+            logger.error(f"记录模型路由失败: {e}")
+
+    try:
+        # 2. 检查并扣除点数（管理员免消耗，按实际使用的模型计费）
+        job["user"] = user
+        job["credits_after_deduct"] = user["credits"]  # 记录扣除后的点数
         if not user.get("is_admin"):
-            cost_map = {"1K": 1, "2K": 2, "4K": 4}
-            cost = cost_map.get(image_size, 2)
+            cost = generation_cost(model, image_size)
 
             if user["credits"] < cost:
-                return jsonify({"error": f"点数不足，本次生成需要 {cost} 点，剩余 {user['credits']} 点。请联系管理员充值。"}), 403
+                return None, (jsonify({"error": f"点数不足，本次生成需要 {cost} 点，剩余 {user['credits']} 点。请联系管理员充值。"}), 403)
 
-            _, _, credits_after_deduct = update_user_credits(user_id, -cost)
+            _, _, job["credits_after_deduct"] = update_user_credits(user_id, -cost)
+            job["cost"] = cost
 
         # 3. 获取或创建聊天实例
-        chat = get_or_create_chat(session_id, aspect_ratio, image_size, model, user_id)
+        job["chat"], job["key_id"] = get_or_create_chat(session_id, aspect_ratio, image_size, model, user_id, aio=aio,
+                                                        revision=session_data.get("revision", 0))
+        job["aio"] = aio
+        job["tried_keys"] = [job["key_id"]]
 
         # 4. 处理参考图片
-        contents, saved_ref_images = _process_reference_images(
-            reference_images, session_id, len(sessions[session_id]['messages'])
+        contents, job["saved_ref_images"] = _process_reference_images(
+            reference_images, session_id, len(session_data['messages'])
         )
         contents.append(prompt)
+        job["contents"] = contents
+    except Exception as e:
+        return None, _generation_error_response(job, e)
+
+    job["prepare_ms"] = int((time.monotonic() - started) * 1000)
+    return job, None
+
+
+def _log_generation(job, outcome, error_code=None, image_bytes=0):
+    """写入生成记录（并累加统计汇总），失败只记录日志，不影响接口响应"""
+    now = time.monotonic()
+    upstream_ms = job.get("upstream_ms")
+    save_ms = None
+    if "upstream_finished" in job:
+        save_ms = int((now - job["upstream_finished"]) * 1000)
+    try:
+        record_generation({
+            "user_id": job["user_id"],
+            "session_id": job["session_id"],
+            "model": job["model"],
+            "requested_model": job["requested_model"],
+            "image_size": job["image_size"],
+            "aspect_ratio": job["aspect_ratio"],
+            "key_id": job.get("key_id"),
+            "credits": job["cost"] if outcome == "success" else 0,
+            "outcome": outcome,
+            "error_code": error_code,
+            "attempts": len(job.get("tried_keys") or [None]),
+            "prepare_ms": job.get("prepare_ms"),
+            "upstream_ms": upstream_ms,
+            "save_ms": save_ms,
+            "total_ms": int((now - job["started"]) * 1000),
+            "image_bytes": image_bytes,
+            "created_at": job["created_at"],
+        })
+    except Exception as e:
+        logger.error(f"写入生成记录失败: {e}")
+
+
+def _upstream_finished(job, upstream_started):
+    """记录上游调用（含切换密钥重试）的总耗时"""
+    job["upstream_finished"] = time.monotonic()
+    job["upstream_ms"] = int((job["upstream_finished"] - upstream_started) * 1000)
+
 
-        # 5. 调用 Gemini API
-        response = chat.send_message(contents)
+def _complete_generation(job, response):
+    """处理 Gemini 响应并保存消息到会话，返回接口响应"""
+    user_id = job["user_id"]
+    session_id = job["session_id"]
+    prompt = job["prompt"]
+    user = job["user"]
 
+    try:
         # 6. 处理 API 响应
         result = _process_gemini_response(response, session_id)
         if result is None:
+            _log_generation(job, "error", "EMPTY_RESPONSE")
             return jsonify({"error": "AI 未返回有效响应，请重试"}), 500
 
-        # 7. 保存消息到会话
+        # 7. 保存消息到会话（按会话读取最新数据后追加，与同一会话的并发写入冲突时自动重试）
         now = datetime.now().isoformat()
 
-        sessions[session_id]["messages"].append({
-            "role": "user",
-            "content": prompt,
-            "reference_images": saved_ref_images if saved_ref_images else None,
-            "timestamp": now
-        })
-
-        sessions[session_id]["messages"].append({
-            "role": "assistant",
-            "content": result["text"],
-            "image": result["image"],
-            "thumbnail": result["thumbnail"] if result["image"] else None,
-            "thought_signature": result["thought_signature"],
-            "text_thought_signature": result["text_thought_signature"],
-            "timestamp": now
-        })
-
-        # 更新会话标题（如果是第一条消息）
-        if len(sessions[session_id]["messages"]) == 2:
-            sessions[session_id]["title"] = prompt[:20] + ("..." if len(prompt) > 20 else "")
-            sessions[session_id]["settings"] = {
-                "aspect_ratio": aspect_ratio,
-                "image_size": image_size,
-                "model": model
-            }
-
-        sessions[session_id]["updated_at"] = now
-        save_sessions(user_id, sessions)
+        def append_messages(session_data):
+            session_data["messages"].append({
+                "role": "user",
+                "content": prompt,
+                "reference_images": job["saved_ref_images"] if job["saved_ref_images"] else None,
+                "timestamp": now
+            })
+
+            session_data["messages"].append({
+                "role": "assistant",
+                "content": result["text"],
+                "image": result["image"],
+                "thumbnail": result["thumbnail"] if result["image"] else None,
+                "image_info": result["image_info"],
+                "model": job["model"],
+                "thought_signature": result["thought_signature"],
+                "text_thought_signature": result["text_thought_signature"],
+                "timestamp": now
+            })
+
+            # 更新会话标题（如果是第一条消息）
+            if len(session_data["messages"]) == 2:
+                session_data["title"] = prompt[:20] + ("..." if len(prompt) > 20 else "")
+                session_data["settings"] = {
+                    "aspect_ratio": job["aspect_ratio"],
+                    "image_size": job["image_size"],
+                    "model": job["model"]
+                }
+
+            session_data["updated_at"] = now
+            _bump_session_revision(session_data)
+
+        session_data, _ = session_store.update_session(user_id, session_id, append_messages)
+        if session_data is None:
+            # 生成期间会话已被删除：退还点数并删除本次生成的文件
+            _refund_generation(job)
+            _delete_message_files({
+                "image": result["image"],
+                "thumbnail": result["thumbnail"],
+                "reference_images": job["saved_ref_images"]
+            })
+            _log_generation(job, "error", "SESSION_DELETED")
+            return jsonify({"error": "会话不存在"}), 404
+        try:
+            record_generation_usage(user_id, job["cost"])
+        except Exception as e:
+            logger.error(f"记录用户 {user_id} 生成用量失败: {e}")
+        _log_generation(job, "success", image_bytes=(result["image_info"] or {}).get("size", 0))
 
         return jsonify({
             "text": result["text"],
             "image": result["image"],
             "thumbnail": result["thumbnail"],
-            "session_title": sessions[session_id]["title"],
-            "settings": sessions[session_id].get("settings"),
-            "credits_remaining": credits_after_deduct if not user.get("is_admin") else "admin"
+            "reference_images": job["saved_ref_images"] or None,
+            "session_title": session_data["title"],
+            "settings": session_data.get("settings"),
+            "revision": session_data["revision"],
+            "model": job["model"],
+            "routed_from": job["requested_model"] if job["requested_model"] != job["model"] else None,
+            "credits_remaining": job["credits_after_deduct"] if not user.get("is_admin") else "admin"
         })
+    except Exception as e:
+        return _generation_error_response(job, e)
+
+
+def _failover_generation(job, e):
+    """
+    上游返回配额耗尽/权限错误，或密钥所在端点熔断时，把本次生成的聊天迁移到其他密钥，返回 True 表示可以重试
+    失败的请求不会写入聊天历史，迁移后重发同样的内容即可；重试次数不超过 GEMINI_KEY_FAILOVER_ATTEMPTS
+    """
+    if isinstance(e, circuit_breaker.CircuitOpen):
+        kind = "circuit_open"
+    else:
+        kind = client_pool.classify_error(e)
+    if kind not in ("quota", "permission", "circuit_open"):
+        return False
+    if len(job["tried_keys"]) > client_pool.KEY_FAILOVER_ATTEMPTS:
+        return False
+    # 熔断中的端点上的密钥不参与迁移
+    blocked = [key["id"] for key in client_pool.KEYS if circuit_breaker.is_open(job["model"], key["base_url"])]
+    moved = _move_chat(job["session_id"], job["chat"], job["key_id"], job["aspect_ratio"], job["image_size"],
+                       job["model"], job["aio"], exclude=job["tried_keys"] + blocked)
+    if moved is None:
+        return False
+    logger.warning(f"密钥 {job['key_id']} 生成失败（{kind}），切换到 {moved[1]} 重试")
+    job["chat"], job["key_id"] = moved
+    job["tried_keys"].append(job["key_id"])
+    return True
+
+
+def _circuit_open_response(e):
+    """上游熔断中：返回 503 和建议的重试时间"""
+    logger.warning(f"上游熔断中，拒绝生成请求: {e}")
+    response = jsonify({"error": "error_upstream_unavailable", "error_code": "CIRCUIT_OPEN", "retry_after": e.retry_after})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 503
+
+
+def _generation_error_response(job, e):
+    """生成失败：退还已扣除的点数，把异常转换为接口错误响应，并写入生成记录"""
+    _refund_generation(job)
+    response, status = _generation_error(job["user_id"], e)
+    _log_generation(job, "error", (response.get_json() or {}).get("error_code") or "GENERATION_FAILED")
+    return response, status
 
-    except genai_errors.ServerError as e:
-        logger.error(f"Image generation server error for user {user_id}: {str(e)}", exc_info=True)
-        # 退还已扣除的点数
-        if cost > 0 and user and not user.get("is_admin"):
-            update_user_credits(user_id, cost)
+
+def _generation_error(user_id, e):
+    """把生成异常转换为接口错误响应 (response, status)"""
+    if isinstance(e, circuit_breaker.CircuitOpen):
+        return _circuit_open_response(e)
+
+    if isinstance(e, genai_errors.ServerError):
+        logger.error(f"Image generation server error for user {user_id}: {str(e)}", exc_info=e)
         error_str = str(e)
 
         if "DEADLINE_EXCEEDED" in error_str:
@@ -956,59 +1346,171 @@ def generate_image():
         else:
             return jsonify({"error": "error_server_busy", "error_code": "SERVER_ERROR"}), 503
 
-    except genai_errors.ClientError as e:
+    if isinstance(e, genai_errors.ClientError):
         logger.warning(f"Image generation client error for user {user_id}: {str(e)}")
-        # 退还已扣除的点数
-        if cost > 0 and user and not user.get("is_admin"):
-            update_user_credits(user_id, cost)
         error_str = str(e)
 
         if "INVALID_ARGUMENT" in error_str:
             return jsonify({"error": "error_invalid_request", "error_code": "INVALID_ARGUMENT"}), 400
+        elif "RESOURCE_EXHAUSTED" in error_str:
+            # 所有可用密钥的配额都已耗尽（429）
+            return jsonify({"error": "error_quota_exceeded", "error_code": "RESOURCE_EXHAUSTED"}), 503
         elif "PERMISSION_DENIED" in error_str:
             return jsonify({"error": "error_permission_denied", "error_code": "PERMISSION_DENIED"}), 403
         else:
             return jsonify({"error": "error_invalid_input", "error_code": "CLIENT_ERROR"}), 400
 
-    except Exception as e:
-        logger.error(f"Image generation failed for user {user_id}: {str(e)}", exc_info=True)
-        # 退还已扣除的点数
-        if cost > 0 and user and not user.get("is_admin"):
-            update_user_credits(user_id, cost)
+    logger.error(f"Image generation failed for user {user_id}: {str(e)}", exc_info=e)
+    if os.getenv('FLASK_DEBUG', 'False').lower() == 'true':
+        return jsonify({"error": str(e)}), 500
+    else:
+        return jsonify({"error": "error_generation_failed", "error_code": "GENERATION_FAILED"}), 500
+
+
+@app.route("/api/generate", methods=["POST"])
+@login_required
+@limiter.limit("20 per hour")  # 限制生成频率
+@csrf.exempt
+def generate_image():
+    """生成或修改图像"""
+    user_id = session["user_id"]
+    data = _get_json_data()
+    deferred = bool(request.environ.get(ASYNC_UPSTREAM_ENVIRON_KEY))
+
+    job, error = _prepare_generation(user_id, data, aio=deferred)
+    if error:
+        return error
+
+    if deferred:
+        # 异步模式：由 asgi.py 在事件循环中等待上游响应，不占用线程
+        request.environ[PENDING_GENERATION_ENVIRON_KEY] = job
+        return "", 202
+
+    # 5. 调用 Gemini API（配额/权限错误时切换到其他密钥重试）
+    upstream_started = time.monotonic()
+    while True:
+        try:
+            with circuit_breaker.guard(job["model"], client_pool.endpoint(job["key_id"])), \
+                    client_pool.track(job["key_id"]):
+                response = job["chat"].send_message(job["contents"])
+            break
+        except Exception as e:
+            if not _failover_generation(job, e):
+                _upstream_finished(job, upstream_started)
+                return _generation_error_response(job, e)
+
+    _upstream_finished(job, upstream_started)
+    return _complete_generation(job, response)
+
+
+@app.route(f"/static/{assets.DIST_DIRNAME}/<path:filename>")
+def serve_dist_asset(filename):
+    """提供指纹化静态资源：按 Accept-Encoding 选择预压缩版本，长期 immutable 缓存"""
+    dist_dir = assets.DIST_DIR
+    file_path = os.path.abspath(os.path.join(dist_dir, filename))
+    if not file_path.startswith(dist_dir + os.sep) or not os.path.isfile(file_path):
+        return jsonify({"error": "File not found"}), 404
+
+    mimetype = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    encoding = None
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if candidate in accept_encoding and os.path.isfile(file_path + suffix):
+            file_path += suffix
+            encoding = candidate
+            break
+
+    response = send_file(file_path, mimetype=mimetype, max_age=STATIC_ASSET_MAX_AGE, conditional=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def _replace_message_image(user_id, session_id, old_filename, new_filename, new_size):
+    """把会话中的生成图片引用改为重新压缩后的文件并更新大小，消息已不存在时返回 False"""
+    def replace(session_data):
+        for msg in session_data["messages"]:
+            if msg.get("image") and os.path.basename(msg["image"]) == old_filename:
+                msg["image"] = f"/static/images/{new_filename}"
+                if msg.get("image_info"):
+                    msg["image_info"] = dict(msg["image_info"], size=new_size)
+                msg.pop("image_bytes", None)  # 保存时按新文件重新计算
+                _bump_session_revision(session_data, truncated=True)
+                return True
+        return False
+
+    _, replaced = session_store.update_session(user_id, session_id, replace)
+    return bool(replaced)
+
 
-        if os.getenv('FLASK_DEBUG', 'False').lower() == 'true':
-            return jsonify({"error": str(e)}), 500
+def _serve_immutable_image(directory, filename, accel_subdir, originals=False):
+    """
+    提供不可变的图片文件（生成图、参考图、缩略图文件名唯一，内容永不改变）：
+    强校验 ETag/Last-Modified、304、Range、长期 immutable 缓存，
+    可选交给前端代理（X-Accel-Redirect / X-Sendfile）传输文件内容
+    originals 为 True（原图目录）时，已迁移到冷存储的文件先取回本地（保留原修改时间，ETag 不变）；
+    已重新压缩为其他格式的原图仍可按原文件名访问，永久重定向到新文件
+    """
+    # 文件名只允许安全字符（不含路径分隔符），等价于 secure_filename + 路径遍历检查
+    if not _IMAGE_FILENAME_PATTERN.match(filename):
+        logger.warning(f"Path traversal attempt detected: {filename}")
+        return jsonify({"error": "Invalid file path"}), 400
+
+    file_ext = os.path.splitext(filename)[1].lower()
+    if file_ext not in ALLOWED_IMAGE_EXTENSIONS:
+        logger.warning(f"Attempted to access invalid file type: {filename}")
+        return jsonify({"error": "Invalid file type"}), 400
+
+    file_path = os.path.abspath(os.path.join(directory, filename))
+    if originals:
+        image_storage.ensure_hot(file_path)
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        new_filename = image_recompress.renamed_filename(filename) if originals else None
+        if new_filename is None:
+            return jsonify({"error": "File not found"}), 404
+        # 改名是永久的（原文件已删除），重定向可以长期缓存
+        response = redirect(url_for("serve_image", filename=new_filename), 301)
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+        return response
+
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    if IMAGE_SENDFILE_MODE in ("x-accel", "x-sendfile"):
+        response = app.response_class(mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        if IMAGE_SENDFILE_MODE == "x-accel":
+            response.headers["X-Accel-Redirect"] = f"{IMAGE_ACCEL_PREFIX}{accel_subdir}/{filename}"
         else:
-            return jsonify({"error": "error_generation_failed", "error_code": "GENERATION_FAILED"}), 500
+            response.headers["X-Sendfile"] = file_path
+        response = response.make_conditional(request)
+    else:
+        response = send_file(file_path, mimetype=mimetype, conditional=True, etag=etag,
+                             last_modified=stat.st_mtime, max_age=IMAGE_CACHE_MAX_AGE)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route("/static/images/<filename>")
 def serve_image(filename):
     """提供图片文件（带路径遍历保护）"""
-    # 安全处理文件名
-    safe_filename = secure_filename(filename)
-    
-    # 验证文件扩展名
-    file_ext = os.path.splitext(safe_filename)[1].lower()
-    if file_ext not in ALLOWED_IMAGE_EXTENSIONS:
-        logger.warning(f"Attempted to access invalid file type: {filename}")
-        return jsonify({"error": "Invalid file type"}), 400
-    
-    # 构建完整路径并验证
-    file_path = os.path.join(IMAGES_DIR, safe_filename)
-    abs_file_path = os.path.abspath(file_path)
-    abs_images_dir = os.path.abspath(IMAGES_DIR)
-    
-    # 防止路径遍历攻击
-    if not abs_file_path.startswith(abs_images_dir):
-        logger.warning(f"Path traversal attempt detected: {filename}")
-        return jsonify({"error": "Invalid file path"}), 400
-    
-    # 检查文件是否存在
-    if not os.path.exists(abs_file_path):
-        return jsonify({"error": "File not found"}), 404
-    
-    return send_from_directory(IMAGES_DIR, safe_filename)
+    return _serve_immutable_image(IMAGES_DIR, filename, "images", originals=True)
+
+
+@app.route("/static/thumbnails/<filename>")
+def serve_thumbnail(filename):
+    """提供缩略图文件（带路径遍历保护）"""
+    return _serve_immutable_image(THUMBNAILS_DIR, filename, "thumbnails")
 
 
 # ========================================
@@ -1026,19 +1528,34 @@ def admin_page():
 @admin_required
 @csrf.exempt
 def admin_get_users():
-    """获取所有用户列表"""
-    users = get_all_users()
-    # 获取每个用户的会话数量
-    for user in users:
-        try:
-            user_sessions = load_sessions(user["id"])
-            user["session_count"] = len(user_sessions)
-            user["message_count"] = sum(len(s.get("messages", [])) for s in user_sessions.values())
-        except Exception as e:
-            logger.warning(f"读取用户 {user['id']} 会话数据失败: {e}")
-            user["session_count"] = 0
-            user["message_count"] = 0
-    return jsonify(users)
+    """
+    键集分页获取用户列表（用量计数来自 user_usage 表，不读取会话文件）
+    查询参数: cursor, page_size, sort, order(asc/desc), q(用户名/邮箱前缀或用户 ID),
+              role(admin/user), created_from, created_to(YYYY-MM-DD)
+    """
+    page_size = request.args.get("page_size", 50, type=int) or 50
+    try:
+        created_from = _parse_date_arg("created_from")
+        created_to = _parse_date_arg("created_to")
+        users, total, next_cursor = get_users_page(
+            page_size,
+            request.args.get("sort", "created_at"),
+            request.args.get("order", "desc"),
+            request.args.get("q", "").strip()[:100] or None,
+            request.args.get("role"),
+            created_from,
+            created_to,
+            request.args.get("cursor") or None
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "users": users,
+        "total": total,
+        "next_cursor": next_cursor,
+        "page_size": max(1, min(200, page_size)),
+        "stats": get_usage_stats()
+    })
 
 
 @app.route("/api/admin/users/<int:user_id>", methods=["DELETE"])
@@ -1046,25 +1563,14 @@ def admin_get_users():
 @csrf.exempt
 def admin_delete_user(user_id):
     """删除用户"""
-    # 删除用户会话中关联的所有图片和缩略图
+    # 删除用户的会话文件，以及会话中关联的所有图片和缩略图
     try:
-        user_sessions = load_sessions(user_id)
+        user_sessions = session_store.delete_user_sessions(user_id)
         for sid, session_data in user_sessions.items():
             for msg in session_data.get("messages", []):
                 _delete_message_files(msg)
     except Exception as e:
-        logger.warning(f"清理用户 {user_id} 的图片文件时出错: {e}")
-    
-    # 删除用户会话文件和锁文件
-    sessions_file = get_user_sessions_file(user_id)
-    if os.path.exists(sessions_file):
-        os.remove(sessions_file)
-    lock_file = sessions_file + ".lock"
-    if os.path.exists(lock_file):
-        try:
-            os.remove(lock_file)
-        except Exception:
-            pass
+        logger.warning(f"清理用户 {user_id} 的会话和图片文件时出错: {e}")
     
     success, message = delete_user(user_id)
     if success:
@@ -1108,18 +1614,7 @@ def admin_add_credits(user_id):
 @csrf.exempt
 def admin_get_user_sessions(user_id):
     """获取指定用户的所有会话列表（不含消息内容，加快加载）"""
-    sessions = load_sessions(user_id)
-    session_list = []
-    for sid, data in sessions.items():
-        session_list.append({
-            "id": sid,
-            "title": data.get("title", "新对话"),
-            "created_at": data.get("created_at"),
-            "updated_at": data.get("updated_at"),
-            "message_count": len(data.get("messages", []))
-        })
-    session_list.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
-    return jsonify(session_list)
+    return jsonify(session_store.list_sessions(user_id))
 
 
 @app.route("/api/admin/users/<int:user_id>/sessions/<session_id>", methods=["GET"])
@@ -1127,9 +1622,10 @@ def admin_get_user_sessions(user_id):
 @csrf.exempt
 def admin_get_session_detail(user_id, session_id):
     """获取指定用户的单个会话详情（含消息，点击时加载）"""
-    sessions = load_sessions(user_id)
-    if session_id in sessions:
-        data = sessions[session_id]
+    if not _validate_session_id(session_id):
+        return jsonify({"error": "无效的会话ID"}), 400
+    data = session_store.get_session(user_id, session_id)
+    if data is not None:
         return jsonify({
             "id": session_id,
             "title": data.get("title", "新对话"),
@@ -1142,7 +1638,7 @@ def admin_get_session_detail(user_id, session_id):
 @admin_required
 @csrf.exempt
 def admin_cleanup_data():
-    """清理历史数据"""
+    """提交历史数据清理任务（后台分批执行，通过任务接口查询进度）"""
     data = _get_json_data()
     cutoff_date_str = data.get("cutoff_date")
     
@@ -1157,184 +1653,235 @@ def admin_cleanup_data():
     except ValueError:
         return jsonify({"error": "日期格式无效"}), 400
 
-    # 第一步：清理过期消息
-    msg_stats = _cleanup_expired_messages(cutoff_date)
-    
-    # 第二步：清理孤儿图片
-    orphan_stats = _cleanup_orphan_files()
-
+    job_id = retention.enqueue(cutoff_date, created_by=session.get("user_id"))
     return jsonify({
         "success": True,
-        "message": "清理完成",
-        "deleted_stats": {
-            "sessions": msg_stats["sessions"],
-            "messages": msg_stats["messages"],
-            "images": msg_stats["images"] + orphan_stats["images"],
-            "orphan_images": orphan_stats["images"],
-            "orphan_thumbnails": orphan_stats["thumbnails"]
-        }
+        "message": "清理任务已提交",
+        "job": get_retention_job(job_id)
+    }), 202
+
+
+@app.route("/api/admin/cleanup/jobs", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_cleanup_jobs():
+    """获取最近的清理任务和当前保留策略"""
+    return jsonify({
+        "jobs": get_recent_retention_jobs(limit=20),
+        "policy": retention.policy_info()
     })
 
 
-def _cleanup_expired_messages(cutoff_date):
-    """清理截止日期之前的消息和空会话"""
-    deleted_sessions = 0
-    deleted_messages = 0
-    deleted_images = 0
+@app.route("/api/admin/scheduler", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_scheduler():
+    """获取后台调度器状态：主节点、各定时任务的最近执行情况和执行记录"""
+    job = request.args.get("job") or None
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), 200)
+    except ValueError:
+        return jsonify({"error": "limit 参数无效"}), 400
+    return jsonify(scheduler.status(limit=limit, job=job))
 
-    if not os.path.exists(SESSIONS_DIR):
-        return {"sessions": 0, "messages": 0, "images": 0}
 
-    for filename in os.listdir(SESSIONS_DIR):
-        if not filename.endswith(".json") or not filename.startswith("user_"):
-            continue
+@app.route("/api/admin/api-keys", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_api_keys():
+    """获取 Gemini 密钥池状态（当前 worker 进程的统计）：选择策略、各密钥的健康状态和请求数"""
+    return jsonify(client_pool.status())
 
-        # 提取 user_id 用于获取文件锁
-        try:
-            cleanup_user_id = int(filename.replace("user_", "").replace(".json", ""))
-        except (ValueError, TypeError):
-            continue
 
-        filepath = os.path.join(SESSIONS_DIR, filename)
-        lock = _get_session_lock(cleanup_user_id)
-        try:
-            with lock:
-                if not os.path.exists(filepath):
-                    continue
-                with open(filepath, "r", encoding="utf-8") as f:
-                    sessions = json.load(f)
-
-                modified = False
-                sessions_to_remove = []
-
-                for sid, session_data in sessions.items():
-                    new_messages = []
-                    session_modified = False
-
-                    for msg in session_data.get("messages", []):
-                        msg_time_str = msg.get("timestamp")
-                        should_delete = False
-
-                        if msg_time_str:
-                            try:
-                                msg_time = datetime.fromisoformat(msg_time_str)
-                                if msg_time < cutoff_date:
-                                    should_delete = True
-                            except ValueError:
-                                pass
-
-                        if should_delete:
-                            deleted_messages += 1
-                            session_modified = True
-                            # 统计图片数
-                            if msg.get("image"):
-                                deleted_images += 1
-                            if msg.get("reference_images"):
-                                deleted_images += len(msg["reference_images"])
-                            # 删除关联文件
-                            _delete_message_files(msg)
-                        else:
-                            new_messages.append(msg)
-
-                    if session_modified:
-                        session_data["messages"] = new_messages
-                        modified = True
-
-                    # 如果会话变空了，则删除整个会话
-                    if not session_data["messages"]:
-                        updated_at_str = session_data.get("updated_at")
-                        if updated_at_str:
-                            try:
-                                updated_at = datetime.fromisoformat(updated_at_str)
-                                if updated_at < cutoff_date:
-                                    sessions_to_remove.append(sid)
-                            except ValueError:
-                                pass
-                        else:
-                             sessions_to_remove.append(sid)
-
-                for sid in sessions_to_remove:
-                    del sessions[sid]
-                    deleted_sessions += 1
-                    modified = True
-
-                if modified:
-                    # 使用原子写入，与 save_sessions 保持一致
-                    tmp_file = filepath + ".tmp"
-                    with open(tmp_file, "w", encoding="utf-8") as f:
-                        json.dump(sessions, f, ensure_ascii=False, indent=2)
-                    os.replace(tmp_file, filepath)
+@app.route("/api/admin/circuits", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_circuits():
+    """获取上游熔断器状态（当前 worker 进程的统计）：各模型/端点的状态、错误率和耗时"""
+    return jsonify(circuit_breaker.status())
 
-        except Exception as e:
-            logger.error(f"Error processing {filename}: {e}")
-            continue
 
-    return {"sessions": deleted_sessions, "messages": deleted_messages, "images": deleted_images}
+@app.route("/api/admin/model-routing", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_model_routing():
+    """获取模型路由配置、各模型当前统计，以及最近的路由决策和 24 小时内的切换次数"""
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), 200)
+    except ValueError:
+        return jsonify({"error": "limit 参数无效"}), 400
+    decisions, counts = get_model_routing_log(limit=limit)
+    return jsonify(dict(model_routing.status(client_pool.endpoints()), decisions=decisions, last_24h=counts))
 
 
-def _cleanup_orphan_files():
-    """清理不在任何会话中引用的孤儿图片和缩略图"""
-    referenced_images = set()
-    referenced_thumbnails = set()
-    
-    if os.path.exists(SESSIONS_DIR):
-        for filename in os.listdir(SESSIONS_DIR):
-            if not filename.endswith(".json") or not filename.startswith("user_"):
-                continue
-                
-            filepath = os.path.join(SESSIONS_DIR, filename)
+@app.route("/api/admin/image-storage", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_image_storage():
+    """获取图片存储状态：冷存储配置、本地原图占用、冷存储中的原图数量，以及无损重新压缩节省的空间"""
+    return jsonify(dict(image_storage.status(IMAGES_DIR), recompression=dict(
+        get_recompression_stats(), format=image_recompress.IMAGE_RECOMPRESS_FORMAT or None
+    )))
+
+
+@app.route("/api/admin/analytics/generations", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_generation_analytics():
+    """
+    生成统计（只读取汇总表）：按小时/按天的请求数、失败数、点数和耗时序列，按模型 × 分辨率的 p95 耗时，
+    以及消耗点数最多的用户
+    """
+    period = request.args.get("period", "day")
+    if period not in ("hour", "day"):
+        return jsonify({"error": "period 参数无效"}), 400
+    try:
+        days = min(max(int(request.args.get("days", 2 if period == "hour" else 30)), 1),
+                   GENERATION_HOURLY_ROLLUP_DAYS if period == "hour" else 366)
+        limit = min(max(int(request.args.get("limit", 10)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "days/limit 参数无效"}), 400
+    since = datetime.now() - timedelta(days=days)
+    series, breakdown, totals = get_generation_stats(period, since)
+    return jsonify({
+        "period": period,
+        "days": days,
+        "totals": totals,
+        "series": series,
+        "breakdown": breakdown,
+        "top_users": get_top_generation_users(since, limit=limit),
+    })
+
+
+@app.route("/api/admin/cleanup/jobs/<int:job_id>", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_cleanup_job(job_id):
+    """查询清理任务进度"""
+    job = get_retention_job(job_id)
+    if not job:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify(job)
+
+
+@app.route("/api/admin/cleanup/jobs/<int:job_id>/cancel", methods=["POST"])
+@admin_required
+@csrf.exempt
+def admin_cancel_cleanup_job(job_id):
+    """取消清理任务（运行中的任务在当前批次结束后停止）"""
+    if not cancel_retention_job(job_id):
+        return jsonify({"error": "任务不存在或已结束"}), 400
+    return jsonify({"success": True, "job": get_retention_job(job_id)})
+
+
+def _expire_session_messages(session_data, cutoff_date):
+    """
+    从单个会话中移除截止日期之前的消息（不删除文件，写入成功后由调用方删除）
+    返回: (被移除的消息列表, 会话是否应整体删除)
+    """
+    removed = []
+    new_messages = []
+
+    for msg in session_data.get("messages", []):
+        msg_time_str = msg.get("timestamp")
+        should_delete = False
+
+        if msg_time_str:
             try:
-                with open(filepath, "r", encoding="utf-8") as f:
-                    sessions_data = json.load(f)
-                
-                for sid, session_data in sessions_data.items():
-                    for msg in session_data.get("messages", []):
-                        if msg.get("image"):
-                            referenced_images.add(os.path.basename(msg["image"]))
-                        if msg.get("thumbnail"):
-                            referenced_thumbnails.add(os.path.basename(msg["thumbnail"]))
-                        if msg.get("reference_images"):
-                            for ref_img in msg["reference_images"]:
-                                referenced_images.add(os.path.basename(ref_img))
-            except Exception as e:
-                logger.error(f"Error reading sessions file {filename}: {e}")
-                continue
-    
-    orphan_images = 0
-    orphan_thumbnails = 0
-    
-    if os.path.exists(IMAGES_DIR):
-        for filename in os.listdir(IMAGES_DIR):
-            if filename not in referenced_images:
-                file_path = os.path.join(IMAGES_DIR, filename)
-                if os.path.isfile(file_path):
-                    try:
-                        os.remove(file_path)
-                        orphan_images += 1
-                    except Exception as e:
-                        logger.error(f"Error deleting orphan image {filename}: {e}")
-    
-    if os.path.exists(THUMBNAILS_DIR):
-        for filename in os.listdir(THUMBNAILS_DIR):
-            if filename not in referenced_thumbnails:
-                file_path = os.path.join(THUMBNAILS_DIR, filename)
-                if os.path.isfile(file_path):
-                    try:
-                        os.remove(file_path)
-                        orphan_thumbnails += 1
-                    except Exception as e:
-                        logger.error(f"Error deleting orphan thumbnail {filename}: {e}")
+                msg_time = datetime.fromisoformat(msg_time_str)
+                if msg_time < cutoff_date:
+                    should_delete = True
+            except ValueError:
+                pass
+
+        if should_delete:
+            removed.append(msg)
+        else:
+            new_messages.append(msg)
 
-    return {"images": orphan_images, "thumbnails": orphan_thumbnails}
+    if removed:
+        session_data["messages"] = new_messages
+        _bump_session_revision(session_data, truncated=True)
+
+    # 如果会话变空了，则删除整个会话
+    remove = False
+    if not session_data["messages"]:
+        updated_at_str = session_data.get("updated_at")
+        if updated_at_str:
+            try:
+                remove = datetime.fromisoformat(updated_at_str) < cutoff_date
+            except ValueError:
+                pass
+        else:
+            remove = True
+
+    return removed, remove
+
+
+def _expire_indexed_sessions(user_id, session_ids, cutoff_date):
+    """保留任务回调：只处理会话时间索引定位到的会话，逐个会话加锁，不阻塞用户的其他会话"""
+    stats = {"sessions": 0, "messages": 0, "images": 0}
+    for sid in session_ids:
+        try:
+            session_data, expired = session_store.update_session(
+                user_id, sid, lambda data: _expire_session_messages(data, cutoff_date)
+            )
+        except SessionConflict:
+            logger.warning(f"会话 {sid} 持续写入冲突，本批跳过")
+            continue
+        if session_data is None:
+            # 会话文件已不存在，清除残留的索引记录
+            remove_session_data(user_id, sid)
+            continue
+        removed, remove = expired
+
+        for msg in removed:
+            stats["messages"] += 1
+            if msg.get("image"):
+                stats["images"] += 1
+            if msg.get("reference_images"):
+                stats["images"] += len(msg["reference_images"])
+            _delete_message_files(msg)
+
+        if remove:
+            try:
+                if session_store.delete_session(user_id, sid, expected_revision=session_data["revision"]) is not None:
+                    stats["sessions"] += 1
+                    with active_chats_lock:
+                        active_chats.pop(sid, None)
+            except SessionConflict:
+                # 删除前会话收到了新消息，保留
+                pass
+        elif removed:
+            # 历史消息已变化，内存中的聊天实例需要重建
+            with active_chats_lock:
+                active_chats.pop(sid, None)
+    return stats
 
 
 @app.route("/api/admin/card-keys", methods=["GET"])
 @admin_required
 @csrf.exempt
 def admin_get_card_keys():
-    """获取所有卡密列表"""
-    keys = get_all_card_keys()
-    return jsonify(keys)
+    """
+    键集分页获取卡密列表
+    查询参数: cursor, limit, status(used/unused/revoked), batch_id, prefix, redeemer(用户名或 ID),
+              created_from, created_to(YYYY-MM-DD)
+    """
+    try:
+        keys, total, next_cursor = get_card_keys_page(
+            request.args.get("limit", 50, type=int) or 50,
+            request.args.get("status"),
+            request.args.get("batch_id", type=int),
+            request.args.get("prefix", "").strip()[:32] or None,
+            _parse_date_arg("created_from"),
+            _parse_date_arg("created_to"),
+            request.args.get("redeemer", "").strip()[:100] or None,
+            request.args.get("cursor") or None
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"keys": keys, "total": total, "next_cursor": next_cursor, "stats": get_card_key_stats()})
 
 
 @app.route("/api/admin/card-keys", methods=["POST"])
@@ -1349,13 +1896,76 @@ def admin_generate_card_keys():
     except (ValueError, TypeError):
         return jsonify({"error": "无效的参数"}), 400
     
-    success, message, keys = generate_card_keys(credits, count)
+    label = (data.get("label") or "").strip()[:100] or None
+    success, message, keys = generate_card_keys(credits, count, label, session["user_id"])
     if success:
         return jsonify({"success": True, "message": message, "keys": keys})
     else:
         return jsonify({"error": message}), 400
 
 
+@app.route("/api/admin/card-keys/export", methods=["POST"])
+@admin_required
+@csrf.exempt
+def admin_export_card_keys():
+    """管理员批量生成卡密，以 CSV 流式下载明文（边生成边输出，不在内存中累积）"""
+    data = _get_json_data()
+    try:
+        credits = int(data.get("credits", 0))
+        count = int(data.get("count", 0))
+    except (ValueError, TypeError):
+        return jsonify({"error": "无效的参数"}), 400
+    if credits <= 0:
+        return jsonify({"error": "点数必须大于0"}), 400
+    if count <= 0 or count > CARD_KEY_EXPORT_MAX:
+        return jsonify({"error": f"数量必须在1-{CARD_KEY_EXPORT_MAX}之间"}), 400
+    label = (data.get("label") or "").strip()[:100] or None
+
+    batch_id = create_card_key_batch(credits, count, label, session["user_id"])
+    logger.info(f"管理员 {session.get('username')} 开始导出卡密批次 #{batch_id}（{count} 张 × {credits} 点）")
+
+    def generate_csv():
+        completed = False
+        try:
+            yield "code,credits,batch_id\r\n"
+            for codes in generate_card_key_batch(batch_id, credits, count):
+                yield "".join(f"{code},{credits},{batch_id}\r\n" for code in codes)
+            completed = True
+        finally:
+            if not completed:
+                # 下载中断或生成失败：明文可能没有完整送达，作废该批次已生成的卡密
+                logger.warning(f"卡密批次 #{batch_id} 导出未完成，已作废")
+                abort_card_key_batch(batch_id)
+
+    filename = f"card_keys_batch_{batch_id}.csv"
+    return Response(generate_csv(), mimetype="text/csv", headers={
+        "Content-Disposition": f"attachment; filename={filename}",
+        "Cache-Control": "no-store",
+        "X-Card-Key-Batch": str(batch_id)
+    })
+
+
+@app.route("/api/admin/card-key-batches", methods=["GET"])
+@admin_required
+@csrf.exempt
+def admin_get_card_key_batches():
+    """获取卡密批次列表（审计）"""
+    return jsonify(get_card_key_batches())
+
+
+@app.route("/api/admin/card-key-batches/<int:batch_id>/revoke", methods=["POST"])
+@admin_required
+@csrf.exempt
+def admin_revoke_card_key_batch(batch_id):
+    """作废整个批次中尚未使用的卡密"""
+    data = _get_json_data()
+    reason = (data.get("reason") or "").strip()[:200] or None
+    success, message, revoked = revoke_card_key_batch(batch_id, session["user_id"], reason)
+    if success:
+        return jsonify({"success": True, "message": message, "revoked": revoked})
+    return jsonify({"error": message}), 404
+
+
 @app.route("/api/redeem", methods=["POST"])
 @login_required
 @csrf.exempt
@@ -1382,7 +1992,96 @@ if os.getenv('FLASK_ENV') != 'production':
         return response
 
 
+# ==================== 运行时初始化 ====================
+# 导入本模块没有副作用（不建目录、不连数据库、不创建线程和网络客户端），
+# 因此可以在 gunicorn --preload 的主进程中导入，PIL/genai 等模块通过写时复制在 worker 间共享。
+# 进程级资源在 init_worker() 中创建：preload 模式由 post_fork 钩子调用，其他方式在首个请求时调用。
+
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+
+def prepare_runtime():
+    """创建数据目录、检查数据库结构版本并加载静态资源 manifest（不创建线程，可以在 fork 之前的主进程中执行）"""
+    for directory in ("data", SESSIONS_DIR, IMAGES_DIR, THUMBNAILS_DIR):
+        os.makedirs(directory, exist_ok=True)
+    init_db()
+    get_app_version()
+
+
+def register_scheduled_jobs():
+    """注册周期维护任务（整个部署每个间隔只执行一次）"""
+    scheduler.register("expired_codes", CHAT_CLEANUP_INTERVAL, cleanup_expired_codes, "删除过期的邮箱验证码")
+    scheduler.register("email_outbox_purge", email_service.OUTBOX_PURGE_INTERVAL, purge_outbox,
+                       "删除 7 天前已发送/已放弃的发件箱记录")
+    scheduler.register("session_index_backfill", 60, session_store.backfill_session_indexes,
+                       "为已有会话补建搜索索引和图片索引（完成后跳过）")
+    scheduler.register("session_write_flush", 60,
+                       lambda: session_store.flush_pending_writes(min_age=60),
+                       "写入进程异常退出时遗留的会话延迟写入记录（排队超过 60 秒）")
+    scheduler.register("generation_log_purge", 86400,
+                       lambda: purge_generation_log(GENERATION_LOG_DAYS, GENERATION_HOURLY_ROLLUP_DAYS),
+                       f"删除 {GENERATION_LOG_DAYS} 天前的生成记录和 {GENERATION_HOURLY_ROLLUP_DAYS} 天前的小时汇总")
+    if image_storage.IMAGE_COLD_STORAGE:
+        scheduler.register("image_tiering", image_storage.IMAGE_TIER_INTERVAL,
+                           lambda: image_storage.migrate(IMAGES_DIR),
+                           f"把 {image_storage.IMAGE_COLD_AFTER_DAYS:g} 天未访问（或超出本地容量上限）的原图迁移到冷存储")
+    if image_recompress.IMAGE_RECOMPRESS_FORMAT:
+        scheduler.register("image_recompress", image_recompress.IMAGE_RECOMPRESS_INTERVAL,
+                           lambda: image_recompress.run_batch(IMAGES_DIR, _replace_message_image),
+                           f"把生成原图无损重新压缩为 {image_recompress.IMAGE_RECOMPRESS_FORMAT}")
+    if model_routing.MODEL_ROUTING_ENABLED:
+        scheduler.register("model_routing_log_purge", 86400,
+                           lambda: purge_model_routing_log(model_routing.MODEL_ROUTING_HISTORY_DAYS),
+                           f"删除 {model_routing.MODEL_ROUTING_HISTORY_DAYS} 天前的模型路由记录")
+    if retention.RETENTION_DAYS > 0:
+        scheduler.register("retention_policy", retention.RETENTION_INTERVAL, retention.schedule_policy,
+                           f"按保留策略创建清理任务（保留 {retention.RETENTION_DAYS} 天）")
+
+
+def init_worker():
+    """当前进程的运行时初始化（每个进程只执行一次，fork 出的子进程会重新执行）"""
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        prepare_runtime()
+
+        threading.Thread(target=cleanup_inactive_chats, daemon=True).start()
+        logger.info(f"会话自动清理已启动（闲置超时: {CHAT_IDLE_TIMEOUT}s, 检查间隔: {CHAT_CLEANUP_INTERVAL}s）")
+
+        # 后台回填老用户的用量计数和索引（已回填的用户不会重复处理）
+        threading.Thread(target=backfill_session_data, daemon=True).start()
+
+        # 启动数据保留任务后台线程
+        retention.start_worker(_expire_indexed_sessions, {"image": IMAGES_DIR, "thumbnail": THUMBNAILS_DIR})
+
+        # 启动邮件发件箱发送线程
+        email_service.start_outbox_sender()
+
+        # 启动后台调度器（周期维护任务只由主节点进程执行）
+        register_scheduled_jobs()
+        scheduler.start()
+
+        _worker_pid = os.getpid()
+
+
+@app.before_request
+def ensure_worker_initialized():
+    """未通过 post_fork 钩子初始化的进程（flask run、未使用 gunicorn.conf.py 等）在首个请求时初始化"""
+    init_worker()
+
+
+def create_app():
+    """应用工厂：初始化当前进程后返回 WSGI 应用（gunicorn 'app:create_app()'，不使用 preload 时）"""
+    init_worker()
+    return app
+
+
 if __name__ == "__main__":
     # 从环境变量读取调试模式
     debug_mode = os.getenv("FLASK_DEBUG", "False").lower() == "true"
+    init_worker()
     app.run(debug=debug_mode, host="0.0.0.0", port=5000)
@@ -0,0 +1,276 @@
+"""
+ASGI 异步服务入口
+在事件循环中等待 Gemini 上游响应（client.aio），生成请求等待期间不占用线程，
+其余路由、登录/权限装饰器和 Session 语义与 WSGI 模式完全一致。
+
+启动方式：
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --timeout-keep-alive 300
+或多进程：
+    gunicorn -w 2 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:5000 --timeout 300 asgi:app
+"""
+
+import asyncio
+import io
+import os
+import sys
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from app import (
+    app as flask_app,
+    ASYNC_UPSTREAM_ENVIRON_KEY,
+    PENDING_GENERATION_ENVIRON_KEY,
+    _complete_generation,
+    _failover_generation,
+    _generation_error_response,
+    _log_generation,
+    _refund_generation,
+    _upstream_finished,
+    init_worker,
+)
+import client_pool  # 在 app 之后导入（app 负责加载 .env）
+import circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+# 执行 Flask 视图、文件读写和 SQLite 操作的线程池大小
+# 生成请求只在准备/保存阶段短暂占用线程，等待上游时不占用
+ASGI_EXECUTOR_WORKERS = int(os.getenv("ASGI_EXECUTOR_WORKERS", 32))
+# 单进程允许同时等待上游的生成请求数量上限
+ASGI_MAX_CONCURRENT_GENERATIONS = int(os.getenv("ASGI_MAX_CONCURRENT_GENERATIONS", 500))
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_WORKERS, thread_name_prefix="asgi-worker")
+_generation_slots = None  # asyncio.Semaphore，需在事件循环内创建
+
+_GENERATE_PATH = "/api/generate"
+
+
+def _build_environ(scope, body):
+    """将 ASGI scope 和请求体转换为 WSGI environ"""
+    script_name = scope.get("root_path", "").encode("utf8").decode("latin1")
+    path_info = scope["path"].encode("utf8").decode("latin1")
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1])
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _read_body(receive):
+    """读取完整的请求体"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def _run(func, *args):
+    """在线程池中执行阻塞操作（Flask 视图、文件读写、SQLite）"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+
+
+async def _send_wsgi_response(send, status, headers, body_iter):
+    """把 WSGI 响应发送给 ASGI 客户端，响应体分块在线程池中读取"""
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    iterator = iter(body_iter)
+    sentinel = object()
+    try:
+        while True:
+            chunk = await _run(next, iterator, sentinel)
+            if chunk is sentinel:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        if hasattr(body_iter, "close"):
+            await _run(body_iter.close)
+    await send({"type": "http.response.body", "body": b""})
+
+
+def _invoke_wsgi(wsgi_callable, environ):
+    """调用 WSGI 可调用对象（Flask 应用或 Response），返回 (status, headers, body_iter)"""
+    captured = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        captured["status"] = int(status.split(" ", 1)[0])
+        captured["headers"] = [
+            (name.lower().encode("latin1"), value.encode("latin1"))
+            for name, value in response_headers
+        ]
+
+    body_iter = wsgi_callable(environ, start_response)
+    return captured["status"], captured["headers"], body_iter
+
+
+def _exception_response(e):
+    """
+    与 Flask.wsgi_app 一致：先交给错误处理器（HTTP 异常、注册的处理器），
+    未处理的异常由 handle_exception 记录日志并返回 500
+    """
+    try:
+        return flask_app.finalize_request(flask_app.handle_user_exception(e))
+    except Exception as unhandled:
+        return flask_app.handle_exception(unhandled)
+
+
+def _prepare_generate(environ):
+    """
+    生成请求准备阶段（线程池中执行）：走完整的 Flask 请求流程
+    （before_request、限流、登录装饰器），视图把待执行任务放入 environ
+    返回 (job, None) 或 (None, (status, headers, body_iter))
+    """
+    environ[ASYNC_UPSTREAM_ENVIRON_KEY] = True
+    with flask_app.request_context(environ):
+        try:
+            rv = flask_app.preprocess_request()
+            if rv is None:
+                rv = flask_app.dispatch_request()
+        except Exception as e:
+            environ.pop(PENDING_GENERATION_ENVIRON_KEY, None)
+            return None, _invoke_wsgi(_exception_response(e), environ)
+
+        job = environ.pop(PENDING_GENERATION_ENVIRON_KEY, None)
+        if job is not None:
+            return job, None
+        try:
+            response = flask_app.finalize_request(rv)
+        except Exception as e:
+            response = flask_app.handle_exception(e)
+        return None, _invoke_wsgi(response, environ)
+
+
+def _finish_generate(environ, job, upstream_response, error):
+    """生成请求收尾阶段（线程池中执行）：保存图片与会话，构建响应"""
+    with flask_app.request_context(environ):
+        try:
+            if error is not None:
+                rv = _generation_error_response(job, error)
+            else:
+                rv = _complete_generation(job, upstream_response)
+            response = flask_app.finalize_request(rv)
+        except Exception as e:
+            response = _exception_response(e)
+        return _invoke_wsgi(response, environ)
+
+
+async def _handle_generate(scope, body, send):
+    """/api/generate：准备和保存在线程池中执行，上游调用在事件循环中等待"""
+    environ = _build_environ(scope, body)
+    job, result = await _run(_prepare_generate, environ)
+
+    if job is not None:
+        upstream_response = None
+        error = None
+        async with _generation_slots:
+            upstream_started = time.monotonic()
+            while True:
+                try:
+                    with circuit_breaker.guard(job["model"], client_pool.endpoint(job["key_id"])), \
+                            client_pool.track(job["key_id"]):
+                        upstream_response = await job["chat"].send_message(job["contents"])
+                    break
+                except asyncio.CancelledError:
+                    # 客户端断开或服务关闭：退还点数后继续向上抛出
+                    _upstream_finished(job, upstream_started)
+                    await _run(_refund_cancelled_generation, job)
+                    raise
+                except Exception as e:
+                    # 配额/权限错误时切换到其他密钥重试（迁移只复用内存中的历史，不阻塞事件循环）
+                    if not _failover_generation(job, e):
+                        error = e
+                        break
+            _upstream_finished(job, upstream_started)
+        # 重新构建 environ（请求体已被读取）
+        environ = _build_environ(scope, body)
+        result = await _run(_finish_generate, environ, job, upstream_response, error)
+
+    await _send_wsgi_response(send, *result)
+
+
+def _refund_cancelled_generation(job):
+    """请求被取消时退还点数并写入生成记录"""
+    try:
+        _refund_generation(job)
+    except Exception as e:
+        logger.error(f"取消生成时退还点数失败: {e}")
+    _log_generation(job, "cancelled", "CANCELLED")
+
+
+async def _lifespan(receive, send):
+    """处理 ASGI lifespan 事件"""
+    global _generation_slots
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # 进程级初始化（数据库迁移检查、后台线程），不阻塞事件循环
+            await asyncio.get_running_loop().run_in_executor(_executor, init_worker)
+            _generation_slots = asyncio.Semaphore(ASGI_MAX_CONCURRENT_GENERATIONS)
+            logger.info(f"ASGI 异步模式已启动（线程池: {ASGI_EXECUTOR_WORKERS}, 最大并发生成: {ASGI_MAX_CONCURRENT_GENERATIONS}）")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            _executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI 应用入口"""
+    global _generation_slots
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if _generation_slots is None:
+        _generation_slots = asyncio.Semaphore(ASGI_MAX_CONCURRENT_GENERATIONS)
+
+    body = await _read_body(receive)
+    if scope["method"] == "POST" and scope["path"] == _GENERATE_PATH:
+        await _handle_generate(scope, body, send)
+        return
+
+    environ = _build_environ(scope, body)
+    result = await _run(_invoke_wsgi, flask_app, environ)
+    await _send_wsgi_response(send, *result)
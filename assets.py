@@ -0,0 +1,213 @@
+"""
+静态资源构建模块
+按内容哈希为 CSS/JS/字体生成指纹文件名，并预先生成 .br/.gz 压缩版本，
+模板通过 manifest 引用指纹文件，配合 immutable 缓存实现重复访问零传输。
+
+可在部署时手动构建：
+    python assets.py
+应用启动时也会自动检查并构建（多个 worker 通过文件锁串行，结果相同）。
+"""
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+from filelock import FileLock
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，缺失时只生成 .gz
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIRNAME = "dist"
+DIST_DIR = os.path.join(STATIC_DIR, DIST_DIRNAME)
+MANIFEST_FILE = os.path.join(DIST_DIR, "manifest.json")
+
+# 需要指纹化的静态资源目录（相对 static/）
+ASSET_SOURCE_DIRS = ["css", "js", "fonts", "lib"]
+# 需要预压缩的文件类型（字体/图片本身已压缩，不再处理）
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".json", ".txt"}
+COMPRESS_MIN_SIZE = 500  # 与 Flask-Compress 的 COMPRESS_MIN_SIZE 保持一致
+HASH_LENGTH = 12
+
+_CSS_URL_PATTERN = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+_manifest = None
+
+
+def _content_hash(data):
+    """计算内容哈希（截取前 HASH_LENGTH 位）"""
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def _fingerprinted_name(rel_path, digest):
+    """style.css -> style.<hash>.css"""
+    root, ext = os.path.splitext(rel_path)
+    return f"{root}.{digest}{ext}"
+
+
+def _iter_source_files():
+    """遍历所有需要构建的源文件，返回相对 static/ 的路径（使用 / 分隔）"""
+    for dirname in ASSET_SOURCE_DIRS:
+        base = os.path.join(STATIC_DIR, dirname)
+        if not os.path.isdir(base):
+            continue
+        for root, _, files in os.walk(base):
+            for filename in sorted(files):
+                full_path = os.path.join(root, filename)
+                yield os.path.relpath(full_path, STATIC_DIR).replace(os.sep, "/")
+
+
+def _rewrite_css_urls(css_rel_path, content, manifest):
+    """把 CSS 中引用的相对资源路径替换为指纹文件名"""
+    css_dir = os.path.dirname(css_rel_path)
+
+    def replace(match):
+        quote, url = match.group(1), match.group(2).strip()
+        if url.startswith(("data:", "http:", "https:", "//", "#")):
+            return match.group(0)
+        path, sep, suffix = url.partition("?")
+        if not sep:
+            path, sep, suffix = url.partition("#")
+        if path.startswith("/static/"):
+            target = path[len("/static/"):]
+        elif path.startswith("/"):
+            return match.group(0)
+        else:
+            target = os.path.normpath(os.path.join(css_dir, path)).replace(os.sep, "/")
+        if target not in manifest:
+            return match.group(0)
+        new_url = os.path.relpath(manifest[target], css_dir).replace(os.sep, "/")
+        return f"url({quote}{new_url}{sep}{suffix}{quote})"
+
+    return _CSS_URL_PATTERN.sub(replace, content)
+
+
+def _write_atomic(path, data):
+    """原子写入文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _write_output(dist_rel_path, data):
+    """写入指纹文件及其预压缩版本（已存在则跳过，内容由哈希保证一致）"""
+    out_path = os.path.join(DIST_DIR, dist_rel_path)
+    if not os.path.exists(out_path):
+        _write_atomic(out_path, data)
+
+    ext = os.path.splitext(dist_rel_path)[1].lower()
+    if ext not in COMPRESSIBLE_EXTENSIONS or len(data) < COMPRESS_MIN_SIZE:
+        return
+
+    gz_path = out_path + ".gz"
+    if not os.path.exists(gz_path):
+        # mtime=0 保证同样内容产出同样的压缩文件
+        _write_atomic(gz_path, gzip.compress(data, compresslevel=9, mtime=0))
+
+    if brotli is not None:
+        br_path = out_path + ".br"
+        if not os.path.exists(br_path):
+            _write_atomic(br_path, brotli.compress(data, quality=11))
+
+
+def build_assets():
+    """
+    构建所有静态资源：生成指纹文件、预压缩版本和 manifest
+    返回: manifest dict {"files": {源路径: 指纹路径}, "version": 整体版本号}
+    """
+    files = {}
+    css_files = []
+
+    # 先处理非 CSS 文件，CSS 中的 url() 需要引用它们的指纹文件名
+    for rel_path in _iter_source_files():
+        if rel_path.endswith(".css"):
+            css_files.append(rel_path)
+            continue
+        with open(os.path.join(STATIC_DIR, rel_path), "rb") as f:
+            data = f.read()
+        dist_rel_path = _fingerprinted_name(rel_path, _content_hash(data))
+        _write_output(dist_rel_path, data)
+        files[rel_path] = dist_rel_path
+
+    for rel_path in css_files:
+        with open(os.path.join(STATIC_DIR, rel_path), "r", encoding="utf-8") as f:
+            content = f.read()
+        data = _rewrite_css_urls(rel_path, content, files).encode("utf-8")
+        dist_rel_path = _fingerprinted_name(rel_path, _content_hash(data))
+        _write_output(dist_rel_path, data)
+        files[rel_path] = dist_rel_path
+
+    manifest = {
+        "version": _content_hash(json.dumps(files, sort_keys=True).encode("utf-8")),
+        "files": files,
+    }
+    manifest_data = json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+    current = None
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE, "rb") as f:
+            current = f.read()
+    if current != manifest_data:
+        _write_atomic(MANIFEST_FILE, manifest_data)
+    return manifest
+
+
+def load_manifest(rebuild=True):
+    """
+    加载静态资源 manifest（进程内缓存）
+    rebuild=True 时先在文件锁保护下构建一次，保证多个 worker 得到同一份结果
+    """
+    global _manifest
+    if _manifest is not None:
+        return _manifest
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    if rebuild:
+        with FileLock(os.path.join(DIST_DIR, ".build.lock"), timeout=60):
+            _manifest = build_assets()
+    else:
+        with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+            _manifest = json.load(f)
+    logger.info(f"静态资源 manifest 已加载（版本: {_manifest['version']}, 文件数: {len(_manifest['files'])}）")
+    return _manifest
+
+
+def asset_path(rel_path):
+    """返回资源在 dist 目录中的指纹路径，不在 manifest 中时返回 None"""
+    manifest = load_manifest()
+    return manifest["files"].get(rel_path.lstrip("/"))
+
+
+def clean_dist():
+    """删除 dist 目录中不属于当前 manifest 的旧指纹文件"""
+    manifest = load_manifest()
+    keep = set()
+    for dist_rel_path in manifest["files"].values():
+        keep.update({dist_rel_path, dist_rel_path + ".gz", dist_rel_path + ".br"})
+
+    removed = 0
+    for root, _, filenames in os.walk(DIST_DIR):
+        for filename in filenames:
+            full_path = os.path.join(root, filename)
+            rel_path = os.path.relpath(full_path, DIST_DIR).replace(os.sep, "/")
+            if rel_path in keep or rel_path in ("manifest.json", ".build.lock"):
+                continue
+            os.remove(full_path)
+            removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    result = load_manifest()
+    print(f"构建完成：{len(result['files'])} 个文件，版本 {result['version']}")
+    if "--clean" in sys.argv:
+        print(f"已删除 {clean_dist()} 个旧文件")
@@ -0,0 +1,52 @@
+"""
+基准测试公共工具：合成会话消息（字段与线上保存的会话一致）和计时
+"""
+
+import time
+import base64
+
+SUBJECTS = ["橘猫", "柴犬", "宇航员", "赛博朋克城市", "水彩山水", "咖啡馆", "机器人", "樱花树", "古风少女", "雪山"]
+STYLES = ["写实摄影", "油画风格", "像素艺术", "吉卜力风格", "低多边形", "电影光效", "黑白素描", "霓虹灯"]
+WORDS = ["sunset", "portrait", "landscape", "cinematic", "studio lighting", "ultra detailed", "bokeh", "minimalist"]
+
+
+def random_prompt(rng):
+    return (f"画一张{rng.choice(SUBJECTS)}，{rng.choice(STYLES)}，{rng.choice(WORDS)}，"
+            f"{rng.choice(WORDS)}，编号 {rng.randrange(10 ** 6)}")
+
+
+def build_messages(rng, turns, now, full=False):
+    """
+    生成 turns 轮对话（每轮一条提示词、一条带图片的模型回复）
+    full=True 时模型回复还带有图片信息、模型和 thought_signature（与完整保存的会话文件一致）
+    """
+    messages = []
+    for _ in range(turns):
+        messages.append({"role": "user", "content": random_prompt(rng), "timestamp": now})
+        reply = {
+            "role": "assistant",
+            "content": f"这是为你生成的{rng.choice(SUBJECTS)}图片" if rng.random() < 0.5 else "",
+            "image": f"/static/images/{rng.randrange(10 ** 12)}.png",
+            "thumbnail": f"/static/thumbnails/{rng.randrange(10 ** 12)}.jpg",
+            "timestamp": now
+        }
+        if full:
+            reply.update({
+                "image_info": {"width": 2048, "height": 2048, "size": rng.randrange(3 * 10 ** 6, 8 * 10 ** 6)},
+                "model": "gemini-3-pro-image-preview",
+                "thought_signature": base64.b64encode(rng.randbytes(rng.randrange(1024, 4096))).decode("utf-8"),
+                "text_thought_signature": base64.b64encode(rng.randbytes(rng.randrange(256, 1024))).decode("utf-8"),
+            })
+        messages.append(reply)
+    return messages
+
+
+def timed(func, repeat):
+    """返回 (中位数 ms, p95 ms)"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.95)]
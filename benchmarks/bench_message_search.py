@@ -0,0 +1,108 @@
+"""
+消息搜索基准测试：在临时数据库中生成大量消息，测量搜索接口的数据库查询耗时
+
+- 数据：--users 个用户 × --sessions 个会话 × --turns 轮对话（每轮一条提示词、一条模型回复），
+  通过 sync_session_data 写入，与线上保存会话的路径一致
+- 查询：随机选取用户，分别测量全文索引（搜索词 >= 3 个字符）和子串扫描（短搜索词）两种路径，
+  以及在所有用户都可能命中的常见词上的耗时
+- 同时测量追加一轮对话时增量同步搜索索引的耗时
+
+用法：
+    python benchmarks/bench_message_search.py
+    python benchmarks/bench_message_search.py --users 500 --sessions 20 --turns 15
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ADMIN_PASSWORD", "benchmark-admin-1")
+
+import database  # noqa: E402
+from bench_common import SUBJECTS, WORDS, build_messages, timed  # noqa: E402
+
+
+def summarize(messages):
+    """与 session_store.summarize_session 相同的搜索条目计算（不读取图片文件大小）"""
+    entries = []
+    for position, msg in enumerate(messages):
+        if not msg["content"]:
+            continue
+        result = msg if msg.get("image") else (messages[position + 1] if msg["role"] == "user" else {})
+        entries.append({
+            "position": position, "role": msg["role"], "content": msg["content"], "timestamp": msg["timestamp"],
+            "image": result.get("image"), "thumbnail": result.get("thumbnail")
+        })
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息搜索查询耗时基准")
+    parser.add_argument("--users", type=int, default=1000, help="用户数")
+    parser.add_argument("--sessions", type=int, default=15, help="每个用户的会话数")
+    parser.add_argument("--turns", type=int, default=10, help="每个会话的对话轮数")
+    parser.add_argument("--repeat", type=int, default=200, help="每种查询的次数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_search_")
+    try:
+        run_benchmark(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmark(args, workdir):
+    database.DATABASE_FILE = os.path.join(workdir, "users.db")
+    database.init_db()
+    rng = random.Random(42)
+    now = "2025-01-01T00:00:00"
+    entry = {"title": "bench", "created_at": now, "updated_at": now, "oldest_at": now,
+             "message_count": 0, "image_count": 0, "image_bytes": 0}
+
+    start = time.perf_counter()
+    for user_id in range(1, args.users + 1):
+        for _ in range(args.sessions):
+            session_id = f"{rng.getrandbits(128):032x}"
+            database.sync_session_data(user_id, session_id, entry, [], summarize(build_messages(rng, args.turns, now)))
+    total = database.count_indexed_messages()
+    print(f"已写入 {total} 条可搜索消息（{args.users} 用户），耗时 {time.perf_counter() - start:.1f}s")
+    print(f"数据库大小: {os.path.getsize(database.DATABASE_FILE) / 1024 / 1024:.1f} MB\n")
+
+    queries = [
+        ("全文索引 - 常见词", lambda: rng.choice(["宇航员", "赛博朋克", "cinematic", "吉卜力风格"])),
+        ("全文索引 - 多个词", lambda: f"{rng.choice(SUBJECTS[2:5])} {rng.choice(WORDS)}"),
+        ("全文索引 - 几乎全部命中", lambda: "画一张"),
+        ("子串扫描 - 短词", lambda: rng.choice(["橘猫", "柴犬", "雪山", "油画"])),
+    ]
+    print(f"{'查询':<22}{'中位数(ms)':>12}{'p95(ms)':>10}{'平均结果数':>12}")
+    for name, make_query in queries:
+        counts = []
+
+        def search_once():
+            counts.append(len(database.search_messages(rng.randrange(1, args.users + 1), make_query(), limit=20)))
+
+        median, p95 = timed(search_once, args.repeat)
+        print(f"{name:<22}{median:>12.2f}{p95:>10.2f}{sum(counts) / len(counts):>12.1f}")
+
+    # 追加一轮对话：增量同步只插入新消息
+    user_id = rng.randrange(1, args.users + 1)
+    session_id = f"{rng.getrandbits(128):032x}"
+    messages = build_messages(rng, args.turns, now)
+    database.sync_session_data(user_id, session_id, entry, [], summarize(messages))
+
+    def append_turn():
+        messages.extend(build_messages(rng, 1, now))
+        database.sync_session_data(user_id, session_id, entry, [], summarize(messages))
+
+    median, p95 = timed(append_turn, 50)
+    print(f"\n追加一轮对话同步索引: 中位数 {median:.2f} ms, p95 {p95:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+密码哈希基准测试：测量不同哈希方法下每个 CPU 核心每秒可以处理的登录数
+
+登录的主要开销是一次 check_password_hash，所以这里直接测量校验速度：
+- 单线程：当前进程内连续校验，得到单核吞吐
+- 进程池：通过 password_hashing 的进程池并发校验，得到整体吞吐和每核吞吐
+
+用法：
+    python benchmarks/bench_password_hashing.py
+    python benchmarks/bench_password_hashing.py --methods scrypt:32768:8:1 pbkdf2:sha256:600000 --workers 4 --seconds 5
+"""
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from werkzeug.security import generate_password_hash, check_password_hash  # noqa: E402
+
+DEFAULT_METHODS = [
+    "scrypt:32768:8:1",
+    "scrypt:16384:8:1",
+    "pbkdf2:sha256:1000000",
+    "pbkdf2:sha256:600000",
+    "pbkdf2:sha256:10000",
+]
+PASSWORD = "benchmark-password-123"
+
+
+def bench_single(stored_hash, seconds):
+    """单线程连续校验，返回每秒校验次数"""
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        check_password_hash(stored_hash, PASSWORD)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def bench_pool(stored_hash, seconds, workers):
+    """通过进程池并发校验（模拟多个请求线程同时登录），返回每秒校验次数"""
+    import password_hashing
+
+    password_hashing.HASH_WORKERS = workers
+    pool = password_hashing._get_pool()
+    # 预热：启动所有工作进程
+    list(pool.map(password_hashing._check_hash, [stored_hash] * workers, [PASSWORD] * workers))
+
+    deadline = time.perf_counter() + seconds
+    counts = [0] * (workers * 2)
+
+    def client(index):
+        while time.perf_counter() < deadline:
+            password_hashing._run(password_hashing._check_hash, stored_hash, PASSWORD)
+            counts[index] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(counts)) as executor:
+        list(executor.map(client, range(len(counts))))
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="密码哈希方法的登录吞吐基准")
+    parser.add_argument("--methods", nargs="+", default=DEFAULT_METHODS, help="werkzeug 哈希方法")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="进程池大小")
+    parser.add_argument("--seconds", type=float, default=3.0, help="每项测试的时长（秒）")
+    args = parser.parse_args()
+
+    print(f"CPU 核数: {os.cpu_count()}，进程池大小: {args.workers}，每项 {args.seconds}s\n")
+    header = f"{'方法':<26}{'单次耗时(ms)':>14}{'单核 登录/秒':>14}{'进程池 登录/秒':>16}{'每核 登录/秒':>14}"
+    print(header)
+    print("-" * len(header))
+
+    for method in args.methods:
+        stored_hash = generate_password_hash(PASSWORD, method=method)
+        single = bench_single(stored_hash, args.seconds)
+        pooled = bench_pool(stored_hash, args.seconds, args.workers)
+        per_core = pooled / args.workers
+        print(f"{method:<26}{1000 / single:>14.1f}{single:>14.1f}{pooled:>16.1f}{per_core:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
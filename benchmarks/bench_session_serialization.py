@@ -0,0 +1,107 @@
+"""
+会话序列化基准测试：对不同长度的会话，比较各编码格式的写入（编码）耗时、读取（解析）耗时和文件大小
+
+- 数据：--turns 轮对话（每轮一条提示词、一条带图片信息和 thought_signature 的模型回复），
+  字段与线上保存的会话一致
+- 基准为旧版写法 json.dump(..., ensure_ascii=False, indent=2) / json.load
+- 对比 serializer 支持的组合：紧凑 JSON（标准库 / orjson）、msgpack，以及各自的 zstd 压缩版本；
+  未安装的可选依赖（orjson、msgpack、zstandard）对应的组合会跳过
+
+用法：
+    python benchmarks/bench_session_serialization.py
+    python benchmarks/bench_session_serialization.py --turns 10 50 200 --repeat 50
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializer  # noqa: E402
+from bench_common import build_messages, timed  # noqa: E402
+
+
+def build_session(rng, turns):
+    now = "2025-01-01T00:00:00.000000"
+    return {
+        "title": "基准测试会话",
+        "created_at": now,
+        "updated_at": now,
+        "messages": build_messages(rng, turns, now, full=True),
+        "settings": {"aspect_ratio": "1:1", "image_size": "2K", "model": "gemini-3-pro-image-preview"},
+        "revision": turns,
+        "base_revision": 0
+    }
+
+
+def legacy_dumps(data):
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def legacy_loads(raw):
+    return json.loads(raw.decode("utf-8"))
+
+
+def serializer_codec(fmt, compression, use_orjson):
+    """返回 (编码函数, 解码函数)；use_orjson=False 时强制使用标准库 json"""
+    def with_json_backend(func):
+        def call(arg):
+            saved = serializer.orjson
+            if not use_orjson:
+                serializer.orjson = None
+            try:
+                return func(arg)
+            finally:
+                serializer.orjson = saved
+        return call
+    return (with_json_backend(lambda data: serializer.dumps(data, fmt, compression)),
+            with_json_backend(serializer.loads))
+
+
+def codecs():
+    """[(名称, 编码函数, 解码函数)]，跳过缺少依赖的组合"""
+    result = [("旧版 JSON（indent=2）", legacy_dumps, legacy_loads)]
+    compressions = ["none"] + (["zstd"] if serializer.zstandard is not None else [])
+    for compression in compressions:
+        suffix = " + zstd" if compression == "zstd" else ""
+        result.append((f"紧凑 JSON（标准库）{suffix}", *serializer_codec("json", compression, False)))
+        if serializer.orjson is not None:
+            result.append((f"紧凑 JSON（orjson）{suffix}", *serializer_codec("json", compression, True)))
+        if serializer.msgpack is not None:
+            result.append((f"msgpack{suffix}", *serializer_codec("msgpack", compression, True)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会话序列化耗时与体积基准")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 500], help="会话的对话轮数（可指定多个）")
+    parser.add_argument("--repeat", type=int, default=30, help="每种格式的重复次数")
+    args = parser.parse_args()
+
+    missing = [name for name, module in (("orjson", serializer.orjson), ("msgpack", serializer.msgpack),
+                                         ("zstandard", serializer.zstandard)) if module is None]
+    if missing:
+        print(f"未安装 {', '.join(missing)}，跳过相关格式\n")
+
+    rng = random.Random(42)
+    for turns in args.turns:
+        data = build_session(rng, turns)
+        baseline = None
+        print(f"会话长度: {turns} 轮（{turns * 2} 条消息）")
+        print(f"{'格式':<26}{'写入(ms)':>10}{'读取(ms)':>10}{'大小(KB)':>11}{'相对大小':>10}")
+        for name, dumps, loads in codecs():
+            raw = dumps(data)
+            assert loads(raw) == data, name
+            dump_ms = timed(lambda: dumps(data), args.repeat)[0]
+            load_ms = timed(lambda: loads(raw), args.repeat)[0]
+            if baseline is None:
+                baseline = len(raw)
+            print(f"{name:<26}{dump_ms:>10.2f}{load_ms:>10.2f}{len(raw) / 1024:>11.1f}{len(raw) / baseline:>10.0%}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
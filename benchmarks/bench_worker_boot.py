@@ -0,0 +1,128 @@
+"""
+Worker 启动基准测试：对比 gunicorn preload 与非 preload 模式下的启动耗时和每个 worker 的内存
+
+- 启动耗时：从启动 gunicorn 到所有 worker 加载完应用（post_worker_init）的时间
+- 内存：所有 worker 就绪后读取 /proc/<pid>/smaps_rollup
+    RSS  常驻内存（包含与主进程共享的页，两种模式差别不大）
+    PSS  按共享进程数分摊后的内存
+    USS  worker 独占的内存（Private_Clean + Private_Dirty），即每多一个 worker 实际增加的内存
+
+仅支持 Linux。在临时目录中运行（数据库、图片目录都在临时目录下创建），不会访问 Gemini API。
+
+用法：
+    python benchmarks/bench_worker_boot.py
+    python benchmarks/bench_worker_boot.py --workers 4 --rounds 3
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 在仓库的 gunicorn.conf.py 基础上，记录每个 worker 加载完应用的时间
+CONFIG_TEMPLATE = """
+exec(open({config!r}).read())
+bind = {bind!r}
+workers = {workers}
+preload_app = {preload}
+import os as _os, time as _time
+def post_worker_init(worker):
+    with open(_os.path.join({ready_dir!r}, str(worker.pid)), "w") as f:
+        f.write(repr(_time.time()))
+"""
+
+
+def read_memory(pid):
+    """返回 (rss, pss, uss)，单位 KB"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":"):
+                values[parts[0][:-1]] = int(parts[1])
+    uss = values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    return values.get("Rss", 0), values.get("Pss", 0), uss
+
+
+def run_once(preload, workers, port, timeout=120):
+    """启动一次 gunicorn，返回 (启动耗时秒数, 每个 worker 的内存列表)"""
+    workdir = tempfile.mkdtemp(prefix="bench_boot_")
+    ready_dir = os.path.join(workdir, "ready")
+    os.makedirs(ready_dir)
+    config_path = os.path.join(workdir, "gunicorn_bench.conf.py")
+    with open(config_path, "w") as f:
+        f.write(CONFIG_TEMPLATE.format(
+            config=os.path.join(ROOT, "gunicorn.conf.py"), bind=f"127.0.0.1:{port}",
+            workers=workers, preload=preload, ready_dir=ready_dir
+        ))
+
+    env = dict(os.environ)
+    env.setdefault("SECRET_KEY", "benchmark")
+    env.setdefault("GEMINI_API_KEY", "benchmark")
+    env.setdefault("ADMIN_PASSWORD", "benchmark-admin-1")
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", config_path, "--chdir", workdir],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while len(os.listdir(ready_dir)) < workers:
+            if proc.poll() is not None:
+                raise RuntimeError("gunicorn 启动失败")
+            if time.time() - start > timeout:
+                raise RuntimeError("等待 worker 就绪超时")
+            time.sleep(0.01)
+        ready_times = []
+        for name in os.listdir(ready_dir):
+            with open(os.path.join(ready_dir, name)) as f:
+                ready_times.append(float(f.read()))
+        boot_seconds = max(ready_times) - start
+        # 等待后台线程启动完成，内存趋于稳定
+        time.sleep(1)
+        memory = [read_memory(int(pid)) for pid in os.listdir(ready_dir)]
+        return boot_seconds, memory
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gunicorn preload 启动耗时和 worker 内存对比")
+    parser.add_argument("--workers", type=int, default=3, help="worker 数量")
+    parser.add_argument("--rounds", type=int, default=3, help="每种模式重复次数（取中位数）")
+    parser.add_argument("--port", type=int, default=18765, help="监听端口")
+    args = parser.parse_args()
+
+    print(f"workers={args.workers}, rounds={args.rounds}")
+    print(f"{'mode':<12}{'boot (s)':>10}{'RSS/worker':>14}{'PSS/worker':>14}{'USS/worker':>14}")
+    for preload in (False, True):
+        boots, rss, pss, uss = [], [], [], []
+        for _ in range(args.rounds):
+            boot_seconds, memory = run_once(preload, args.workers, args.port)
+            boots.append(boot_seconds)
+            rss.append(sum(m[0] for m in memory) / len(memory))
+            pss.append(sum(m[1] for m in memory) / len(memory))
+            uss.append(sum(m[2] for m in memory) / len(memory))
+
+        def median(values):
+            return sorted(values)[len(values) // 2]
+
+        mode = "preload" if preload else "no-preload"
+        print(f"{mode:<12}{median(boots):>10.2f}{median(rss) / 1024:>11.1f} MB"
+              f"{median(pss) / 1024:>11.1f} MB{median(uss) / 1024:>11.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+聊天预热模块
+聊天实例闲置超过 CHAT_IDLE_TIMEOUT 被清理，或请求落到其他 worker 时，会话中的第一次生成要先从会话文件
+重建聊天历史（读取全部历史图片）。用户打开会话时在后台提前重建，输入提示词期间完成，第一次生成直接使用：
+
+- 打开会话（GET /api/sessions/<id>）或调用预热接口时，当前进程没有该会话的聊天实例才预热
+- 预热结果按会话修订号缓存，生成时修订号一致才使用，否则照常重建；预热进行中时生成请求等待其完成
+- 线程池限制同时预热的数量；缓存的预热（进行中和已完成）数量有上限，超出时先丢弃最早提交的已完成结果，
+  都在进行中时不再预热（已完成的结果包含会话中全部历史图片的内容，占用内存较大）
+- 同一用户打开另一个会话或离开页面时丢弃之前会话的预热（进行中的取消）；未被使用的结果超过 CHAT_PREWARM_TTL 后丢弃
+- 缓存的是重建好的历史（不是聊天实例），同步/异步两种服务模式都可以直接使用
+
+配置（环境变量）：
+    CHAT_PREWARM_ENABLED  是否开启预热，默认 true
+    CHAT_PREWARM_WORKERS  同时预热的会话数，默认 2
+    CHAT_PREWARM_MAX_PENDING  缓存的预热数上限（排队、进行中和已完成未使用），默认 32
+    CHAT_PREWARM_TTL  预热结果的保留时间（秒），默认 300
+"""
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, CancelledError
+
+logger = logging.getLogger(__name__)
+
+CHAT_PREWARM_ENABLED = os.getenv("CHAT_PREWARM_ENABLED", "true").lower() == "true"
+CHAT_PREWARM_WORKERS = int(os.getenv("CHAT_PREWARM_WORKERS", 2))
+CHAT_PREWARM_MAX_PENDING = int(os.getenv("CHAT_PREWARM_MAX_PENDING", 32))
+CHAT_PREWARM_TTL = int(os.getenv("CHAT_PREWARM_TTL", 300))
+WAIT_SECONDS = 30  # 生成请求等待进行中的预热的最长时间
+
+_lock = threading.Lock()
+_entries = {}  # (user_id, session_id) -> {"revision", "future", "cancelled", "created"}
+_user_sessions = {}  # user_id -> 最近预热的 session_id
+_executor = None
+_executor_pid = None
+
+
+def _get_executor():
+    # 线程池不能跨 fork 使用，按进程创建
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=CHAT_PREWARM_WORKERS, thread_name_prefix="chat-prewarm")
+        _executor_pid = os.getpid()
+        _entries.clear()
+        _user_sessions.clear()
+    return _executor
+
+
+def _expire_locked(now):
+    for key in [key for key, entry in _entries.items()
+                if entry["future"].done() and now - entry["created"] > CHAT_PREWARM_TTL]:
+        del _entries[key]
+
+
+def _make_room_locked():
+    """缓存数达到上限时丢弃最早提交的已完成结果，全部在进行中时返回 False"""
+    excess = len(_entries) - CHAT_PREWARM_MAX_PENDING + 1
+    if excess <= 0:
+        return True
+    finished = sorted((entry["created"], key) for key, entry in _entries.items() if entry["future"].done())
+    for _, key in finished[:excess]:
+        del _entries[key]
+    return len(_entries) < CHAT_PREWARM_MAX_PENDING
+
+
+def _cancel_locked(key):
+    entry = _entries.pop(key, None)
+    if entry is None:
+        return False
+    entry["cancelled"] = True
+    entry["future"].cancel()
+    return True
+
+
+def schedule(user_id, session_id, revision, build):
+    """
+    提交预热：build() 返回重建好的聊天历史
+    同一修订号已在预热或已有结果时不重复提交；取消同一用户其他会话未完成的预热
+    返回 True 表示已提交
+    """
+    if not CHAT_PREWARM_ENABLED:
+        return False
+    key = (user_id, session_id)
+    with _lock:
+        executor = _get_executor()
+        now = time.time()
+        _expire_locked(now)
+        previous = _user_sessions.get(user_id)
+        if previous is not None and previous != session_id:
+            # 用户已离开之前的会话：不论是否完成都丢弃，不让已完成的历史留在内存中直到过期
+            _cancel_locked((user_id, previous))
+        _user_sessions[user_id] = session_id
+
+        entry = _entries.get(key)
+        if entry is not None and entry["revision"] == revision:
+            return False
+        if entry is not None:
+            _cancel_locked(key)
+        if not _make_room_locked():
+            return False
+
+        entry = {"revision": revision, "cancelled": False, "created": now}
+
+        def run():
+            if entry["cancelled"]:
+                return None
+            started = time.perf_counter()
+            history = build()
+            logger.info(f"已预热会话 {session_id} 的聊天历史（{len(history)} 条，{time.perf_counter() - started:.2f}s）")
+            return history
+
+        entry["future"] = executor.submit(run)
+        _entries[key] = entry
+    return True
+
+
+def cancel(user_id, session_id):
+    """取消会话的预热并丢弃结果（用户离开会话时调用）"""
+    with _lock:
+        if _user_sessions.get(user_id) == session_id:
+            del _user_sessions[user_id]
+        return _cancel_locked((user_id, session_id))
+
+
+def take(user_id, session_id, revision):
+    """
+    取出修订号一致的预热结果（进行中时等待完成），没有可用结果时返回 None
+    结果只能使用一次
+    """
+    if not CHAT_PREWARM_ENABLED or _executor_pid != os.getpid():
+        return None
+    with _lock:
+        _expire_locked(time.time())
+        entry = _entries.pop((user_id, session_id), None)
+    if entry is None or entry["revision"] != revision or entry["cancelled"]:
+        return None
+    try:
+        return entry["future"].result(timeout=WAIT_SECONDS)
+    except (FutureTimeoutError, CancelledError):
+        return None
+    except Exception as e:
+        logger.warning(f"预热会话 {session_id} 失败: {e}")
+        return None
+
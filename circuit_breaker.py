@@ -0,0 +1,337 @@
+"""
+上游熔断模块
+按（模型, API 端点）统计 Gemini 调用的错误率和耗时，上游故障时快速失败，
+避免每个生成请求都等满 300 秒超时、占满 worker 拖垮整个站点。
+
+- 关闭（closed）：正常放行；统计窗口内请求数达到下限且失败比例（服务端错误、超时、连接错误、
+  超过慢调用阈值的请求）达到阈值时熔断。仍在进行中但已超过慢调用阈值的请求也计为失败，
+  上游卡死时不必等这些请求超时才熔断
+- 打开（open）：新请求直接失败（503 + Retry-After），不扣点数、不调用上游
+- 半开（half_open）：打开时长到期后放行少量探测请求，探测全部成功则关闭，
+  任一失败则重新打开，打开时长加倍（不超过上限）
+- 4xx 客户端错误说明上游可以正常响应，计为成功；429 配额错误由密钥池处理，不计入统计
+- 状态保存在进程内存中，每个 worker 各自统计
+
+配置（环境变量）：
+    CIRCUIT_ENABLED  是否启用熔断，默认 true
+    CIRCUIT_WINDOW_SECONDS  统计窗口（秒），默认 120
+    CIRCUIT_MIN_REQUESTS  窗口内请求数达到该值才判断是否熔断，默认 5
+    CIRCUIT_ERROR_RATE  熔断的失败比例，默认 0.5
+    CIRCUIT_SLOW_CALL_SECONDS  超过该耗时的请求计为失败（秒），默认 150
+    CIRCUIT_OPEN_SECONDS  打开状态的持续时间（秒），默认 30
+    CIRCUIT_OPEN_MAX_SECONDS  探测连续失败时打开时长的上限（秒），默认 300
+    CIRCUIT_HALF_OPEN_PROBES  半开状态同时放行的探测请求数（也是关闭所需的成功次数），默认 1
+"""
+
+import os
+import time
+import math
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import httpx
+from google.genai import errors as genai_errors
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_ENABLED = os.getenv("CIRCUIT_ENABLED", "true").lower() == "true"
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", 120))
+CIRCUIT_MIN_REQUESTS = int(os.getenv("CIRCUIT_MIN_REQUESTS", 5))
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", 0.5))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", 150))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+CIRCUIT_OPEN_MAX_SECONDS = float(os.getenv("CIRCUIT_OPEN_MAX_SECONDS", 300))
+CIRCUIT_HALF_OPEN_PROBES = max(1, int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", 1)))
+
+DEFAULT_ENDPOINT = "default"  # 官方 API 端点
+
+# 熔断器：{(模型, 端点): 状态}
+_circuits = {}
+_lock = threading.Lock()
+_call_ids = itertools.count(1)
+
+
+class CircuitOpen(Exception):
+    """上游熔断中，请求被直接拒绝"""
+
+    def __init__(self, model, endpoint, retry_after):
+        super().__init__(f"upstream circuit open for {model}@{endpoint}, retry after {retry_after}s")
+        self.model = model
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def _new_circuit():
+    return {
+        "state": "closed",
+        "opened_at": None,
+        "open_until": 0.0,
+        "open_seconds": CIRCUIT_OPEN_SECONDS,
+        "open_count": 0,
+        "probes": 0,  # 半开状态进行中的探测数
+        "probe_successes": 0,
+        "calls": deque(),  # 窗口内已完成的请求：(完成时间, 是否失败, 耗时秒)
+        "inflight": {},  # 进行中的请求：{调用 id: 开始时间}
+        "reset_at": 0.0,  # 上次关闭的时间，之前开始的进行中请求不再计入统计
+        "last_failure": None,
+        "last_failure_at": None,
+    }
+
+
+def _circuit(model, endpoint):
+    key = (model, endpoint or DEFAULT_ENDPOINT)
+    if key not in _circuits:
+        _circuits[key] = _new_circuit()
+    return _circuits[key]
+
+
+def _prune(circuit, now):
+    calls = circuit["calls"]
+    while calls and calls[0][0] <= now - CIRCUIT_WINDOW_SECONDS:
+        calls.popleft()
+
+
+def _window_counts(circuit, now):
+    """窗口内的（请求数, 失败数），包含已超过慢调用阈值的进行中请求"""
+    _prune(circuit, now)
+    stuck = sum(
+        1 for started in circuit["inflight"].values()
+        if started >= circuit["reset_at"] and now - started >= CIRCUIT_SLOW_CALL_SECONDS
+    )
+    total = len(circuit["calls"]) + stuck
+    failures = sum(1 for _, failed, _ in circuit["calls"] if failed) + stuck
+    return total, failures
+
+
+def _open(model, endpoint, circuit, now, reason):
+    circuit["state"] = "open"
+    circuit["opened_at"] = now
+    circuit["open_until"] = now + circuit["open_seconds"]
+    circuit["open_count"] += 1
+    circuit["probes"] = 0
+    circuit["probe_successes"] = 0
+    logger.warning(f"上游熔断打开 {model}@{endpoint or DEFAULT_ENDPOINT}（{reason}），{int(circuit['open_seconds'])} 秒后探测")
+
+
+def _close(model, endpoint, circuit, now):
+    circuit["state"] = "closed"
+    circuit["reset_at"] = now
+    circuit["open_seconds"] = CIRCUIT_OPEN_SECONDS
+    circuit["probes"] = 0
+    circuit["probe_successes"] = 0
+    circuit["calls"].clear()
+    logger.info(f"上游熔断关闭 {model}@{endpoint or DEFAULT_ENDPOINT}，探测请求成功")
+
+
+def _maybe_open(model, endpoint, circuit, now):
+    """关闭状态下检查窗口内失败比例，达到阈值时熔断"""
+    total, failures = _window_counts(circuit, now)
+    if total >= CIRCUIT_MIN_REQUESTS and failures / total >= CIRCUIT_ERROR_RATE:
+        _open(model, endpoint, circuit, now, f"{failures}/{total} 失败")
+
+
+def _rejects(circuit, now):
+    """当前是否拒绝新请求，返回建议的重试秒数（不拒绝时返回 None）"""
+    if circuit["state"] == "open":
+        if now < circuit["open_until"]:
+            return max(1, math.ceil(circuit["open_until"] - now))
+        return None  # 到期，下一个请求作为探测
+    if circuit["state"] == "half_open" and circuit["probes"] >= CIRCUIT_HALF_OPEN_PROBES:
+        return max(1, math.ceil(CIRCUIT_OPEN_SECONDS / 2))
+    return None
+
+
+def is_open(model, endpoint):
+    """该模型和端点的熔断器当前是否会拒绝新请求"""
+    if not CIRCUIT_ENABLED:
+        return False
+    now = time.time()
+    with _lock:
+        circuit = _circuit(model, endpoint)
+        if circuit["state"] == "closed":
+            _maybe_open(model, endpoint, circuit, now)
+        return _rejects(circuit, now) is not None
+
+
+def check(model, endpoints):
+    """该模型在所有端点上都处于熔断时抛出 CircuitOpen（生成前的快速检查，不占用探测名额）"""
+    if not CIRCUIT_ENABLED:
+        return
+    now = time.time()
+    retry_after = None
+    with _lock:
+        for endpoint in endpoints:
+            circuit = _circuit(model, endpoint)
+            if circuit["state"] == "closed":
+                _maybe_open(model, endpoint, circuit, now)
+            wait = _rejects(circuit, now)
+            if wait is None:
+                return
+            retry_after = wait if retry_after is None else min(retry_after, wait)
+    if retry_after is not None:
+        raise CircuitOpen(model, ", ".join(e or DEFAULT_ENDPOINT for e in endpoints), retry_after)
+
+
+def _acquire(model, endpoint, now):
+    """放行一次调用，返回 (调用 id, 是否探测)；熔断中抛出 CircuitOpen"""
+    circuit = _circuit(model, endpoint)
+    if circuit["state"] == "closed":
+        _maybe_open(model, endpoint, circuit, now)
+    retry_after = _rejects(circuit, now)
+    if retry_after is not None:
+        raise CircuitOpen(model, endpoint or DEFAULT_ENDPOINT, retry_after)
+    probe = False
+    if circuit["state"] == "open":
+        circuit["state"] = "half_open"
+        logger.info(f"上游熔断半开 {model}@{endpoint or DEFAULT_ENDPOINT}，发送探测请求")
+    if circuit["state"] == "half_open":
+        circuit["probes"] += 1
+        probe = True
+    call_id = next(_call_ids)
+    circuit["inflight"][call_id] = now
+    return call_id, probe
+
+
+def _release(model, endpoint, call_id, probe, failed, error=None):
+    """记录一次调用的结果（failed 为 None 表示不计入统计）"""
+    now = time.time()
+    with _lock:
+        circuit = _circuit(model, endpoint)
+        started = circuit["inflight"].pop(call_id, now)
+        duration = now - started
+        if failed is not None and duration >= CIRCUIT_SLOW_CALL_SECONDS:
+            failed, error = True, f"slow call {duration:.0f}s"
+        if failed:
+            circuit["last_failure"] = str(error)[:300]
+            circuit["last_failure_at"] = now
+
+        if probe and circuit["state"] == "half_open":
+            circuit["probes"] -= 1
+            if failed is None:
+                return
+            if failed:
+                circuit["open_seconds"] = min(circuit["open_seconds"] * 2, CIRCUIT_OPEN_MAX_SECONDS)
+                _open(model, endpoint, circuit, now, f"探测失败: {circuit['last_failure']}")
+                return
+            circuit["probe_successes"] += 1
+            if circuit["probe_successes"] >= CIRCUIT_HALF_OPEN_PROBES:
+                _close(model, endpoint, circuit, now)
+            return
+
+        if failed is None or started < circuit["reset_at"]:
+            return  # 熔断恢复前开始的请求不影响恢复后的统计
+        circuit["calls"].append((now, failed, duration))
+        if failed and circuit["state"] == "closed":
+            _maybe_open(model, endpoint, circuit, now)
+
+
+def is_upstream_failure(error):
+    """
+    判断异常是否说明上游不健康：True（5xx、超时、连接错误）、False（4xx，上游正常响应）、
+    None（429 配额错误或其他与上游健康无关的异常，不计入统计）
+    """
+    if isinstance(error, genai_errors.ServerError):
+        return True
+    if isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, genai_errors.ClientError):
+        return None if getattr(error, "code", None) == 429 else False
+    return None
+
+
+@contextmanager
+def guard(model, endpoint):
+    """包裹一次上游调用：熔断中抛出 CircuitOpen，否则统计耗时和结果（取消的请求不计入统计）"""
+    if not CIRCUIT_ENABLED:
+        yield
+        return
+    with _lock:
+        call_id, probe = _acquire(model, endpoint, time.time())
+    failed, error = None, None
+    try:
+        yield
+        failed = False
+    except Exception as e:
+        failed, error = is_upstream_failure(e), e
+        raise
+    finally:
+        _release(model, endpoint, call_id, probe, failed, error)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 2)
+
+
+def model_health(model, endpoints):
+    """
+    模型在给定端点上的汇总统计：窗口内请求数、错误率、p95 耗时（秒），以及是否所有端点都在熔断
+    已超过慢调用阈值仍在进行中的请求按当前耗时计入
+    """
+    now = time.time()
+    total = failures = 0
+    durations = []
+    rejecting = bool(endpoints) and CIRCUIT_ENABLED
+    with _lock:
+        for endpoint in endpoints:
+            circuit = _circuits.get((model, endpoint or DEFAULT_ENDPOINT))
+            if circuit is None:
+                rejecting = False
+                continue
+            count, failed = _window_counts(circuit, now)
+            total += count
+            failures += failed
+            durations.extend(duration for _, _, duration in circuit["calls"])
+            durations.extend(
+                now - started for started in circuit["inflight"].values()
+                if started >= circuit["reset_at"] and now - started >= CIRCUIT_SLOW_CALL_SECONDS
+            )
+            if _rejects(circuit, now) is None:
+                rejecting = False
+    return {
+        "requests": total,
+        "error_rate": round(failures / total, 3) if total else 0.0,
+        "p95_seconds": _percentile(durations, 0.95),
+        "circuit_open": rejecting,
+    }
+
+
+def status():
+    """返回当前进程中各熔断器的状态、窗口内错误率和耗时（管理后台展示用）"""
+    now = time.time()
+    circuits = []
+    with _lock:
+        for (model, endpoint), circuit in sorted(_circuits.items()):
+            total, failures = _window_counts(circuit, now)
+            durations = [duration for _, _, duration in circuit["calls"]]
+            retry_after = _rejects(circuit, now)
+            circuits.append({
+                "model": model,
+                "endpoint": endpoint,
+                "state": circuit["state"],
+                "rejecting": retry_after is not None,
+                "retry_after": retry_after,
+                "requests": total,
+                "failures": failures,
+                "error_rate": round(failures / total, 3) if total else 0.0,
+                "latency_p50": _percentile(durations, 0.5),
+                "latency_p95": _percentile(durations, 0.95),
+                "inflight": len(circuit["inflight"]),
+                "open_count": circuit["open_count"],
+                "opened_at": circuit["opened_at"],
+                "last_failure": circuit["last_failure"],
+                "last_failure_at": circuit["last_failure_at"],
+            })
+    return {
+        "enabled": CIRCUIT_ENABLED,
+        "pid": os.getpid(),
+        "window_seconds": CIRCUIT_WINDOW_SECONDS,
+        "error_rate_threshold": CIRCUIT_ERROR_RATE,
+        "slow_call_seconds": CIRCUIT_SLOW_CALL_SECONDS,
+        "circuits": circuits,
+    }
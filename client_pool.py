@@ -0,0 +1,321 @@
+"""
+Gemini 客户端池模块
+配置多个 API 密钥（可分别指定端点），新建聊天时按策略选择密钥，单个密钥的配额不再是整体吞吐的上限。
+
+- 每个密钥一个 genai.Client（首次使用时按进程创建，HTTP 连接池不能跨 fork 共享）
+- 选择策略：
+    least_inflight  进行中请求数 / 权重最小的密钥（默认）
+    weighted        按权重平滑轮询
+    rate_remaining  最近一分钟剩余请求数比例最高的密钥（需要为密钥配置 rpm，未配置的视为不限）
+- 健康状态按密钥记录：返回 RESOURCE_EXHAUSTED（配额耗尽）时冷却一段时间（优先使用错误中的 retryDelay，
+  连续耗尽时加倍）；PERMISSION_DENIED / 密钥无效时长时间停用；连续多次服务端错误时短暂冷却
+- 冷却中的密钥不会被选中；所有密钥都在冷却时选择最早恢复的密钥，请求照常发出
+- 聊天实例固定在创建它的密钥上；密钥冷却或配额错误时优先迁移到同一端点的其他密钥
+- 健康状态保存在进程内存中，每个 worker 各自统计
+
+配置（环境变量）：
+    GEMINI_API_KEYS  多个密钥，逗号或换行分隔；每项可附加 ;base_url=...;weight=N;rpm=N，
+                     例如 key1;weight=2,key2;base_url=http://127.0.0.1:8045;rpm=10。
+                     未设置时使用 GEMINI_API_KEY 和 GEMINI_API_BASE_URL
+    GEMINI_KEY_POLICY  选择策略，默认 least_inflight
+    GEMINI_KEY_COOLDOWN  配额耗尽时的基础冷却时间（秒），默认 60
+    GEMINI_KEY_COOLDOWN_MAX  连续耗尽时冷却时间的上限（秒），默认 900
+    GEMINI_KEY_DISABLE_SECONDS  权限错误/密钥无效时的停用时间（秒），默认 1800
+    GEMINI_KEY_MAX_FAILURES  连续服务端错误达到该次数后冷却，默认 3
+    GEMINI_KEY_FAILOVER_ATTEMPTS  单次生成遇到配额/权限错误时最多切换密钥重试的次数，默认 2
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from google import genai
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("least_inflight", "weighted", "rate_remaining")
+KEY_POLICY = os.getenv("GEMINI_KEY_POLICY", "least_inflight").strip().lower()
+KEY_COOLDOWN = float(os.getenv("GEMINI_KEY_COOLDOWN", 60))
+KEY_COOLDOWN_MAX = float(os.getenv("GEMINI_KEY_COOLDOWN_MAX", 900))
+KEY_DISABLE_SECONDS = float(os.getenv("GEMINI_KEY_DISABLE_SECONDS", 1800))
+KEY_MAX_FAILURES = int(os.getenv("GEMINI_KEY_MAX_FAILURES", 3))
+KEY_FAILOVER_ATTEMPTS = int(os.getenv("GEMINI_KEY_FAILOVER_ATTEMPTS", 2))
+
+HTTP_TIMEOUT_MS = 300000  # 300秒超时（毫秒），支持长提示词
+RATE_WINDOW = 60  # rpm 统计窗口（秒）
+
+# 错误分类：配额耗尽 → 冷却；权限/密钥无效 → 停用
+QUOTA_MARKERS = ("RESOURCE_EXHAUSTED",)
+PERMISSION_MARKERS = ("PERMISSION_DENIED", "UNAUTHENTICATED", "API_KEY_INVALID")
+_RETRY_DELAY_PATTERN = re.compile(r"retryDelay['\"]?\s*:\s*['\"](\d+(?:\.\d+)?)s")
+
+if KEY_POLICY not in POLICIES:
+    raise ValueError(f"GEMINI_KEY_POLICY 必须是 {', '.join(POLICIES)} 之一")
+
+
+def _parse_keys():
+    """解析密钥配置，返回 [{id, api_key, base_url, weight, rpm}]"""
+    raw = os.getenv("GEMINI_API_KEYS", "").strip()
+    if not raw:
+        api_key = os.getenv("GEMINI_API_KEY")
+        raw = api_key if api_key else ""
+        if raw and os.getenv("GEMINI_API_BASE_URL"):
+            raw += f";base_url={os.getenv('GEMINI_API_BASE_URL')}"
+
+    keys = []
+    for item in re.split(r"[,\n]", raw):
+        fields = [field.strip() for field in item.split(";") if field.strip()]
+        if not fields:
+            continue
+        entry = {"api_key": fields[0], "base_url": None, "weight": 1.0, "rpm": None}
+        for field in fields[1:]:
+            name, _, value = field.partition("=")
+            name = name.strip().lower()
+            if name == "base_url":
+                entry["base_url"] = value.strip().rstrip("/") or None
+            elif name in ("weight", "rpm"):
+                number = float(value)
+                if number <= 0:
+                    raise ValueError(f"GEMINI_API_KEYS 中 {name} 必须大于 0")
+                entry[name] = number if name == "weight" else int(number)
+            else:
+                raise ValueError(f"GEMINI_API_KEYS 不支持的参数: {name}")
+        entry["id"] = f"key-{len(keys) + 1}"
+        keys.append(entry)
+    return keys
+
+
+def _new_state():
+    return {
+        "inflight": 0,
+        "requests": 0,
+        "successes": 0,
+        "failures": 0,
+        "consecutive_failures": 0,
+        "quota_strikes": 0,
+        "cooldown_until": 0.0,
+        "state": "healthy",
+        "last_error": None,
+        "last_error_at": None,
+        "recent": deque(),  # 最近一个窗口内的请求时间（rpm 统计）
+        "current_weight": 0.0,  # 平滑轮询的当前权重
+    }
+
+
+KEYS = _parse_keys()
+_keys_by_id = {key["id"]: key for key in KEYS}
+_states = {key["id"]: _new_state() for key in KEYS}
+_lock = threading.Lock()
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def _mask(api_key):
+    return f"{api_key[:4]}…{api_key[-4:]}" if len(api_key) > 12 else "…"
+
+
+def endpoint(key_id):
+    """密钥对应的 API 端点（None 表示官方端点）"""
+    return _keys_by_id[key_id]["base_url"]
+
+
+def endpoints():
+    """所有密钥涉及的 API 端点（去重，保持配置顺序）"""
+    return list(dict.fromkeys(key["base_url"] for key in KEYS))
+
+
+def get_client(key_id=None):
+    """
+    获取指定密钥在当前进程的 Gemini 客户端（首次使用时创建，未指定时使用第一个密钥）
+    客户端内部的 HTTP 连接池不能跨 fork 共享，preload 模式下每个 worker 各自创建
+    """
+    global _clients, _clients_pid
+    key = _keys_by_id[key_id] if key_id else KEYS[0]
+    if _clients_pid != os.getpid() or key["id"] not in _clients:
+        with _clients_lock:
+            if _clients_pid != os.getpid():
+                _clients = {}
+                _clients_pid = os.getpid()
+            if key["id"] not in _clients:
+                http_kwargs = {"timeout": HTTP_TIMEOUT_MS}
+                if key["base_url"]:
+                    http_kwargs["base_url"] = key["base_url"]
+                    logger.info(f"密钥 {key['id']} 使用自定义 API 端点: {key['base_url']}")
+                _clients[key["id"]] = genai.Client(
+                    api_key=key["api_key"], http_options=types.HttpOptions(**http_kwargs)
+                )
+    return _clients[key["id"]]
+
+
+def _recent_count(state, now):
+    recent = state["recent"]
+    while recent and recent[0] <= now - RATE_WINDOW:
+        recent.popleft()
+    return len(recent)
+
+
+def _available(key, now):
+    """密钥未在冷却中，且配置了 rpm 时最近一分钟（含进行中）未超出"""
+    state = _states[key["id"]]
+    if state["cooldown_until"] > now:
+        return False
+    if key["rpm"] and _recent_count(state, now) >= key["rpm"]:
+        return False
+    return True
+
+
+def _pick(candidates, now):
+    """在候选密钥中按策略选择一个"""
+    if KEY_POLICY == "weighted":
+        # 平滑加权轮询：每次所有候选加上自身权重，选当前权重最大的，再减去总权重
+        total = sum(key["weight"] for key in candidates)
+        for key in candidates:
+            _states[key["id"]]["current_weight"] += key["weight"]
+        chosen = max(candidates, key=lambda key: _states[key["id"]]["current_weight"])
+        _states[chosen["id"]]["current_weight"] -= total
+        return chosen
+
+    def load(key):
+        state = _states[key["id"]]
+        return (state["inflight"] / key["weight"], _recent_count(state, now) / key["weight"])
+
+    if KEY_POLICY == "rate_remaining":
+        def remaining(key):
+            if not key["rpm"]:
+                return 1.0
+            used = _recent_count(_states[key["id"]], now) + _states[key["id"]]["inflight"]
+            return max(0, key["rpm"] - used) / key["rpm"]
+        return min(candidates, key=lambda key: (-remaining(key), load(key)))
+
+    return min(candidates, key=load)
+
+
+def select(near=None, exclude=()):
+    """
+    按策略选择一个可用密钥，返回密钥 id
+    指定 near（密钥 id）时优先选择与它相同端点的密钥（已有对话迁移时保持兼容）；
+    exclude 中的密钥不参与选择（除非没有其他密钥）
+    """
+    now = time.time()
+    with _lock:
+        pool = [key for key in KEYS if key["id"] not in exclude] or list(KEYS)
+        candidates = [key for key in pool if _available(key, now)]
+        if near and candidates:
+            same = [key for key in candidates if key["base_url"] == _keys_by_id[near]["base_url"]]
+            candidates = same or candidates
+        if not candidates:
+            # 全部冷却中：选择最早恢复的密钥
+            return min(pool, key=lambda key: _states[key["id"]]["cooldown_until"])["id"]
+        return _pick(candidates, now)["id"]
+
+
+def is_available(key_id):
+    """密钥当前是否可用（未冷却且未超出 rpm）"""
+    with _lock:
+        return _available(_keys_by_id[key_id], time.time())
+
+
+def classify_error(error):
+    """错误分类：'quota'（配额耗尽）、'permission'（权限/密钥无效）、'server'（服务端错误）或 None"""
+    status = f"{getattr(error, 'status', '') or ''} {error}"
+    code = getattr(error, "code", None)
+    if code == 429 or any(marker in status for marker in QUOTA_MARKERS):
+        return "quota"
+    if code in (401, 403) or any(marker in status for marker in PERMISSION_MARKERS):
+        return "permission"
+    if isinstance(code, int) and code >= 500:
+        return "server"
+    return None
+
+
+def _cooldown(key_id, state, seconds, reason, now):
+    state["cooldown_until"] = max(state["cooldown_until"], now + seconds)
+    state["state"] = "disabled" if reason == "permission" else "cooling"
+    logger.warning(f"Gemini 密钥 {key_id} 因 {reason} 错误冷却 {int(seconds)} 秒")
+
+
+def record_failure(key_id, error):
+    """记录一次失败并按错误类型更新冷却状态"""
+    kind = classify_error(error)
+    now = time.time()
+    with _lock:
+        state = _states[key_id]
+        state["failures"] += 1
+        state["consecutive_failures"] += 1
+        state["last_error"] = str(error)[:300]
+        state["last_error_at"] = now
+        if kind == "quota":
+            state["quota_strikes"] += 1
+            match = _RETRY_DELAY_PATTERN.search(str(error))
+            seconds = float(match.group(1)) if match else KEY_COOLDOWN * 2 ** (state["quota_strikes"] - 1)
+            _cooldown(key_id, state, min(seconds, KEY_COOLDOWN_MAX), kind, now)
+        elif kind == "permission":
+            _cooldown(key_id, state, KEY_DISABLE_SECONDS, kind, now)
+        elif kind == "server" and state["consecutive_failures"] >= KEY_MAX_FAILURES:
+            _cooldown(key_id, state, KEY_COOLDOWN, kind, now)
+    return kind
+
+
+def record_success(key_id):
+    with _lock:
+        state = _states[key_id]
+        state["successes"] += 1
+        state["consecutive_failures"] = 0
+        state["quota_strikes"] = 0
+        state["state"] = "healthy"
+
+
+@contextmanager
+def track(key_id):
+    """包裹一次上游调用：统计进行中请求数和 rpm，按结果更新健康状态（取消的请求不计为失败）"""
+    now = time.time()
+    with _lock:
+        state = _states[key_id]
+        state["inflight"] += 1
+        state["requests"] += 1
+        state["recent"].append(now)
+    try:
+        yield
+    except Exception as e:
+        record_failure(key_id, e)
+        raise
+    else:
+        record_success(key_id)
+    finally:
+        with _lock:
+            _states[key_id]["inflight"] -= 1
+
+
+def status():
+    """返回当前进程中各密钥的健康状态（管理后台展示用，不包含完整密钥）"""
+    now = time.time()
+    keys = []
+    with _lock:
+        for key in KEYS:
+            state = _states[key["id"]]
+            cooldown = max(0.0, state["cooldown_until"] - now)
+            keys.append({
+                "id": key["id"],
+                "key": _mask(key["api_key"]),
+                "base_url": key["base_url"],
+                "weight": key["weight"],
+                "rpm": key["rpm"],
+                "state": state["state"] if cooldown else "healthy",
+                "cooldown_remaining": round(cooldown, 1),
+                "inflight": state["inflight"],
+                "requests_last_minute": _recent_count(state, now),
+                "requests": state["requests"],
+                "successes": state["successes"],
+                "failures": state["failures"],
+                "consecutive_failures": state["consecutive_failures"],
+                "last_error": state["last_error"],
+                "last_error_at": state["last_error_at"],
+            })
+    return {"policy": KEY_POLICY, "pid": os.getpid(), "keys": keys}
@@ -9,10 +9,14 @@ import re
 import secrets
 import string
 import hashlib
+import json
+import time
+import base64
 import logging
 from contextlib import contextmanager
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from filelock import FileLock
+from password_hashing import hash_secret, hash_many, verify_secret
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
@@ -40,74 +44,53 @@ def get_db():
         conn.close()
 
 
-def init_db():
-    """初始化数据库，创建用户表"""
-    os.makedirs("data", exist_ok=True)
-    with get_db() as conn:
-        # 启用 WAL 模式提升并发性能（数据库级别持久设置，只需设置一次）
-        conn.execute("PRAGMA journal_mode=WAL")
-        cursor = conn.cursor()
-        
-        # 检查表是否存在，如果存在检查是否有 is_admin 列
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-        table_exists = cursor.fetchone()
+def _migration_baseline(conn):
+    """
+    迁移 1：基础表结构
+    引入版本号之前的数据库可能处于任意历史版本，这里保留逐项探测的升级逻辑，之后的改动都写成新的迁移
+    """
+    cursor = conn.cursor()
+    
+    # 检查表是否存在，如果存在检查是否有 is_admin 列
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
+    table_exists = cursor.fetchone()
+    
+    if table_exists:
+        # 检查是否有 is_admin 列
+        cursor.execute("PRAGMA table_info(users)")
+        columns = [col[1] for col in cursor.fetchall()]
+        if 'is_admin' not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN is_admin INTEGER DEFAULT 0")
         
-        if table_exists:
-            # 检查是否有 is_admin 列
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [col[1] for col in cursor.fetchall()]
-            if 'is_admin' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN is_admin INTEGER DEFAULT 0")
-            
-            if 'credits' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN credits INTEGER DEFAULT 4")
-            
-            if 'email' not in columns:
-                cursor.execute("ALTER TABLE users ADD COLUMN email TEXT")
-        else:
-            cursor.execute('''
-                CREATE TABLE users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE,
-                    password_hash TEXT NOT NULL,
-                    is_admin INTEGER DEFAULT 0,
-                    credits INTEGER DEFAULT 4,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+        if 'credits' not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN credits INTEGER DEFAULT 4")
         
-        # 创建/迁移卡密表（哈希存储）
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='card_keys'")
-        table_exists = cursor.fetchone()
+        if 'email' not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN email TEXT")
+    else:
+        cursor.execute('''
+            CREATE TABLE users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                email TEXT UNIQUE,
+                password_hash TEXT NOT NULL,
+                is_admin INTEGER DEFAULT 0,
+                credits INTEGER DEFAULT 4,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+    # 创建/迁移卡密表（哈希存储）
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='card_keys'")
+    table_exists = cursor.fetchone()
+    
+    if table_exists:
+        cursor.execute("PRAGMA table_info(card_keys)")
+        columns = [col[1] for col in cursor.fetchall()]
         
-        if table_exists:
-            cursor.execute("PRAGMA table_info(card_keys)")
-            columns = [col[1] for col in cursor.fetchall()]
-            
-            if 'code' in columns and 'code_hash' not in columns:
-                logger.warning("检测到旧版本卡密表（明文存储），正在升级到安全的哈希存储...")
-                cursor.execute("DROP TABLE card_keys")
-                cursor.execute('''
-                    CREATE TABLE card_keys (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        code_hash TEXT UNIQUE NOT NULL,
-                        code_prefix TEXT,
-                        fast_hash TEXT,
-                        credits INTEGER NOT NULL,
-                        is_used INTEGER DEFAULT 0,
-                        used_by INTEGER,
-                        used_at TIMESTAMP,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (used_by) REFERENCES users(id)
-                    )
-                ''')
-                logger.info("卡密表已升级，所有旧卡密已清空（安全考虑）")
-            
-            if 'fast_hash' not in columns:
-                cursor.execute("ALTER TABLE card_keys ADD COLUMN fast_hash TEXT")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_fast_hash ON card_keys(fast_hash)")
-        else:
+        if 'code' in columns and 'code_hash' not in columns:
+            logger.warning("检测到旧版本卡密表（明文存储），正在升级到安全的哈希存储...")
+            cursor.execute("DROP TABLE card_keys")
             cursor.execute('''
                 CREATE TABLE card_keys (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -122,58 +105,537 @@ def init_db():
                     FOREIGN KEY (used_by) REFERENCES users(id)
                 )
             ''')
+            logger.info("卡密表已升级，所有旧卡密已清空（安全考虑）")
+        
+        if 'fast_hash' not in columns:
+            cursor.execute("ALTER TABLE card_keys ADD COLUMN fast_hash TEXT")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_fast_hash ON card_keys(fast_hash)")
+    else:
+        cursor.execute('''
+            CREATE TABLE card_keys (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code_hash TEXT UNIQUE NOT NULL,
+                code_prefix TEXT,
+                fast_hash TEXT,
+                credits INTEGER NOT NULL,
+                is_used INTEGER DEFAULT 0,
+                used_by INTEGER,
+                used_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (used_by) REFERENCES users(id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fast_hash ON card_keys(fast_hash)")
+    
+    # 卡密批次（每次生成为一个批次，用于审计和整批作废）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_key_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            label TEXT,
+            credits INTEGER NOT NULL,
+            requested_count INTEGER NOT NULL,
+            generated_count INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'generating',
+            created_by INTEGER,
+            created_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            revoked_at TIMESTAMP,
+            revoked_by INTEGER,
+            revoke_reason TEXT
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(card_keys)")
+    card_key_columns = [col[1] for col in cursor.fetchall()]
+    if 'batch_id' not in card_key_columns:
+        cursor.execute("ALTER TABLE card_keys ADD COLUMN batch_id INTEGER")
+    if 'revoked_at' not in card_key_columns:
+        cursor.execute("ALTER TABLE card_keys ADD COLUMN revoked_at TIMESTAMP")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_card_keys_batch ON card_keys(batch_id, is_used)")
+    # 管理员卡密列表按状态/前缀/使用者/创建时间筛选，按 id 倒序键集分页
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_card_keys_status ON card_keys(is_used, revoked_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_card_keys_prefix ON card_keys(code_prefix)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_card_keys_used_by ON card_keys(used_by)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_card_keys_created_at ON card_keys(created_at)")
+    # 批量生成依赖 fast_hash 唯一约束做集合式去重（NULL 为未回填的旧数据，不受约束）
+    try:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_card_keys_fast_hash_unique ON card_keys(fast_hash)")
+    except sqlite3.IntegrityError:
+        logger.error("card_keys.fast_hash 存在重复值，无法创建唯一索引，批量生成将无法检测重复卡密")
+
+    # 创建邮箱验证码表
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='verification_codes'")
+    table_exists = cursor.fetchone()
+    
+    if not table_exists:
+        cursor.execute('''
+            CREATE TABLE verification_codes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT NOT NULL,
+                code_hash TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL,
+                used INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute("CREATE INDEX idx_email ON verification_codes(email)")
+        cursor.execute("CREATE INDEX idx_expires_at ON verification_codes(expires_at)")
+
+    # 创建用户用量计数表（会话/消息/图片数由会话保存时同步，生成次数/消耗点数累计）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_usage (
+            user_id INTEGER PRIMARY KEY,
+            session_count INTEGER DEFAULT 0,
+            message_count INTEGER DEFAULT 0,
+            image_count INTEGER DEFAULT 0,
+            image_bytes INTEGER DEFAULT 0,
+            generation_count INTEGER DEFAULT 0,
+            credits_spent INTEGER DEFAULT 0,
+            updated_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)")
+    # 管理员列表键集分页：排序列索引（SQLite 索引隐含 rowid，即 (列, id) 有序）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_credits ON users(credits)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_is_admin ON users(is_admin, created_at)")
+    for column in ("session_count", "message_count", "image_count", "image_bytes", "generation_count", "credits_spent"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_user_usage_{column} ON user_usage({column})")
+
+    # 会话时间索引：每个会话最早一条消息的时间，保留策略按时间顺序分批定位过期会话
+    # 同时作为会话列表的数据来源，列表接口不需要读取会话文件
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_index (
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            oldest_at TEXT,
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, session_id)
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(session_index)")
+    columns = [col[1] for col in cursor.fetchall()]
+    for column, definition in (("title", "TEXT"), ("created_at", "TEXT"), ("updated_at", "TEXT"),
+                               ("image_count", "INTEGER DEFAULT 0"), ("image_bytes", "INTEGER DEFAULT 0")):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE session_index ADD COLUMN {column} {definition}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_index_oldest ON session_index(oldest_at, user_id, session_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_index_updated ON session_index(user_id, updated_at)")
+
+    # 媒体文件索引：会话中引用的图片/缩略图，清理孤儿文件时按文件名查询，无需扫描会话文件
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            filename TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (kind, filename)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_files_user ON media_files(user_id, session_id)")
+
+    # 数据保留任务表（分批、可恢复，进度持久化）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS retention_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            cutoff TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            phase TEXT NOT NULL DEFAULT 'messages',
+            cursor TEXT,
+            stats TEXT,
+            total INTEGER DEFAULT 0,
+            error TEXT,
+            lease_owner TEXT,
+            lease_expires REAL,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_retention_jobs_status ON retention_jobs(status, id)")
+
+    # 邮件发件箱（请求内只写入，由后台发送线程批量投递、失败退避重试）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            payload TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox(status, next_attempt_at)")
+
+    # 通用键值表（记录一次性迁移/回填进度等）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def _migration_admin_account(conn):
+    """迁移 2：创建管理员账号（如果不存在），已存在时确保其有管理员权限"""
+    cursor = conn.cursor()
+    
+    # 检查 admin 是否已存在
+    cursor.execute("SELECT id FROM users WHERE username = ?", ("admin",))
+    if cursor.fetchone() is None:
+        # 从环境变量获取管理员密码
+        admin_password = os.getenv("ADMIN_PASSWORD")
         
-        # 创建邮箱验证码表
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='verification_codes'")
-        table_exists = cursor.fetchone()
+        if not admin_password:
+            # 如果未设置，生成随机密码并输出警告
+            admin_password = ''.join(secrets.choice(string.ascii_letters + string.digits + string.punctuation) for _ in range(16))
+            logger.warning("=" * 60)
+            logger.warning("⚠️  警告：未设置 ADMIN_PASSWORD 环境变量！")
+            logger.warning(f"⚠️  已自动生成管理员密码: {admin_password}")
+            logger.warning("⚠️  请立即保存此密码，并在首次登录后修改！")
+            logger.warning("⚠️  建议：在 .env 文件中设置 ADMIN_PASSWORD=your_password")
+            logger.warning("=" * 60)
         
-        if not table_exists:
-            cursor.execute('''
-                CREATE TABLE verification_codes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    email TEXT NOT NULL,
-                    code_hash TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    used INTEGER DEFAULT 0
-                )
-            ''')
-            cursor.execute("CREATE INDEX idx_email ON verification_codes(email)")
-            cursor.execute("CREATE INDEX idx_expires_at ON verification_codes(expires_at)")
+        # 创建 admin 用户
+        # 迁移可能在 preload 主进程中执行，直接计算，不在 fork 之前创建哈希进程池
+        password_hash = hash_secret("password", admin_password, offload=False)
+        cursor.execute(
+            "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
+            ("admin", password_hash, 1)
+        )
+        cursor.execute(
+            "INSERT OR IGNORE INTO user_usage (user_id, updated_at) VALUES (?, ?)",
+            (cursor.lastrowid, datetime.now().isoformat())
+        )
+        logger.info("✅ 管理员账号创建成功: admin")
+    else:
+        # 确保 admin 有管理员权限
+        cursor.execute("UPDATE users SET is_admin = 1 WHERE username = ?", ("admin",))
 
 
-def create_admin_user():
-    """创建管理员账号（如果不存在）"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        # 检查 admin 是否已存在
-        cursor.execute("SELECT id FROM users WHERE username = ?", ("admin",))
-        if cursor.fetchone() is None:
-            # 从环境变量获取管理员密码
-            admin_password = os.getenv("ADMIN_PASSWORD")
-            
-            if not admin_password:
-                # 如果未设置，生成随机密码并输出警告
-                admin_password = ''.join(secrets.choice(string.ascii_letters + string.digits + string.punctuation) for _ in range(16))
-                logger.warning("=" * 60)
-                logger.warning("⚠️  警告：未设置 ADMIN_PASSWORD 环境变量！")
-                logger.warning(f"⚠️  已自动生成管理员密码: {admin_password}")
-                logger.warning("⚠️  请立即保存此密码，并在首次登录后修改！")
-                logger.warning("⚠️  建议：在 .env 文件中设置 ADMIN_PASSWORD=your_password")
-                logger.warning("=" * 60)
-            
-            # 创建 admin 用户
-            password_hash = generate_password_hash(admin_password)
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
-                ("admin", password_hash, 1)
+def _migration_indexes_v3(conn):
+    """迁移 3：验证码查询复合索引，删除被其他索引覆盖的冗余索引"""
+    # verify_email_code: WHERE email = ? AND used = 0 ORDER BY created_at DESC LIMIT 1
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_verification_codes_lookup ON verification_codes(email, used, created_at)")
+    conn.execute("DROP INDEX IF EXISTS idx_email")
+    # fast_hash 唯一索引创建成功后，原普通索引已冗余（有重复数据时唯一索引不存在，保留原索引）
+    unique_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_card_keys_fast_hash_unique'"
+    ).fetchone()
+    if unique_exists:
+        conn.execute("DROP INDEX IF EXISTS idx_fast_hash")
+
+
+def _migration_scheduler(conn):
+    """迁移 4：后台调度器的主节点租约、任务状态和执行历史"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_leader (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT NOT NULL,
+            lease_expires REAL NOT NULL,
+            acquired_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name TEXT PRIMARY KEY,
+            last_started_at REAL,
+            last_finished_at REAL,
+            last_status TEXT,
+            last_duration_ms INTEGER,
+            last_owner TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            duration_ms INTEGER NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduler_runs_job ON scheduler_runs(job, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduler_runs_started ON scheduler_runs(started_at)")
+
+
+def _migration_message_search(conn):
+    """
+    迁移 5：消息全文搜索索引
+    message_index 保存每条可搜索消息（用户提示词、模型文字回复），message_fts 是其外部内容 FTS5 索引，
+    由触发器同步。行 ID 按用户分段（user_id << 32 | 序号），搜索时用 rowid 范围限定在当前用户的数据内
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_index (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT,
+            image TEXT,
+            thumbnail TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_message_index_session ON message_index(user_id, session_id)")
+    try:
+        # trigram 分词按字符三元组建索引，中文等不以空格分词的文本也能按子串搜索
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+                content, content='message_index', content_rowid='id', tokenize='trigram'
             )
-            logger.info("✅ 管理员账号创建成功: admin")
-        else:
-            # 确保 admin 有管理员权限
-            cursor.execute("UPDATE users SET is_admin = 1 WHERE username = ?", ("admin",))
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite 未编译 FTS5 或版本低于 3.34（不支持 trigram）：搜索退化为按子串扫描当前用户的消息
+        logger.warning(f"无法创建全文索引，消息搜索将按子串扫描: {e}")
+        return
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_index_ai AFTER INSERT ON message_index BEGIN
+            INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_index_ad AFTER DELETE ON message_index BEGIN
+            INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_index_au AFTER UPDATE OF content ON message_index BEGIN
+            INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+
+
+def _migration_image_index(conn):
+    """迁移 6：生成图片索引（图库按用户、时间倒序分页浏览，不读取会话文件和原图）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_index (
+            filename TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            image TEXT NOT NULL,
+            thumbnail TEXT,
+            width INTEGER,
+            height INTEGER,
+            size INTEGER,
+            model TEXT,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_index_user ON image_index(user_id, created_at, filename)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_index_session ON image_index(user_id, session_id)")
+
+
+def _migration_model_routing(conn):
+    """迁移 7：模型路由（用户是否允许自动切换模型、路由决策记录）"""
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(users)").fetchall()]
+    if "model_fallback" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN model_fallback INTEGER DEFAULT 0")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS model_routing_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            requested_model TEXT NOT NULL,
+            routed_model TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            p95_seconds REAL,
+            error_rate REAL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_model_routing_log_created ON model_routing_log(created_at)")
+
+
+def _migration_generation_log(conn):
+    """迁移 8：生成记录表，以及按小时/按天增量维护的汇总表（管理后台统计只读汇总表）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            requested_model TEXT,
+            image_size TEXT NOT NULL,
+            aspect_ratio TEXT,
+            key_id TEXT,
+            credits INTEGER NOT NULL DEFAULT 0,
+            outcome TEXT NOT NULL,
+            error_code TEXT,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            prepare_ms INTEGER,
+            upstream_ms INTEGER,
+            save_ms INTEGER,
+            total_ms INTEGER,
+            image_bytes INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_generations_created ON generations(created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_generations_user ON generations(user_id, created_at)")
+    # period 为 hour / day，bucket 为对应的时间段（YYYY-MM-DDTHH / YYYY-MM-DD）
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generation_rollups (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            model TEXT NOT NULL,
+            image_size TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            successes INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            credits INTEGER NOT NULL DEFAULT 0,
+            total_ms INTEGER NOT NULL DEFAULT 0,
+            upstream_ms INTEGER NOT NULL DEFAULT 0,
+            image_bytes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket, model, image_size)
+        )
+    ''')
+    # 耗时直方图（le 为区间上限毫秒数，-1 表示超过最大区间），用于计算 p95
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generation_latency_rollups (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            model TEXT NOT NULL,
+            image_size TEXT NOT NULL,
+            le INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket, model, image_size, le)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generation_user_rollups (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            credits INTEGER NOT NULL DEFAULT 0,
+            upstream_ms INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id)
+        )
+    ''')
+
+
+def _migration_image_archive(conn):
+    """迁移 9：冷存储中的原图（原图移出本地磁盘后按需取回）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_archive (
+            filename TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            archived_at TEXT NOT NULL,
+            rehydrated_at TEXT
+        )
+    ''')
+
+
+def _migration_image_recompression(conn):
+    """迁移 10：原图无损重新压缩记录（每个原图处理一次，记录压缩前后的大小）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_recompression (
+            filename TEXT PRIMARY KEY,
+            new_filename TEXT,
+            format TEXT NOT NULL,
+            status TEXT NOT NULL,
+            original_bytes INTEGER,
+            new_bytes INTEGER,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_recompression_new ON image_recompression(new_filename)")
+
+
+def _migration_session_pending_writes(conn):
+    """迁移 11：会话元数据延迟写入的意图记录（写入会话文件后删除）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS session_pending_writes (
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            created TEXT,
+            title TEXT,
+            updated_at TEXT,
+            stamp INTEGER NOT NULL,
+            queued_at REAL NOT NULL,
+            PRIMARY KEY (user_id, session_id)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_session_pending_writes_queued ON session_pending_writes(queued_at)")
+
+
+# 数据库结构迁移（按版本号顺序执行，已执行的版本记录在 PRAGMA user_version 中）
+# 只能追加新迁移，不能修改已发布的迁移
+SCHEMA_MIGRATIONS = [
+    (1, "基础表结构", _migration_baseline),
+    (2, "管理员账号", _migration_admin_account),
+    (3, "验证码复合索引", _migration_indexes_v3),
+    (4, "后台调度器", _migration_scheduler),
+    (5, "消息全文搜索", _migration_message_search),
+    (6, "生成图片索引", _migration_image_index),
+    (7, "模型路由", _migration_model_routing),
+    (8, "生成记录与统计汇总", _migration_generation_log),
+    (9, "图片冷存储", _migration_image_archive),
+    (10, "原图无损重新压缩", _migration_image_recompression),
+    (11, "会话元数据延迟写入", _migration_session_pending_writes),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+MIGRATION_LOCK_TIMEOUT = 600  # 等待其他进程执行迁移的最长时间（秒）
+
+
+def _schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db():
+    """
+    初始化/升级数据库结构
+    版本已是最新时只有一次 PRAGMA user_version 查询；否则在文件锁内逐个执行未完成的迁移，
+    多个 worker 同时启动时只有一个执行，其余等待后直接返回。每个迁移与版本号在同一事务中提交
+    """
+    os.makedirs(os.path.dirname(DATABASE_FILE), exist_ok=True)
+    conn = get_db_connection()
+    try:
+        version = _schema_version(conn)
+    finally:
+        conn.close()
+    if version >= SCHEMA_VERSION:
+        return
+
+    with FileLock(DATABASE_FILE + ".migrate.lock", timeout=MIGRATION_LOCK_TIMEOUT):
+        conn = get_db_connection()
+        try:
+            # 启用 WAL 模式提升并发性能（数据库级别持久设置，不能在事务中修改）
+            conn.execute("PRAGMA journal_mode=WAL")
+            version = _schema_version(conn)
+            for number, description, migrate in SCHEMA_MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info(f"执行数据库迁移 {number}: {description}")
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    migrate(conn)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    logger.error(f"数据库迁移 {number} 失败，已回滚")
+                    raise
+        finally:
+            conn.close()
 
 
 def create_user(username, password, email=None):
@@ -200,15 +662,21 @@ def create_user(username, password, email=None):
         if not re.match(email_pattern, email):
             return False, "邮箱格式不正确", None
     
+    # 先在事务外计算哈希，避免慢哈希期间占用数据库连接
+    password_hash = hash_secret("password", password)
     try:
         with get_db() as conn:
             cursor = conn.cursor()
-            password_hash = generate_password_hash(password)
             cursor.execute(
                 "INSERT INTO users (username, email, password_hash, is_admin, credits) VALUES (?, ?, ?, ?, ?)",
                 (username, email, password_hash, 0, 4)
             )
             user_id = cursor.lastrowid
+            # 新用户没有会话，直接写入零值用量记录（按用量排序的列表以 user_usage 为驱动表）
+            cursor.execute(
+                "INSERT OR IGNORE INTO user_usage (user_id, updated_at) VALUES (?, ?)",
+                (user_id, datetime.now().isoformat())
+            )
             return True, "注册成功", user_id
     except sqlite3.IntegrityError as e:
         if 'email' in str(e):
@@ -230,7 +698,15 @@ def verify_user(username, password):
     if user is None:
         return False, "用户名或密码错误", None
     
-    if check_password_hash(user["password_hash"], password):
+    matched, new_hash = verify_secret("password", user["password_hash"], password)
+    if matched:
+        if new_hash:
+            # 哈希参数已调整，登录成功时透明升级存储的哈希
+            with get_db() as conn:
+                conn.execute(
+                    "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                    (new_hash, user["id"], user["password_hash"])
+                )
         return True, "登录成功", {
             "id": user["id"],
             "username": user["username"],
@@ -247,7 +723,7 @@ def get_user_by_id(user_id):
     with get_db() as conn:
         cursor = conn.cursor()
         
-        cursor.execute("SELECT id, username, is_admin, credits, created_at FROM users WHERE id = ?", (user_id,))
+        cursor.execute("SELECT id, username, is_admin, credits, model_fallback, created_at FROM users WHERE id = ?", (user_id,))
         user = cursor.fetchone()
     
     if user:
@@ -256,26 +732,588 @@ def get_user_by_id(user_id):
             "username": user["username"],
             "is_admin": user["is_admin"] == 1,
             "credits": user["credits"],
+            "model_fallback": user["model_fallback"] == 1,
             "created_at": user["created_at"]
         }
     return None
 
 
-def get_all_users():
-    """获取所有用户列表（管理员功能）"""
+# 管理员用户列表允许的排序字段（白名单，防止 SQL 注入）
+# 值为 (排序列, 同值时的次序列)；用量字段以 user_usage 为驱动表，才能使用其上的索引
+USER_SORT_COLUMNS = {
+    "id": ("u.id", None),
+    "username": ("u.username", None),
+    "credits": ("u.credits", "u.id"),
+    "created_at": ("u.created_at", "u.id"),
+    "session_count": ("uu.session_count", "uu.user_id"),
+    "message_count": ("uu.message_count", "uu.user_id"),
+    "image_count": ("uu.image_count", "uu.user_id"),
+    "image_bytes": ("uu.image_bytes", "uu.user_id"),
+    "generation_count": ("uu.generation_count", "uu.user_id"),
+    "credits_spent": ("uu.credits_spent", "uu.user_id"),
+}
+
+
+def encode_cursor(values):
+    """把键集分页的位置编码为不透明的游标字符串"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size):
+    """解析游标，格式不正确时抛出 ValueError"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("无效的分页游标")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("无效的分页游标")
+    return values
+
+
+def _keyset_condition(columns, direction, values):
+    """(a, b) < (?, ?) 形式的键集条件（SQLite 行值比较，可以使用 (a, b) 上的索引）"""
+    op = ">" if direction == "ASC" else "<"
+    if len(columns) == 1:
+        return f"{columns[0]} {op} ?", list(values)
+    return f"({', '.join(columns)}) {op} ({', '.join('?' for _ in columns)})", list(values)
+
+
+def _usage_dict(row):
+    """把包含用量字段的查询结果转换为字典"""
+    return {
+        "id": row["id"],
+        "username": row["username"],
+        "is_admin": row["is_admin"] == 1,
+        "credits": row["credits"],
+        "created_at": row["created_at"],
+        "session_count": row["session_count"],
+        "message_count": row["message_count"],
+        "image_count": row["image_count"],
+        "image_bytes": row["image_bytes"],
+        "generation_count": row["generation_count"],
+        "credits_spent": row["credits_spent"],
+    }
+
+
+def get_users_page(page_size=50, sort="created_at", order="desc", query=None, role=None,
+                   created_from=None, created_to=None, cursor=None):
+    """
+    键集分页获取用户列表及用量计数（管理员功能，单次 JOIN 查询，不读取会话文件）
+    query: 按用户名/邮箱前缀搜索，纯数字时同时匹配用户 ID
+    role: "admin" / "user"；created_from / created_to: 注册日期范围（YYYY-MM-DD，含两端）
+    cursor: 上一页返回的 next_cursor，格式不正确时抛出 ValueError
+    按用量字段排序时以 user_usage 为驱动表，尚未回填用量记录的老用户不会出现（启动回填完成后即完整）
+    返回: (users: list, total: int, next_cursor: str 或 None)
+    """
+    sort_column, tiebreak = USER_SORT_COLUMNS.get(sort, USER_SORT_COLUMNS["created_at"])
+    direction = "ASC" if str(order).lower() == "asc" else "DESC"
+    page_size = max(1, min(200, int(page_size)))
+    order_columns = [sort_column] + ([tiebreak] if tiebreak else [])
+
+    conditions = []
+    params = []
+    if query:
+        # 前缀范围查询可以使用 username/email 上的唯一索引
+        upper = query + "\uffff"
+        search = "(u.username >= ? AND u.username < ?) OR (u.email >= ? AND u.email < ?)"
+        params += [query, upper, query, upper]
+        if query.isdigit():
+            search += " OR u.id = ?"
+            params.append(int(query))
+        conditions.append(f"({search})")
+    if role in ("admin", "user"):
+        conditions.append("u.is_admin = ?")
+        params.append(1 if role == "admin" else 0)
+    if created_from:
+        conditions.append("u.created_at >= ?")
+        params.append(created_from)
+    if created_to:
+        conditions.append("u.created_at < date(?, '+1 day')")
+        params.append(created_to)
+
+    if sort_column.startswith("uu."):
+        from_clause = "FROM user_usage uu JOIN users u ON u.id = uu.user_id"
+    else:
+        from_clause = "FROM users u LEFT JOIN user_usage uu ON uu.user_id = u.id"
+
+    with get_db() as conn:
+        count_where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        count_from = from_clause if sort_column.startswith("uu.") else "FROM users u"
+        total = conn.execute(f"SELECT COUNT(*) {count_from} {count_where}", params).fetchone()[0]
+
+        page_conditions = list(conditions)
+        page_params = list(params)
+        if cursor:
+            condition, values = _keyset_condition(order_columns, direction, decode_cursor(cursor, len(order_columns)))
+            page_conditions.append(condition)
+            page_params += values
+        where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+
+        rows = conn.execute(f'''
+            SELECT u.id, u.username, u.is_admin, u.credits, u.created_at,
+                   COALESCE(uu.session_count, 0) AS session_count,
+                   COALESCE(uu.message_count, 0) AS message_count,
+                   COALESCE(uu.image_count, 0) AS image_count,
+                   COALESCE(uu.image_bytes, 0) AS image_bytes,
+                   COALESCE(uu.generation_count, 0) AS generation_count,
+                   COALESCE(uu.credits_spent, 0) AS credits_spent,
+                   {sort_column} AS sort_value
+            {from_clause}
+            {where}
+            ORDER BY {", ".join(f"{column} {direction}" for column in order_columns)}
+            LIMIT ?
+        ''', page_params + [page_size + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor([last["sort_value"], last["id"]][:len(order_columns)])
+    return [_usage_dict(row) for row in rows], total, next_cursor
+
+
+def get_usage_stats():
+    """获取全站用量汇总（管理员统计卡片）"""
     with get_db() as conn:
         cursor = conn.cursor()
-        
-        cursor.execute("SELECT id, username, is_admin, credits, created_at FROM users ORDER BY created_at DESC")
-        users = cursor.fetchall()
-    
+        cursor.execute("SELECT COUNT(*) AS users, COALESCE(SUM(is_admin = 1), 0) AS admins FROM users")
+        user_row = cursor.fetchone()
+        cursor.execute('''
+            SELECT COALESCE(SUM(session_count), 0) AS sessions,
+                   COALESCE(SUM(message_count), 0) AS messages,
+                   COALESCE(SUM(image_count), 0) AS images,
+                   COALESCE(SUM(image_bytes), 0) AS image_bytes,
+                   COALESCE(SUM(generation_count), 0) AS generations,
+                   COALESCE(SUM(credits_spent), 0) AS credits_spent
+            FROM user_usage
+        ''')
+        usage_row = cursor.fetchone()
+
+    return {
+        "total_users": user_row["users"],
+        "total_admins": user_row["admins"],
+        "total_sessions": usage_row["sessions"],
+        "total_messages": usage_row["messages"],
+        "total_images": usage_row["images"],
+        "total_image_bytes": usage_row["image_bytes"],
+        "total_generations": usage_row["generations"],
+        "total_credits_spent": usage_row["credits_spent"],
+    }
+
+
+def _refresh_user_usage(conn, user_id):
+    """由会话索引重新汇总用户的会话/消息/图片计数（按主键前缀查询，只涉及该用户的会话）"""
+    conn.execute('''
+        INSERT INTO user_usage (user_id, session_count, message_count, image_count, image_bytes, updated_at)
+        SELECT ?, COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(image_count), 0),
+               COALESCE(SUM(image_bytes), 0), ?
+        FROM session_index WHERE user_id = ?
+        ON CONFLICT(user_id) DO UPDATE SET
+            session_count = excluded.session_count,
+            message_count = excluded.message_count,
+            image_count = excluded.image_count,
+            image_bytes = excluded.image_bytes,
+            updated_at = excluded.updated_at
+    ''', (user_id, datetime.now().isoformat(), user_id))
+
+
+def _message_id_range(user_id):
+    """用户在 message_index / message_fts 中的行 ID 范围（含两端）"""
+    start = int(user_id) << 32
+    return start, start + 0xFFFFFFFF
+
+
+def _sync_message_index(conn, user_id, session_id, search_entries):
+    """
+    增量同步会话的搜索索引：内容未变的消息只更新位置，新消息插入，已删除的消息移除
+    追加一轮对话时只插入两行，不重建整个会话的索引
+    """
+    rows = conn.execute(
+        "SELECT id, position, role, content, timestamp, image, thumbnail FROM message_index "
+        "WHERE user_id = ? AND session_id = ?",
+        (user_id, session_id)
+    ).fetchall()
+    existing = {}
+    for row in rows:
+        key = (row["role"], row["content"], row["timestamp"], row["image"], row["thumbnail"])
+        existing.setdefault(key, []).append((row["id"], row["position"]))
+
+    new_entries = []
+    for entry in search_entries:
+        key = (entry["role"], entry["content"], entry["timestamp"], entry["image"], entry["thumbnail"])
+        matches = existing.get(key)
+        if matches:
+            row_id, position = matches.pop()
+            if position != entry["position"]:
+                conn.execute("UPDATE message_index SET position = ? WHERE id = ?", (entry["position"], row_id))
+        else:
+            new_entries.append(entry)
+
+    stale_ids = [(row_id,) for matches in existing.values() for row_id, _ in matches]
+    if stale_ids:
+        conn.executemany("DELETE FROM message_index WHERE id = ?", stale_ids)
+
+    if new_entries:
+        start, end = _message_id_range(user_id)
+        last_id = conn.execute(
+            "SELECT MAX(id) FROM message_index WHERE id BETWEEN ? AND ?", (start, end)
+        ).fetchone()[0]
+        next_id = (last_id or start) + 1
+        conn.executemany('''
+            INSERT INTO message_index (id, user_id, session_id, position, role, content, timestamp, image, thumbnail)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (next_id + i, user_id, session_id, entry["position"], entry["role"], entry["content"],
+             entry["timestamp"], entry["image"], entry["thumbnail"])
+            for i, entry in enumerate(new_entries)
+        ])
+
+
+IMAGE_INDEX_COLUMNS = ("position", "image", "thumbnail", "width", "height", "size", "model", "created_at")
+
+
+def _sync_image_index(conn, user_id, session_id, image_entries):
+    """增量同步会话的生成图片索引：只写入新增或变化的图片，删除已不在会话中的图片"""
+    rows = conn.execute(
+        f"SELECT filename, {', '.join(IMAGE_INDEX_COLUMNS)} FROM image_index WHERE user_id = ? AND session_id = ?",
+        (user_id, session_id)
+    ).fetchall()
+    existing = {row["filename"]: tuple(row[column] for column in IMAGE_INDEX_COLUMNS) for row in rows}
+
+    changed = []
+    for entry in image_entries:
+        values = tuple(entry[column] for column in IMAGE_INDEX_COLUMNS)
+        if existing.pop(entry["filename"], None) != values:
+            changed.append((entry["filename"], user_id, session_id) + values)
+    if existing:
+        conn.executemany("DELETE FROM image_index WHERE filename = ?", [(filename,) for filename in existing])
+    if changed:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO image_index (filename, user_id, session_id, {', '.join(IMAGE_INDEX_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(IMAGE_INDEX_COLUMNS) + 3))})",
+            changed
+        )
+
+
+def sync_session_data(user_id, session_id, entry, media_entries, search_entries=None, image_entries=None):
+    """
+    保存会话时在同一事务中同步会话索引、媒体文件索引、搜索索引、图片索引和用户用量计数（结果幂等）
+    entry: {"title", "created_at", "updated_at", "oldest_at", "message_count", "image_count", "image_bytes"}
+    media_entries: [(filename, kind, created_at)]
+    search_entries: [{"position", "role", "content", "timestamp", "image", "thumbnail"}]，None 表示不更新搜索索引
+    image_entries: [{"filename", "position", "image", "thumbnail", "width", "height", "size", "model", "created_at"}]，
+                   None 表示不更新图片索引
+    """
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO session_index (user_id, session_id, title, created_at, updated_at, oldest_at,
+                                       message_count, image_count, image_bytes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, session_id) DO UPDATE SET
+                title = excluded.title,
+                created_at = excluded.created_at,
+                updated_at = excluded.updated_at,
+                oldest_at = excluded.oldest_at,
+                message_count = excluded.message_count,
+                image_count = excluded.image_count,
+                image_bytes = excluded.image_bytes
+        ''', (user_id, session_id, entry["title"], entry["created_at"], entry["updated_at"], entry["oldest_at"],
+              entry["message_count"], entry["image_count"], entry["image_bytes"]))
+
+        conn.execute("DELETE FROM media_files WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+        conn.executemany(
+            "INSERT OR REPLACE INTO media_files (filename, kind, user_id, session_id, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(filename, kind, user_id, session_id, created_at) for filename, kind, created_at in media_entries]
+        )
+        if search_entries is not None:
+            _sync_message_index(conn, user_id, session_id, search_entries)
+        if image_entries is not None:
+            _sync_image_index(conn, user_id, session_id, image_entries)
+        _refresh_user_usage(conn, user_id)
+
+
+def remove_session_data(user_id, session_id):
+    """删除会话时移除其索引记录并更新用户用量计数"""
+    with get_db() as conn:
+        conn.execute("DELETE FROM session_index WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+        conn.execute("DELETE FROM media_files WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+        conn.execute("DELETE FROM message_index WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+        conn.execute("DELETE FROM image_index WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+        _refresh_user_usage(conn, user_id)
+
+
+# ========== 会话元数据延迟写入 ==========
+
+def queue_session_write(user_id, session_id, created=None, title=None, updated_at=None, index_entry=None):
+    """
+    记录会话的延迟写入（与会话索引在同一事务中提交，提交后即可保证不丢失）
+    created: 延迟创建的会话初始数据（JSON 字符串），index_entry 为其索引记录
+    title / updated_at: 延迟写入的元数据，None 表示不修改；同一会话的多次修改合并为一条，保留最早的排队时间
+    返回: 意图记录的版本戳（每次写入都不同）
+    """
+    stamp = time.time_ns()
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO session_pending_writes (user_id, session_id, created, title, updated_at, stamp, queued_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, session_id) DO UPDATE SET
+                created = COALESCE(excluded.created, created),
+                title = COALESCE(excluded.title, title),
+                updated_at = COALESCE(excluded.updated_at, updated_at),
+                stamp = excluded.stamp
+        ''', (user_id, session_id, created, title, updated_at, stamp, stamp / 1e9))
+        if index_entry is not None:
+            conn.execute('''
+                INSERT OR REPLACE INTO session_index (user_id, session_id, title, created_at, updated_at, oldest_at,
+                                                      message_count, image_count, image_bytes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, session_id, index_entry["title"], index_entry["created_at"], index_entry["updated_at"],
+                  index_entry["oldest_at"], index_entry["message_count"], index_entry["image_count"],
+                  index_entry["image_bytes"]))
+            _refresh_user_usage(conn, user_id)
+        else:
+            conn.execute('''
+                UPDATE session_index SET title = COALESCE(?, title), updated_at = COALESCE(?, updated_at)
+                WHERE user_id = ? AND session_id = ?
+            ''', (title, updated_at, user_id, session_id))
+    return stamp
+
+
+def get_session_pending_write(user_id, session_id):
+    """获取会话未写入文件的延迟写入记录，没有时返回 None"""
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT created, title, updated_at, stamp, queued_at FROM session_pending_writes
+            WHERE user_id = ? AND session_id = ?
+        ''', (user_id, session_id)).fetchone()
+    return dict(row) if row else None
+
+
+def get_pending_session_creates(user_id):
+    """列出用户延迟创建、尚未写入文件的会话 ID"""
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT session_id FROM session_pending_writes WHERE user_id = ? AND created IS NOT NULL", (user_id,)
+        ).fetchall()
+    return [row["session_id"] for row in rows]
+
+
+def get_due_session_writes(before, limit):
+    """排队时间早于 before 的延迟写入 [(user_id, session_id)]，按排队时间升序"""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT user_id, session_id FROM session_pending_writes
+            WHERE queued_at <= ? ORDER BY queued_at LIMIT ?
+        ''', (before, limit)).fetchall()
+    return [(row["user_id"], row["session_id"]) for row in rows]
+
+
+def clear_session_pending_write(user_id, session_id, stamp=None):
+    """删除已写入文件的延迟写入记录；指定 stamp 时只有期间没有新的写入才删除"""
+    with get_db() as conn:
+        if stamp is None:
+            conn.execute("DELETE FROM session_pending_writes WHERE user_id = ? AND session_id = ?",
+                         (user_id, session_id))
+        else:
+            conn.execute("DELETE FROM session_pending_writes WHERE user_id = ? AND session_id = ? AND stamp = ?",
+                         (user_id, session_id, stamp))
+
+
+def get_user_session_list(user_id):
+    """从会话索引获取用户的会话列表（按更新时间倒序）"""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT session_id, title, created_at, updated_at, message_count
+            FROM session_index WHERE user_id = ?
+            ORDER BY updated_at DESC
+        ''', (user_id,)).fetchall()
     return [{
-        "id": user["id"],
-        "username": user["username"],
-        "is_admin": user["is_admin"] == 1,
-        "credits": user["credits"],
-        "created_at": user["created_at"]
-    } for user in users]
+        "id": row["session_id"],
+        "title": row["title"] or "新对话",
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "message_count": row["message_count"]
+    } for row in rows]
+
+
+# 搜索结果摘要中的高亮标记（控制字符不会出现在正常文本中，由调用方转义 HTML 后替换为 <mark>）
+SEARCH_HIGHLIGHT_START = "\x02"
+SEARCH_HIGHLIGHT_END = "\x03"
+SEARCH_SNIPPET_CHARS = 60  # 摘要的字符数
+SEARCH_MIN_TERM_LENGTH = 3  # trigram 索引只能匹配不少于 3 个字符的词
+SEARCH_CANDIDATES = 500  # 参与排序的最近匹配消息数上限
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+
+
+def _search_terms(query):
+    """按空白拆分搜索词（去重，保持顺序）"""
+    terms = []
+    for term in query.split():
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+
+def _message_fts_available(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+    ).fetchone() is not None
+
+
+def _search_snippet(content, terms):
+    """截取第一个匹配附近的文字，并标记所有匹配"""
+    lower = content.lower()
+    positions = [lower.find(term.lower()) for term in terms]
+    first = min((p for p in positions if p >= 0), default=0)
+    start = max(0, first - SEARCH_SNIPPET_CHARS // 3)
+    end = start + SEARCH_SNIPPET_CHARS
+    text = content[start:end]
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    text = pattern.sub(lambda m: f"{SEARCH_HIGHLIGHT_START}{m.group(0)}{SEARCH_HIGHLIGHT_END}", text)
+    return ("…" if start > 0 else "") + text + ("…" if end < len(content) else "")
+
+
+def _rank_candidates(rows, terms):
+    """
+    按 bm25 的词频饱和与长度归一化给候选消息打分，同分时较新的在前
+    候选消息都包含全部搜索词，各词的 IDF 对相对顺序影响很小，因此不使用 FTS5 的 rank：
+    rank 需要统计每个词在全部用户消息中的文档频率，常见词在二十多万条消息时单次约 20ms
+    """
+    if not rows:
+        return []
+    lowered_terms = [term.lower() for term in terms]
+    avg_length = sum(len(row["content"]) for row in rows) / len(rows) or 1
+
+    def score(row):
+        content = row["content"].lower()
+        norm = 1 - SEARCH_BM25_B + SEARCH_BM25_B * len(content) / avg_length
+        total = 0.0
+        for term in lowered_terms:
+            tf = content.count(term)
+            total += tf * (SEARCH_BM25_K1 + 1) / (tf + SEARCH_BM25_K1 * norm)
+        return total
+
+    return sorted(rows, key=lambda row: (-score(row), -row["id"]))
+
+
+def search_messages(user_id, query, limit=20):
+    """
+    搜索用户的提示词和模型文字回复（全部搜索词都要匹配，不区分大小写）
+    所有搜索词都不少于 3 个字符时用 FTS5 全文索引查找，否则（或全文索引不可用时）按子串扫描；
+    两种方式都用 rowid 范围限定在该用户的消息内，取最近的 SEARCH_CANDIDATES 条匹配按相关度排序
+    返回: [{"session_id", "session_title", "position", "role", "snippet", "timestamp", "image", "thumbnail"}]
+          snippet 中的匹配部分用 SEARCH_HIGHLIGHT_START / SEARCH_HIGHLIGHT_END 包围
+    """
+    terms = _search_terms(query)
+    if not terms:
+        return []
+    start, end = _message_id_range(user_id)
+    with get_db() as conn:
+        if all(len(term) >= SEARCH_MIN_TERM_LENGTH for term in terms) and _message_fts_available(conn):
+            match = " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            rows = conn.execute('''
+                SELECT m.*, s.title
+                FROM message_fts
+                JOIN message_index m ON m.id = message_fts.rowid
+                LEFT JOIN session_index s ON s.user_id = m.user_id AND s.session_id = m.session_id
+                WHERE message_fts MATCH ? AND message_fts.rowid BETWEEN ? AND ?
+                ORDER BY message_fts.rowid DESC
+                LIMIT ?
+            ''', (match, start, end, SEARCH_CANDIDATES)).fetchall()
+        else:
+            conditions = " AND ".join("instr(lower(m.content), ?) > 0" for _ in terms)
+            rows = conn.execute(f'''
+                SELECT m.*, s.title
+                FROM message_index m
+                LEFT JOIN session_index s ON s.user_id = m.user_id AND s.session_id = m.session_id
+                WHERE m.id BETWEEN ? AND ? AND {conditions}
+                ORDER BY m.id DESC
+                LIMIT ?
+            ''', [start, end] + [term.lower() for term in terms] + [SEARCH_CANDIDATES]).fetchall()
+
+    return [{
+        "session_id": row["session_id"],
+        "session_title": row["title"] or "新对话",
+        "position": row["position"],
+        "role": row["role"],
+        "snippet": _search_snippet(row["content"], terms),
+        "timestamp": row["timestamp"],
+        "image": row["image"],
+        "thumbnail": row["thumbnail"]
+    } for row in _rank_candidates(rows, terms)[:limit]]
+
+
+def get_gallery_page(user_id, limit=60, cursor=None):
+    """
+    按时间倒序获取用户的生成图片（键集分页，只查询图片索引）
+    cursor: 上一页返回的 next_cursor，格式不正确时抛出 ValueError
+    返回: (images: list, next_cursor: str 或 None)
+    """
+    conditions = ["i.user_id = ?"]
+    params = [user_id]
+    if cursor:
+        condition, values = _keyset_condition(["i.created_at", "i.filename"], "DESC", decode_cursor(cursor, 2))
+        conditions.append(condition)
+        params += values
+    with get_db() as conn:
+        rows = conn.execute(f'''
+            SELECT i.*, s.title
+            FROM image_index i
+            LEFT JOIN session_index s ON s.user_id = i.user_id AND s.session_id = i.session_id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY i.created_at DESC, i.filename DESC
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]["created_at"], rows[-1]["filename"]])
+
+    return [{
+        "image": row["image"],
+        "thumbnail": row["thumbnail"],
+        "width": row["width"],
+        "height": row["height"],
+        "size": row["size"],
+        "model": row["model"],
+        "session_id": row["session_id"],
+        "session_title": row["title"] or "新对话",
+        "position": row["position"],
+        "created_at": row["created_at"]
+    } for row in rows], next_cursor
+
+
+def count_indexed_messages():
+    """搜索索引中的消息数"""
+    with get_db() as conn:
+        return conn.execute("SELECT COUNT(*) FROM message_index").fetchone()[0]
+
+
+def record_generation_usage(user_id, credits_spent):
+    """记录一次成功的生成（累计生成次数和消耗点数）"""
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO user_usage (user_id, generation_count, credits_spent, updated_at)
+            VALUES (?, 1, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                generation_count = generation_count + 1,
+                credits_spent = credits_spent + excluded.credits_spent,
+                updated_at = excluded.updated_at
+        ''', (user_id, credits_spent, datetime.now().isoformat()))
+
+
+def get_user_ids_without_usage():
+    """获取还没有用量计数记录的用户 ID（用于一次性回填）"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.id FROM users u
+            LEFT JOIN user_usage uu ON uu.user_id = u.id
+            WHERE uu.user_id IS NULL
+        ''')
+        return [row["id"] for row in cursor.fetchall()]
 
 
 def delete_user(user_id):
@@ -289,6 +1327,16 @@ def delete_user(user_id):
         if user and user["is_admin"] == 1:
             return False, "不能删除管理员账号"
         
+        cursor.execute("DELETE FROM user_usage WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM session_index WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM media_files WHERE user_id = ?", (user_id,))
+        start, end = _message_id_range(user_id)
+        cursor.execute("DELETE FROM message_index WHERE id BETWEEN ? AND ?", (start, end))
+        cursor.execute("DELETE FROM image_index WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM model_routing_log WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM generations WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM generation_user_rollups WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM session_pending_writes WHERE user_id = ?", (user_id,))
         cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
     return True, "用户已删除"
 
@@ -314,6 +1362,12 @@ def toggle_admin(user_id):
     return True, "管理员" if new_status == 1 else "普通用户"
 
 
+def set_user_model_fallback(user_id, enabled):
+    """设置用户是否允许在所选模型繁忙时自动切换到更快的模型"""
+    with get_db() as conn:
+        conn.execute("UPDATE users SET model_fallback = ? WHERE id = ?", (1 if enabled else 0, user_id))
+
+
 def update_user_credits(user_id, amount):
     """更新用户点数（增加或减少）"""
     with get_db() as conn:
@@ -342,7 +1396,88 @@ def generate_card_key_code(length=16):
     return ''.join(secrets.choice(chars) for _ in range(length))
 
 
-def generate_card_keys(credits, count):
+CARD_KEY_CHUNK_SIZE = 1000  # 批量生成时每组的数量（每组一个短事务）
+
+
+def _fast_hash(code):
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def create_card_key_batch(credits, count, label=None, created_by=None):
+    """创建卡密批次记录，返回批次 ID"""
+    with get_db() as conn:
+        cursor = conn.execute(
+            "INSERT INTO card_key_batches (label, credits, requested_count, created_by, created_at) VALUES (?, ?, ?, ?, ?)",
+            (label, credits, count, created_by, datetime.now().isoformat())
+        )
+        return cursor.lastrowid
+
+
+def _insert_card_key_chunk(batch_id, credits, count):
+    """
+    生成并写入一组卡密，返回明文卡密列表
+    慢哈希在事务外并行计算；写入时先放入临时表，再用一条 INSERT OR IGNORE ... SELECT
+    依靠 fast_hash 唯一索引去重，与已有卡密冲突的（极少）重新生成
+    """
+    codes = []
+    while len(codes) < count:
+        candidates = list({generate_card_key_code() for _ in range(count - len(codes))})
+        code_hashes = hash_many("card_key", candidates)
+        rows = [(code_hash, code[:4], _fast_hash(code)) for code, code_hash in zip(candidates, code_hashes)]
+
+        with get_db() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS card_key_staging (code_hash TEXT, code_prefix TEXT, fast_hash TEXT)")
+            conn.executemany("INSERT INTO card_key_staging VALUES (?, ?, ?)", rows)
+            conn.execute('''
+                INSERT OR IGNORE INTO card_keys (code_hash, code_prefix, fast_hash, credits, batch_id)
+                SELECT code_hash, code_prefix, fast_hash, ?, ? FROM card_key_staging
+            ''', (credits, batch_id))
+            inserted = {row[0] for row in conn.execute('''
+                SELECT s.fast_hash FROM card_key_staging s
+                JOIN card_keys ck ON ck.code_hash = s.code_hash
+            ''')}
+            conn.execute("DROP TABLE card_key_staging")
+            conn.execute(
+                "UPDATE card_key_batches SET generated_count = generated_count + ? WHERE id = ?",
+                (len(inserted), batch_id)
+            )
+
+        codes.extend(code for code, row in zip(candidates, rows) if row[2] in inserted)
+    return codes
+
+
+def generate_card_key_batch(batch_id, credits, count, chunk_size=CARD_KEY_CHUNK_SIZE):
+    """
+    分组生成一个批次的卡密（生成器），每组写入后产出该组的明文卡密列表
+    全部生成完成后批次标记为 completed；调用方中途停止时应调用 abort_card_key_batch
+    """
+    remaining = count
+    while remaining > 0:
+        codes = _insert_card_key_chunk(batch_id, credits, min(chunk_size, remaining))
+        remaining -= len(codes)
+        yield codes
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE card_key_batches SET status = 'completed', completed_at = ? WHERE id = ?",
+            (datetime.now().isoformat(), batch_id)
+        )
+
+
+def abort_card_key_batch(batch_id):
+    """批次未完整交付（如导出中断）：标记为 incomplete 并作废已写入的卡密，明文可能没有送达管理员"""
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE card_key_batches SET status = 'incomplete', revoked_at = ?, revoke_reason = ? WHERE id = ?",
+            (now, "export_incomplete", batch_id)
+        )
+        conn.execute(
+            "UPDATE card_keys SET revoked_at = ? WHERE batch_id = ? AND is_used = 0 AND revoked_at IS NULL",
+            (now, batch_id)
+        )
+
+
+def generate_card_keys(credits, count, label=None, created_by=None):
     """
     批量生成卡密
     返回: (success: bool, message: str, keys: list)
@@ -352,56 +1487,131 @@ def generate_card_keys(credits, count):
         return False, "点数必须大于0", []
     if count <= 0 or count > 100:
         return False, "数量必须在1-100之间", []
-    
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        generated_keys = []
-        for _ in range(count):
-            # 生成唯一卡密码（明文）
-            while True:
-                code = generate_card_key_code()
-                # 用 SHA256 做快速查找索引
-                fast_hash = hashlib.sha256(code.encode()).hexdigest()
-                # 检查是否已存在（用快速哈希检查）
-                cursor.execute("SELECT id FROM card_keys WHERE fast_hash = ?", (fast_hash,))
-                if cursor.fetchone() is None:
-                    break
-            
-            # bcrypt 哈希用于安全验证
-            code_hash = generate_password_hash(code)
-            # 提取前缀（前4位）用于管理员识别
-            code_prefix = code[:4]
-            
-            # 存储哈希值、快速索引和前缀
-            cursor.execute(
-                "INSERT INTO card_keys (code_hash, code_prefix, fast_hash, credits) VALUES (?, ?, ?, ?)",
-                (code_hash, code_prefix, fast_hash, credits)
-            )
-            
-            # 返回明文卡密给管理员（只在生成时显示）
-            generated_keys.append({
-                "code": code,  # 明文卡密，只在此次返回
-                "code_prefix": code_prefix,
-                "credits": credits
-            })
-    
+
+    batch_id = create_card_key_batch(credits, count, label, created_by)
+    codes = [code for chunk in generate_card_key_batch(batch_id, credits, count) for code in chunk]
+
+    # 返回明文卡密给管理员（只在生成时显示）
+    generated_keys = [{
+        "code": code,  # 明文卡密，只在此次返回
+        "code_prefix": code[:4],
+        "credits": credits,
+        "batch_id": batch_id
+    } for code in codes]
     return True, f"成功生成 {count} 张卡密", generated_keys
 
 
-def get_all_card_keys():
-    """获取所有卡密列表（管理员功能）"""
+def revoke_card_key_batch(batch_id, revoked_by=None, reason=None):
+    """
+    作废整个批次中尚未使用的卡密
+    返回: (success: bool, message: str, revoked_count: int)
+    """
+    now = datetime.now().isoformat()
     with get_db() as conn:
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT ck.id, ck.code_prefix, ck.credits, ck.is_used, ck.used_by, ck.used_at, ck.created_at, u.username
+        batch = conn.execute("SELECT id FROM card_key_batches WHERE id = ?", (batch_id,)).fetchone()
+        if batch is None:
+            return False, "批次不存在", 0
+        cursor = conn.execute(
+            "UPDATE card_keys SET revoked_at = ? WHERE batch_id = ? AND is_used = 0 AND revoked_at IS NULL",
+            (now, batch_id)
+        )
+        revoked = cursor.rowcount
+        conn.execute(
+            "UPDATE card_key_batches SET revoked_at = COALESCE(revoked_at, ?), revoked_by = ?, revoke_reason = ? WHERE id = ?",
+            (now, revoked_by, reason, batch_id)
+        )
+    logger.info(f"卡密批次 #{batch_id} 已作废 {revoked} 张未使用卡密")
+    return True, f"已作废 {revoked} 张卡密", revoked
+
+
+def get_card_key_batches(limit=50):
+    """获取最近的卡密批次及使用情况（管理员审计）"""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT b.*, u.username AS created_by_username,
+                   (SELECT COUNT(*) FROM card_keys WHERE batch_id = b.id AND is_used = 1) AS used_count,
+                   (SELECT COUNT(*) FROM card_keys WHERE batch_id = b.id AND is_used = 0 AND revoked_at IS NOT NULL) AS revoked_count
+            FROM card_key_batches b
+            LEFT JOIN users u ON b.created_by = u.id
+            ORDER BY b.id DESC LIMIT ?
+        ''', (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+CARD_KEY_STATUSES = {
+    "used": "ck.is_used = 1",
+    "unused": "ck.is_used = 0 AND ck.revoked_at IS NULL",
+    "revoked": "ck.is_used = 0 AND ck.revoked_at IS NOT NULL",
+}
+
+
+def get_card_keys_page(limit=50, status=None, batch_id=None, prefix=None, created_from=None,
+                       created_to=None, redeemer=None, cursor=None):
+    """
+    键集分页获取卡密列表（管理员功能，按 id 倒序）
+    status: used / unused / revoked；prefix: 卡密前缀（输入完整 16 位卡密时按快速哈希精确查找）
+    created_from / created_to: 创建日期范围（YYYY-MM-DD，含两端）；redeemer: 使用者用户名或用户 ID
+    cursor: 上一页返回的 next_cursor，格式不正确时抛出 ValueError
+    返回: (keys: list, total: int, next_cursor: str 或 None)
+    """
+    limit = max(1, min(200, int(limit)))
+    conditions = []
+    params = []
+    if status in CARD_KEY_STATUSES:
+        conditions.append(CARD_KEY_STATUSES[status])
+    if batch_id is not None:
+        conditions.append("ck.batch_id = ?")
+        params.append(int(batch_id))
+    if prefix:
+        prefix = prefix.strip().upper().replace("-", "")
+        if len(prefix) >= 16:
+            conditions.append("ck.fast_hash = ?")
+            params.append(_fast_hash(prefix[:16]))
+        else:
+            # 只存储了前 4 位，更长的前缀按前 4 位匹配
+            prefix = prefix[:4]
+            conditions.append("ck.code_prefix >= ? AND ck.code_prefix < ?")
+            params += [prefix, prefix + "\uffff"]
+    if created_from:
+        conditions.append("ck.created_at >= ?")
+        params.append(created_from)
+    if created_to:
+        conditions.append("ck.created_at < date(?, '+1 day')")
+        params.append(created_to)
+    if redeemer:
+        redeemer = str(redeemer).strip()
+        if redeemer.isdigit():
+            conditions.append("ck.used_by IN (?, (SELECT id FROM users WHERE username = ?))")
+            params += [int(redeemer), redeemer]
+        else:
+            conditions.append("ck.used_by = (SELECT id FROM users WHERE username = ?)")
+            params.append(redeemer)
+
+    with get_db() as conn:
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        total = conn.execute(f"SELECT COUNT(*) FROM card_keys ck {where}", params).fetchone()[0]
+
+        page_conditions = list(conditions)
+        page_params = list(params)
+        if cursor:
+            page_conditions.append("ck.id < ?")
+            page_params.append(int(decode_cursor(cursor, 1)[0]))
+        where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+        keys = conn.execute(f'''
+            SELECT ck.id, ck.code_prefix, ck.credits, ck.is_used, ck.used_by, ck.used_at, ck.created_at,
+                   ck.batch_id, ck.revoked_at, u.username
             FROM card_keys ck
             LEFT JOIN users u ON ck.used_by = u.id
-            ORDER BY ck.created_at DESC
-        ''')
-        keys = cursor.fetchall()
-    
+            {where}
+            ORDER BY ck.id DESC
+            LIMIT ?
+        ''', page_params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(keys) > limit:
+        keys = keys[:limit]
+        next_cursor = encode_cursor([keys[-1]["id"]])
+
     return [{
         "id": key["id"],
         "code_prefix": key["code_prefix"],  # 只返回前缀，不返回完整卡密
@@ -410,15 +1620,38 @@ def get_all_card_keys():
         "used_by": key["used_by"],
         "used_by_username": key["username"],
         "used_at": key["used_at"],
-        "created_at": key["created_at"]
-    } for key in keys]
+        "created_at": key["created_at"],
+        "batch_id": key["batch_id"],
+        "is_revoked": key["revoked_at"] is not None
+    } for key in keys], total, next_cursor
+
+
+def get_card_key_stats():
+    """卡密汇总统计（按状态分组计数，扫描 (is_used, revoked_at) 索引）"""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT is_used, revoked_at IS NOT NULL AS revoked, COUNT(*) AS count, COALESCE(SUM(credits), 0) AS credits
+            FROM card_keys GROUP BY is_used, revoked
+        ''').fetchall()
+    stats = {"total": 0, "unused": 0, "used": 0, "revoked": 0, "unused_credits": 0, "redeemed_credits": 0}
+    for row in rows:
+        stats["total"] += row["count"]
+        if row["is_used"] == 1:
+            stats["used"] += row["count"]
+            stats["redeemed_credits"] += row["credits"]
+        elif row["revoked"]:
+            stats["revoked"] += row["count"]
+        else:
+            stats["unused"] += row["count"]
+            stats["unused_credits"] += row["credits"]
+    return stats
 
 
 def use_card_key(code, user_id):
     """
     使用卡密充值
     返回: (success: bool, message: str, new_credits: int)
-    使用 SHA256 快速索引定位卡密，再用 bcrypt 验证，避免全表扫描
+    使用 SHA256 快速索引定位卡密，再用慢哈希验证，避免全表扫描
     """
     if not code or not code.strip():
         return False, "请输入卡密", 0
@@ -432,15 +1665,15 @@ def use_card_key(code, user_id):
         cursor = conn.cursor()
         
         # 用 fast_hash 精确定位（O(1) 查找，不再全表扫描）
-        cursor.execute("SELECT * FROM card_keys WHERE is_used = 0 AND fast_hash = ?", (fast_hash,))
+        cursor.execute("SELECT * FROM card_keys WHERE is_used = 0 AND revoked_at IS NULL AND fast_hash = ?", (fast_hash,))
         candidate = cursor.fetchone()
         
         if candidate is None:
             # 兼容旧数据（没有 fast_hash 的卡密，回退到遍历方式）
-            cursor.execute("SELECT * FROM card_keys WHERE is_used = 0 AND fast_hash IS NULL")
+            cursor.execute("SELECT * FROM card_keys WHERE is_used = 0 AND revoked_at IS NULL AND fast_hash IS NULL")
             old_keys = cursor.fetchall()
             for key in old_keys:
-                if check_password_hash(key["code_hash"], code):
+                if verify_secret("card_key", key["code_hash"], code)[0]:
                     candidate = key
                     # 补充 fast_hash 以加速后续查找
                     cursor.execute("UPDATE card_keys SET fast_hash = ? WHERE id = ?", (fast_hash, key["id"]))
@@ -449,17 +1682,20 @@ def use_card_key(code, user_id):
         if candidate is None:
             return False, "卡密不存在或已被使用", 0
         
-        # 用 bcrypt 做最终安全验证
-        if not check_password_hash(candidate["code_hash"], code):
+        # 用慢哈希做最终安全验证
+        if not verify_secret("card_key", candidate["code_hash"], code)[0]:
             return False, "卡密不存在或已被使用", 0
         
         credits_to_add = candidate["credits"]
         
         # 标记卡密为已使用
         cursor.execute(
-            "UPDATE card_keys SET is_used = 1, used_by = ?, used_at = ? WHERE id = ?",
+            "UPDATE card_keys SET is_used = 1, used_by = ?, used_at = ? WHERE id = ? AND is_used = 0 AND revoked_at IS NULL",
             (user_id, datetime.now().isoformat(), candidate["id"])
         )
+        if cursor.rowcount == 0:
+            # 校验期间已被其他请求使用或被作废
+            return False, "卡密不存在或已被使用", 0
         
         # 给用户加点数
         cursor.execute("SELECT credits FROM users WHERE id = ?", (user_id,))
@@ -473,9 +1709,10 @@ def use_card_key(code, user_id):
     return True, f"充值成功！获得 {credits_to_add} 点", new_credits
 
 
-def create_verification_code(email, code_hash, expires_at):
+def create_verification_code(email, code_hash, expires_at, outbox_payload=None):
     """
     创建邮箱验证码记录
+    outbox_payload 不为空时，在同一事务中写入验证码邮件到发件箱
     返回: (success: bool, message: str)
     """
     try:
@@ -485,6 +1722,8 @@ def create_verification_code(email, code_hash, expires_at):
                 "INSERT INTO verification_codes (email, code_hash, expires_at) VALUES (?, ?, ?)",
                 (email, code_hash, expires_at)
             )
+            if outbox_payload is not None:
+                _insert_outbox(conn, "verification_code", email, outbox_payload)
         return True, "验证码已创建"
     except Exception as e:
         return False, f"创建验证码失败: {str(e)}"
@@ -517,7 +1756,7 @@ def verify_email_code(email, code):
             return False, "验证码已过期，请重新获取"
         
         # 验证验证码
-        if check_password_hash(record["code_hash"], code):
+        if verify_secret("verification_code", record["code_hash"], code)[0]:
             # 标记为已使用
             cursor.execute(
                 "UPDATE verification_codes SET used = 1 WHERE id = ?",
@@ -544,8 +1783,673 @@ def cleanup_expired_codes():
     return deleted_count
 
 
-# 应用启动时自动初始化数据库
-init_db()
-# 创建管理员账号
-create_admin_user()
+# ========== 数据保留（Retention）==========
+
+def get_meta(key, default=None):
+    """读取 app_meta 键值"""
+    with get_db() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else default
+
+
+def set_meta(key, value):
+    """写入 app_meta 键值"""
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO app_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value))
+        )
+
+
+def get_expired_session_batch(cutoff, after=None, limit=50):
+    """
+    按时间顺序获取最早消息早于 cutoff 的一批会话（键集分页，可从上次位置继续）
+    after: 上一批最后一行的 (oldest_at, user_id, session_id)
+    返回: [(oldest_at, user_id, session_id)]
+    """
+    with get_db() as conn:
+        if after:
+            rows = conn.execute('''
+                SELECT oldest_at, user_id, session_id FROM session_index
+                WHERE oldest_at < ? AND (oldest_at, user_id, session_id) > (?, ?, ?)
+                ORDER BY oldest_at, user_id, session_id
+                LIMIT ?
+            ''', (cutoff, after[0], after[1], after[2], limit)).fetchall()
+        else:
+            rows = conn.execute('''
+                SELECT oldest_at, user_id, session_id FROM session_index
+                WHERE oldest_at < ?
+                ORDER BY oldest_at, user_id, session_id
+                LIMIT ?
+            ''', (cutoff, limit)).fetchall()
+    return [(row["oldest_at"], row["user_id"], row["session_id"]) for row in rows]
+
+
+def count_expired_sessions(cutoff):
+    """统计最早消息早于 cutoff 的会话数（用于任务进度）"""
+    with get_db() as conn:
+        return conn.execute("SELECT COUNT(*) FROM session_index WHERE oldest_at < ?", (cutoff,)).fetchone()[0]
+
+
+def get_referenced_media(kind, filenames):
+    """返回 filenames 中仍被会话引用的文件名集合"""
+    if not filenames:
+        return set()
+    placeholders = ",".join("?" * len(filenames))
+    with get_db() as conn:
+        rows = conn.execute(
+            f"SELECT filename FROM media_files WHERE kind = ? AND filename IN ({placeholders})",
+            [kind] + list(filenames)
+        ).fetchall()
+    return {row["filename"] for row in rows}
+
+
+def _retention_job_dict(row):
+    """把保留任务行转换为字典"""
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "cutoff": row["cutoff"],
+        "status": row["status"],
+        "phase": row["phase"],
+        "cursor": row["cursor"],
+        "stats": json.loads(row["stats"]) if row["stats"] else {},
+        "total": row["total"],
+        "error": row["error"],
+        "created_by": row["created_by"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def create_retention_job(kind, cutoff, created_by=None, only_if_idle=False):
+    """
+    创建数据保留任务
+    only_if_idle=True 时，如果已有同类型的排队/运行中任务则不创建（多进程下由同一条 SQL 保证原子性）
+    返回: 新任务 ID，未创建时返回 None
+    """
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        if only_if_idle:
+            cursor = conn.execute('''
+                INSERT INTO retention_jobs (kind, cutoff, created_by, created_at, updated_at)
+                SELECT ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM retention_jobs WHERE kind = ? AND status IN ('pending', 'running')
+                )
+            ''', (kind, cutoff, created_by, now, now, kind))
+        else:
+            cursor = conn.execute(
+                "INSERT INTO retention_jobs (kind, cutoff, created_by, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, cutoff, created_by, now, now)
+            )
+        return cursor.lastrowid if cursor.rowcount else None
+
+
+def claim_retention_job(owner, lease_seconds):
+    """
+    认领一个待执行的任务，或租约已过期（执行进程已退出）的运行中任务
+    返回: 任务字典，没有可执行任务时返回 None
+    """
+    now = datetime.now().isoformat()
+    current = time.time()
+    with get_db() as conn:
+        cursor = conn.execute('''
+            UPDATE retention_jobs
+            SET status = 'running', lease_owner = ?, lease_expires = ?,
+                started_at = COALESCE(started_at, ?), updated_at = ?
+            WHERE id = (
+                SELECT id FROM retention_jobs
+                WHERE status = 'pending' OR (status = 'running' AND lease_expires < ?)
+                ORDER BY id LIMIT 1
+            )
+        ''', (owner, current + lease_seconds, now, now, current))
+        if not cursor.rowcount:
+            return None
+        row = conn.execute(
+            "SELECT * FROM retention_jobs WHERE lease_owner = ? AND status = 'running' ORDER BY updated_at DESC LIMIT 1",
+            (owner,)
+        ).fetchone()
+    return _retention_job_dict(row) if row else None
+
+
+def update_retention_job(job_id, owner, lease_seconds, **fields):
+    """
+    保存任务进度并续约（只有持有租约的进程才能更新）
+    返回: False 表示租约已丢失或任务已被取消，执行进程应停止
+    """
+    allowed = {"phase", "cursor", "stats", "total", "status", "error", "finished_at"}
+    updates = {k: v for k, v in fields.items() if k in allowed}
+    if "stats" in updates:
+        updates["stats"] = json.dumps(updates["stats"])
+    updates["updated_at"] = datetime.now().isoformat()
+    updates["lease_expires"] = time.time() + lease_seconds
+
+    assignments = ", ".join(f"{key} = ?" for key in updates)
+    with get_db() as conn:
+        cursor = conn.execute(
+            f"UPDATE retention_jobs SET {assignments} WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            list(updates.values()) + [job_id, owner]
+        )
+        return cursor.rowcount > 0
+
+
+def cancel_retention_job(job_id):
+    """取消排队中或运行中的任务（运行中的任务会在当前批次结束后停止）"""
+    now = datetime.now().isoformat()
+    with get_db() as conn:
+        cursor = conn.execute(
+            "UPDATE retention_jobs SET status = 'cancelled', finished_at = ?, updated_at = ? "
+            "WHERE id = ? AND status IN ('pending', 'running')",
+            (now, now, job_id)
+        )
+        return cursor.rowcount > 0
+
+
+def get_retention_job(job_id):
+    """获取单个保留任务"""
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM retention_jobs WHERE id = ?", (job_id,)).fetchone()
+    return _retention_job_dict(row) if row else None
+
+
+def get_recent_retention_jobs(limit=20, kind=None):
+    """获取最近的保留任务（按创建时间倒序）"""
+    with get_db() as conn:
+        if kind:
+            rows = conn.execute(
+                "SELECT * FROM retention_jobs WHERE kind = ? ORDER BY id DESC LIMIT ?", (kind, limit)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM retention_jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [_retention_job_dict(row) for row in rows]
+
+
+# ==================== 邮件发件箱 ====================
+
+def _insert_outbox(conn, kind, recipient, payload):
+    cursor = conn.execute(
+        "INSERT INTO email_outbox (kind, recipient, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+        (kind, recipient, json.dumps(payload, ensure_ascii=False), time.time(), datetime.now().isoformat())
+    )
+    return cursor.lastrowid
+
+
+def claim_outbox_batch(owner, limit, lease_seconds):
+    """
+    认领一批到期的待发送邮件，或租约已过期（发送进程已退出）的发送中邮件
+    返回: 邮件字典列表（payload 已解析）
+    """
+    current = time.time()
+    with get_db() as conn:
+        cursor = conn.execute('''
+            UPDATE email_outbox
+            SET status = 'sending', lease_owner = ?, lease_expires = ?
+            WHERE id IN (
+                SELECT id FROM email_outbox
+                WHERE (status = 'pending' AND next_attempt_at <= ?)
+                   OR (status = 'sending' AND lease_expires < ?)
+                ORDER BY id LIMIT ?
+            )
+        ''', (owner, current + lease_seconds, current, current, limit))
+        if not cursor.rowcount:
+            return []
+        rows = conn.execute(
+            "SELECT * FROM email_outbox WHERE lease_owner = ? AND status = 'sending' ORDER BY id", (owner,)
+        ).fetchall()
+    messages = []
+    for row in rows:
+        message = dict(row)
+        message["payload"] = json.loads(message["payload"]) if message["payload"] else {}
+        messages.append(message)
+    return messages
+
+
+def mark_outbox_sent(message_id, owner):
+    """标记邮件已发送（清空 payload，其中可能包含明文验证码）"""
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE email_outbox SET status = 'sent', payload = NULL, attempts = attempts + 1, "
+            "lease_owner = NULL, lease_expires = NULL, last_error = NULL, sent_at = ? "
+            "WHERE id = ? AND lease_owner = ?",
+            (datetime.now().isoformat(), message_id, owner)
+        )
+
+
+def mark_outbox_failed(message_id, owner, error, retry_at=None):
+    """
+    记录发送失败
+    retry_at 为下次重试的时间戳；为 None 时放弃发送（清空 payload）
+    """
+    with get_db() as conn:
+        if retry_at is None:
+            conn.execute(
+                "UPDATE email_outbox SET status = 'failed', payload = NULL, attempts = attempts + 1, "
+                "lease_owner = NULL, lease_expires = NULL, last_error = ? WHERE id = ? AND lease_owner = ?",
+                (error[:500], message_id, owner)
+            )
+        else:
+            conn.execute(
+                "UPDATE email_outbox SET status = 'pending', attempts = attempts + 1, next_attempt_at = ?, "
+                "lease_owner = NULL, lease_expires = NULL, last_error = ? WHERE id = ? AND lease_owner = ?",
+                (retry_at, error[:500], message_id, owner)
+            )
+
+
+def purge_outbox(days=7):
+    """删除已发送/已放弃超过指定天数的发件箱记录，返回删除条数"""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    with get_db() as conn:
+        cursor = conn.execute(
+            "DELETE FROM email_outbox WHERE status IN ('sent', 'failed') AND created_at < ?", (cutoff,)
+        )
+        return cursor.rowcount
+
+
+# ==================== 后台调度器 ====================
+
+def acquire_scheduler_lease(owner, lease_seconds):
+    """
+    获取或续约调度器主节点租约（同一时刻只有一个进程持有）
+    返回: True 表示当前进程是主节点
+    """
+    current = time.time()
+    with get_db() as conn:
+        cursor = conn.execute('''
+            INSERT INTO scheduler_leader (id, owner, lease_expires, acquired_at) VALUES (1, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                owner = excluded.owner,
+                lease_expires = excluded.lease_expires,
+                acquired_at = CASE WHEN scheduler_leader.owner = excluded.owner
+                                   THEN scheduler_leader.acquired_at ELSE excluded.acquired_at END
+            WHERE scheduler_leader.owner = excluded.owner OR scheduler_leader.lease_expires < ?
+        ''', (owner, current + lease_seconds, datetime.now().isoformat(), current))
+        return cursor.rowcount > 0
+
+
+def release_scheduler_lease(owner):
+    """主动释放主节点租约（进程退出时调用，其他进程可立即接管）"""
+    with get_db() as conn:
+        conn.execute("UPDATE scheduler_leader SET lease_expires = 0 WHERE id = 1 AND owner = ?", (owner,))
+
+
+def get_scheduler_leader():
+    """获取当前主节点信息，没有有效租约时返回 None"""
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT owner, lease_expires, acquired_at FROM scheduler_leader WHERE id = 1 AND lease_expires >= ?",
+            (time.time(),)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def claim_scheduled_job(name, interval, owner):
+    """
+    认领一次到期的定时任务（距上次开始已超过 interval 秒）
+    同一条 UPDATE 判断并记录开始时间，主节点切换期间也不会重复执行
+    返回: True 表示本进程应执行该任务
+    """
+    current = time.time()
+    with get_db() as conn:
+        conn.execute("INSERT OR IGNORE INTO scheduler_jobs (name) VALUES (?)", (name,))
+        cursor = conn.execute('''
+            UPDATE scheduler_jobs
+            SET last_started_at = ?, last_owner = ?, last_status = 'running'
+            WHERE name = ? AND (last_started_at IS NULL OR last_started_at <= ?)
+        ''', (current, owner, name, current - interval))
+        return cursor.rowcount > 0
+
+
+def record_scheduler_run(name, owner, started_at, duration_ms, status, result=None, error=None):
+    """记录一次定时任务的执行结果（started_at 为时间戳）"""
+    finished_at = started_at + duration_ms / 1000
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO scheduler_runs (job, owner, status, result, error, duration_ms, started_at, finished_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            name, owner, status,
+            json.dumps(result, ensure_ascii=False) if result is not None else None,
+            error[:500] if error else None, duration_ms,
+            datetime.fromtimestamp(started_at).isoformat(), datetime.fromtimestamp(finished_at).isoformat()
+        ))
+        conn.execute(
+            "UPDATE scheduler_jobs SET last_finished_at = ?, last_status = ?, last_duration_ms = ? "
+            "WHERE name = ? AND last_owner = ?",
+            (finished_at, status, duration_ms, name, owner)
+        )
+
+
+def get_scheduler_jobs():
+    """获取所有定时任务的最近执行状态，返回 {任务名: 状态字典}"""
+    with get_db() as conn:
+        rows = conn.execute("SELECT * FROM scheduler_jobs").fetchall()
+    jobs = {}
+    for row in rows:
+        job = dict(row)
+        for key in ("last_started_at", "last_finished_at"):
+            if job[key] is not None:
+                job[key] = datetime.fromtimestamp(job[key]).isoformat()
+        jobs[job["name"]] = job
+    return jobs
+
+
+def get_scheduler_runs(limit=50, job=None):
+    """获取最近的定时任务执行记录（可按任务名筛选）"""
+    with get_db() as conn:
+        if job:
+            rows = conn.execute(
+                "SELECT * FROM scheduler_runs WHERE job = ? ORDER BY id DESC LIMIT ?", (job, limit)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM scheduler_runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    runs = []
+    for row in rows:
+        run = dict(row)
+        run["result"] = json.loads(run["result"]) if run["result"] else None
+        runs.append(run)
+    return runs
+
+
+def purge_scheduler_runs(days=30):
+    """删除超过指定天数的定时任务执行记录，返回删除条数"""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    with get_db() as conn:
+        cursor = conn.execute("DELETE FROM scheduler_runs WHERE started_at < ?", (cutoff,))
+        return cursor.rowcount
+
+
+def record_model_routing(user_id, session_id, requested_model, routed_model, reason, p95_seconds=None, error_rate=None):
+    """记录一次模型路由决策（请求的模型被切换为其他模型）"""
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO model_routing_log
+                (user_id, session_id, requested_model, routed_model, reason, p95_seconds, error_rate, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, session_id, requested_model, routed_model, reason, p95_seconds, error_rate,
+              datetime.now().isoformat()))
+
+
+def get_model_routing_log(limit=50):
+    """获取最近的模型路由决策，以及最近 24 小时按（请求模型, 实际模型）的次数"""
+    since = (datetime.now() - timedelta(days=1)).isoformat()
+    with get_db() as conn:
+        rows = conn.execute("SELECT * FROM model_routing_log ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        counts = conn.execute('''
+            SELECT requested_model, routed_model, COUNT(*) AS count FROM model_routing_log
+            WHERE created_at >= ? GROUP BY requested_model, routed_model
+        ''', (since,)).fetchall()
+    return [dict(row) for row in rows], [dict(row) for row in counts]
+
+
+def purge_model_routing_log(days=30):
+    """删除超过指定天数的模型路由记录，返回删除条数"""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    with get_db() as conn:
+        cursor = conn.execute("DELETE FROM model_routing_log WHERE created_at < ?", (cutoff,))
+        return cursor.rowcount
+
+
+# 生成耗时直方图的区间上限（毫秒），超过最大区间的记为 -1
+GENERATION_LATENCY_BUCKETS_MS = [2000, 5000, 10000, 15000, 20000, 30000, 45000, 60000, 90000, 120000, 180000, 300000]
+
+
+def _latency_bucket(total_ms):
+    for le in GENERATION_LATENCY_BUCKETS_MS:
+        if total_ms <= le:
+            return le
+    return -1
+
+
+def record_generation(entry):
+    """
+    写入一条生成记录，并在同一事务中累加按小时/按天的汇总（模型 × 分辨率、用户 × 天）
+    entry 的字段与 generations 表的列一致，created_at 缺省为当前时间
+    """
+    created_at = entry.get("created_at") or datetime.now().isoformat()
+    success = 1 if entry["outcome"] == "success" else 0
+    total_ms = entry.get("total_ms") or 0
+    upstream_ms = entry.get("upstream_ms") or 0
+    credits = entry.get("credits") or 0
+    image_bytes = entry.get("image_bytes") or 0
+    le = _latency_bucket(total_ms)
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO generations (user_id, session_id, model, requested_model, image_size, aspect_ratio, key_id,
+                                     credits, outcome, error_code, attempts, prepare_ms, upstream_ms, save_ms,
+                                     total_ms, image_bytes, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (entry["user_id"], entry["session_id"], entry["model"], entry.get("requested_model"),
+              entry["image_size"], entry.get("aspect_ratio"), entry.get("key_id"), credits, entry["outcome"],
+              entry.get("error_code"), entry.get("attempts", 1), entry.get("prepare_ms"), entry.get("upstream_ms"),
+              entry.get("save_ms"), entry.get("total_ms"), image_bytes, created_at))
+        for period, bucket in (("hour", created_at[:13]), ("day", created_at[:10])):
+            conn.execute('''
+                INSERT INTO generation_rollups (period, bucket, model, image_size, requests, successes, errors,
+                                                credits, total_ms, upstream_ms, image_bytes)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(period, bucket, model, image_size) DO UPDATE SET
+                    requests = requests + 1,
+                    successes = successes + excluded.successes,
+                    errors = errors + excluded.errors,
+                    credits = credits + excluded.credits,
+                    total_ms = total_ms + excluded.total_ms,
+                    upstream_ms = upstream_ms + excluded.upstream_ms,
+                    image_bytes = image_bytes + excluded.image_bytes
+            ''', (period, bucket, entry["model"], entry["image_size"], success, 1 - success, credits,
+                  total_ms, upstream_ms, image_bytes))
+            conn.execute('''
+                INSERT INTO generation_latency_rollups (period, bucket, model, image_size, le, count)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT(period, bucket, model, image_size, le) DO UPDATE SET count = count + 1
+            ''', (period, bucket, entry["model"], entry["image_size"], le))
+        conn.execute('''
+            INSERT INTO generation_user_rollups (day, user_id, requests, errors, credits, upstream_ms)
+            VALUES (?, ?, 1, ?, ?, ?)
+            ON CONFLICT(day, user_id) DO UPDATE SET
+                requests = requests + 1,
+                errors = errors + excluded.errors,
+                credits = credits + excluded.credits,
+                upstream_ms = upstream_ms + excluded.upstream_ms
+        ''', (created_at[:10], entry["user_id"], 1 - success, credits, upstream_ms))
+
+
+def _latency_quantile(histogram, q):
+    """根据耗时直方图 {le: count} 估算分位数（返回所在区间的上限秒数，超过最大区间时返回 None）"""
+    total = sum(histogram.values())
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    for le in GENERATION_LATENCY_BUCKETS_MS:
+        seen += histogram.get(le, 0)
+        if seen >= rank:
+            return le / 1000
+    return None
 
+
+def get_generation_stats(period="day", since=None):
+    """
+    读取汇总表中的生成统计（不扫描 generations 表）
+    返回 (按时间段的序列, 按模型 × 分辨率的汇总, 整体汇总)，都包含请求数、成功/失败数、点数、平均耗时和 p95
+    """
+    since_bucket = since.isoformat()[:13 if period == "hour" else 10] if since else ""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT * FROM generation_rollups WHERE period = ? AND bucket >= ? ORDER BY bucket
+        ''', (period, since_bucket)).fetchall()
+        hist_rows = conn.execute('''
+            SELECT bucket, model, image_size, le, count FROM generation_latency_rollups
+            WHERE period = ? AND bucket >= ?
+        ''', (period, since_bucket)).fetchall()
+
+    def empty():
+        return {"requests": 0, "successes": 0, "errors": 0, "credits": 0,
+                "total_ms": 0, "upstream_ms": 0, "image_bytes": 0, "histogram": {}}
+
+    series, breakdown, totals = {}, {}, empty()
+    for row in rows:
+        for group in (series.setdefault(row["bucket"], empty()),
+                      breakdown.setdefault((row["model"], row["image_size"]), empty()), totals):
+            for field in ("requests", "successes", "errors", "credits", "total_ms", "upstream_ms", "image_bytes"):
+                group[field] += row[field]
+    for row in hist_rows:
+        for group in (series.get(row["bucket"]), breakdown.get((row["model"], row["image_size"])), totals):
+            if group is not None:
+                group["histogram"][row["le"]] = group["histogram"].get(row["le"], 0) + row["count"]
+
+    def finish(group):
+        histogram = group.pop("histogram")
+        requests = group["requests"]
+        group["error_rate"] = round(group["errors"] / requests, 3) if requests else 0
+        group["avg_seconds"] = round(group.pop("total_ms") / requests / 1000, 1) if requests else None
+        group["avg_upstream_seconds"] = round(group.pop("upstream_ms") / requests / 1000, 1) if requests else None
+        group["p95_seconds"] = _latency_quantile(histogram, 0.95)
+        return group
+
+    return (
+        [dict(finish(group), bucket=bucket) for bucket, group in series.items()],
+        [dict(finish(group), model=model, image_size=image_size)
+         for (model, image_size), group in sorted(breakdown.items())],
+        finish(totals),
+    )
+
+
+def get_top_generation_users(since=None, limit=10):
+    """按消耗点数排序的用户（读取用户 × 天汇总表）"""
+    since_day = since.isoformat()[:10] if since else ""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT r.user_id, u.username, SUM(r.requests) AS requests, SUM(r.errors) AS errors,
+                   SUM(r.credits) AS credits, SUM(r.upstream_ms) AS upstream_ms
+            FROM generation_user_rollups r
+            LEFT JOIN users u ON u.id = r.user_id
+            WHERE r.day >= ?
+            GROUP BY r.user_id
+            ORDER BY credits DESC, upstream_ms DESC
+            LIMIT ?
+        ''', (since_day, limit)).fetchall()
+    return [{
+        "user_id": row["user_id"],
+        "username": row["username"],
+        "requests": row["requests"],
+        "errors": row["errors"],
+        "credits": row["credits"],
+        "upstream_seconds": round(row["upstream_ms"] / 1000, 1),
+    } for row in rows]
+
+
+def purge_generation_log(log_days=90, hourly_days=14):
+    """删除过期的生成记录和小时汇总（按天汇总保留），返回删除的生成记录条数"""
+    now = datetime.now()
+    log_cutoff = (now - timedelta(days=log_days)).isoformat()
+    hour_cutoff = (now - timedelta(days=hourly_days)).isoformat()[:13]
+    with get_db() as conn:
+        cursor = conn.execute("DELETE FROM generations WHERE created_at < ?", (log_cutoff,))
+        deleted = cursor.rowcount
+        conn.execute("DELETE FROM generation_rollups WHERE period = 'hour' AND bucket < ?", (hour_cutoff,))
+        conn.execute("DELETE FROM generation_latency_rollups WHERE period = 'hour' AND bucket < ?", (hour_cutoff,))
+    return deleted
+
+
+def get_archived_image(filename):
+    """获取冷存储中的原图记录，不存在时返回 None"""
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM image_archive WHERE filename = ?", (filename,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_archived_images(filenames):
+    """批量获取冷存储记录 {filename: 记录}"""
+    result = {}
+    filenames = list(filenames)
+    with get_db() as conn:
+        for start in range(0, len(filenames), 500):
+            chunk = filenames[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in conn.execute(f"SELECT * FROM image_archive WHERE filename IN ({placeholders})", chunk):
+                result[row["filename"]] = dict(row)
+    return result
+
+
+def record_archived_image(filename, size, mtime_ns):
+    """记录已复制到冷存储的原图"""
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO image_archive (filename, size, mtime_ns, archived_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET
+                size = excluded.size, mtime_ns = excluded.mtime_ns, archived_at = excluded.archived_at, rehydrated_at = NULL
+        ''', (filename, size, mtime_ns, datetime.now().isoformat()))
+
+
+def mark_image_rehydrated(filename):
+    """记录原图被取回本地的时间（作为最近访问时间，取回后重新计算迁移时间）"""
+    with get_db() as conn:
+        conn.execute("UPDATE image_archive SET rehydrated_at = ? WHERE filename = ?",
+                     (datetime.now().isoformat(), filename))
+
+
+def delete_archived_image(filename):
+    """删除冷存储记录"""
+    with get_db() as conn:
+        conn.execute("DELETE FROM image_archive WHERE filename = ?", (filename,))
+
+
+def get_image_archive_stats():
+    """冷存储中的原图数量和总大小"""
+    with get_db() as conn:
+        row = conn.execute("SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS bytes FROM image_archive").fetchone()
+    return {"archived_files": row["count"], "archived_bytes": row["bytes"]}
+
+
+def get_recompression_candidates(before, limit=20):
+    """获取尚未处理的生成原图（PNG，不含参考图片），按创建时间从旧到新"""
+    with get_db() as conn:
+        rows = conn.execute(r'''
+            SELECT m.filename, m.user_id, m.session_id FROM media_files m
+            WHERE m.kind = 'image' AND m.filename LIKE '%.png' AND m.filename NOT LIKE 'ref\_%' ESCAPE '\'
+              AND m.created_at < ?
+              AND NOT EXISTS (SELECT 1 FROM image_recompression r WHERE r.filename = m.filename)
+            ORDER BY m.created_at
+            LIMIT ?
+        ''', (before, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def record_recompression(filename, new_filename, image_format, status, original_bytes=None, new_bytes=None):
+    """记录原图的重新压缩结果（status: done / skipped / failed）"""
+    with get_db() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO image_recompression
+                (filename, new_filename, format, status, original_bytes, new_bytes, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (filename, new_filename, image_format, status, original_bytes, new_bytes, datetime.now().isoformat()))
+
+
+def get_recompressed_image(filename):
+    """获取已改名（转换格式）的原图记录，用于按原文件名访问"""
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT * FROM image_recompression WHERE filename = ? AND status = 'done' AND new_filename != filename
+        ''', (filename,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_recompression_stats():
+    """重新压缩统计：各状态的文件数，以及已完成文件的压缩前后总大小"""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT status, COUNT(*) AS count, COALESCE(SUM(original_bytes), 0) AS original_bytes,
+                   COALESCE(SUM(new_bytes), 0) AS new_bytes
+            FROM image_recompression GROUP BY status
+        ''').fetchall()
+    stats = {"recompressed": 0, "skipped": 0, "failed": 0, "original_bytes": 0, "bytes_saved": 0}
+    for row in rows:
+        key = "recompressed" if row["status"] == "done" else row["status"]
+        stats[key] = row["count"]
+        if row["status"] == "done":
+            stats["original_bytes"] = row["original_bytes"]
+            stats["bytes_saved"] = row["original_bytes"] - row["new_bytes"]
+    return stats
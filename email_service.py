@@ -1,11 +1,20 @@
 """
 邮件服务模块
 用于发送验证码邮件
+
+请求内只把邮件写入 email_outbox 表，由后台发送线程批量投递：
+- 复用已认证的 SMTP 连接（连接池），避免每封邮件重复 TLS 握手和登录
+- 发送失败按指数退避重试，超过次数或收件人被拒绝时放弃
+- 发件箱持久化在数据库中，进程重启后未发送的邮件会由任一进程继续发送
 """
 
 import smtplib
 import secrets
 import os
+import time
+import uuid
+import random
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
@@ -13,14 +22,120 @@ import logging
 from email.header import Header
 from email.utils import formataddr
 
+from database import claim_outbox_batch, mark_outbox_sent, mark_outbox_failed
+
 # 配置邮箱服务器（从环境变量读取，必须在 .env 中配置）
 EMAIL_SENDER = os.getenv("EMAIL_SENDER", "")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "")
 SMTP_SERVER = os.getenv("SMTP_SERVER", "")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+# 连接加密方式：ssl（SMTP_SSL）、starttls，或 none（仅用于本地测试 SMTP 服务，此时可不配置密码）
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "ssl").lower()
+SMTP_TIMEOUT = int(os.getenv("SMTP_TIMEOUT", 30))
+
+# 连接池
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))  # 最大连接数
+SMTP_IDLE_TIMEOUT = int(os.getenv("SMTP_IDLE_TIMEOUT", 60))  # 空闲超过该秒数的连接复用前先 NOOP 检查
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", 100))  # 单连接发送上限，超过后重连
+
+# 发件箱
+OUTBOX_SENDERS = int(os.getenv("EMAIL_OUTBOX_SENDERS", 1))  # 每个进程的发送线程数
+OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 20))  # 每批认领的邮件数
+OUTBOX_POLL_INTERVAL = float(os.getenv("EMAIL_OUTBOX_POLL_INTERVAL", 2))  # 空闲时检查发件箱的间隔（秒）
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", 5))  # 最大发送次数
+OUTBOX_RETRY_BASE = float(os.getenv("EMAIL_OUTBOX_RETRY_BASE", 5))  # 首次重试间隔（秒），之后每次翻倍
+OUTBOX_RETRY_MAX = 600  # 重试间隔上限（秒）
+OUTBOX_LEASE_SECONDS = 120  # 认领租约，发送进程退出后其他进程可接手
+OUTBOX_PURGE_INTERVAL = 3600  # 清理已发送记录的间隔（秒，由调度器执行）
 
 logger = logging.getLogger(__name__)
 
+_wakeup = threading.Event()
+_senders_started = False
+_senders_lock = threading.Lock()
+
+
+def is_configured():
+    """邮件服务是否已配置"""
+    if not SMTP_SERVER or not EMAIL_SENDER:
+        return False
+    return bool(EMAIL_PASSWORD) or SMTP_SECURITY == "none"
+
+
+class SMTPConnectionPool:
+    """已认证 SMTP 连接池（线程安全）"""
+
+    def __init__(self, size):
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []  # [(connection, 放回时间, 已发送数)]
+
+    def _connect(self):
+        if SMTP_SECURITY == "ssl":
+            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_SECURITY == "starttls":
+                server.starttls()
+        if EMAIL_PASSWORD:
+            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """
+        取出一个可用连接（空闲太久的连接先 NOOP 检查，失效则重连）
+        返回: (connection, 已发送数)
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._connect(), 0
+                server, released_at, sent = item
+                if time.time() - released_at < SMTP_IDLE_TIMEOUT:
+                    return server, sent
+                try:
+                    if server.noop()[0] == 250:
+                        return server, sent
+                except Exception:
+                    pass
+                self._close(server)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, server, sent, healthy=True):
+        """归还连接；连接异常或已达到单连接发送上限时关闭"""
+        try:
+            if healthy and sent < SMTP_MAX_MESSAGES_PER_CONNECTION:
+                with self._lock:
+                    self._idle.append((server, time.time(), sent))
+            else:
+                self._close(server)
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _, _ in idle:
+            self._close(server)
+
+
+_pool = SMTPConnectionPool(SMTP_POOL_SIZE)
+
 
 def generate_verification_code(length=6):
     """
@@ -33,166 +148,247 @@ def generate_verification_code(length=6):
     return ''.join([str(secrets.randbelow(10)) for _ in range(length)])
 
 
-def send_verification_email(recipient_email, verification_code):
+def build_verification_message(recipient_email, verification_code):
     """
-    发送验证码邮件
+    构建验证码邮件
     Args:
         recipient_email: 收件人邮箱地址
         verification_code: 验证码
     Returns:
-        (success: bool, message: str)
+        MIMEMultipart: 邮件对象
     """
-    if not EMAIL_PASSWORD:
-        logger.error("邮箱密码未配置")
-        return False, "error_email_not_configured"
+    # 创建邮件对象
+    message = MIMEMultipart('alternative')
+    message['From'] = formataddr((str(Header("码言 Nano Banana", 'utf-8')), EMAIL_SENDER))
+    message['To'] = recipient_email
+    message['Subject'] = "码言 Nano Banana - 注册验证码"
     
-    try:
-        # 创建邮件对象
-        message = MIMEMultipart('alternative')
-        message['From'] = formataddr((str(Header("码言 Nano Banana", 'utf-8')), EMAIL_SENDER))
-        message['To'] = recipient_email
-        message['Subject'] = "码言 Nano Banana - 注册验证码"
-        
-        # HTML 邮件内容
-        html_content = f"""
-        <!DOCTYPE html>
-        <html lang="zh-CN">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <style>
-                body {{
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    background-color: #f4f4f4;
-                    margin: 0;
-                    padding: 0;
-                }}
-                .container {{
-                    max-width: 600px;
-                    margin: 40px auto;
-                    background-color: #ffffff;
-                    border-radius: 12px;
-                    overflow: hidden;
-                    box-shadow: 0 4px 20px rgba(0,0,0,0.1);
-                }}
-                .header {{
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                    color: white;
-                    padding: 30px;
-                    text-align: center;
-                }}
-                .header h1 {{
-                    margin: 0;
-                    font-size: 24px;
-                    font-weight: 600;
-                }}
-                .content {{
-                    padding: 40px 30px;
-                }}
-                .code-box {{
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                    color: white;
-                    font-size: 32px;
-                    font-weight: bold;
-                    text-align: center;
-                    padding: 20px;
-                    margin: 30px 0;
-                    border-radius: 8px;
-                    letter-spacing: 8px;
-                    font-family: 'Courier New', monospace;
-                }}
-                .info {{
-                    color: #666;
-                    line-height: 1.6;
-                    margin: 20px 0;
-                }}
-                .warning {{
-                    background-color: #fff3cd;
-                    border-left: 4px solid #ffc107;
-                    padding: 12px;
-                    margin: 20px 0;
-                    color: #856404;
-                    border-radius: 4px;
-                }}
-                .footer {{
-                    background-color: #f8f9fa;
-                    padding: 20px;
-                    text-align: center;
-                    color: #6c757d;
-                    font-size: 14px;
-                }}
-                .brand {{
-                    font-weight: 600;
-                    color: #667eea;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🍌 码言 Nano Banana Pro</h1>
-                </div>
-                <div class="content">
-                    <p class="info">您好！</p>
-                    <p class="info">感谢您注册 <span class="brand">码言 Nano Banana Pro</span>。请使用以下验证码完成注册：</p>
-                    
-                    <div class="code-box">
-                        {verification_code}
-                    </div>
-                    
-                    <div class="warning">
-                        ⚠️ 验证码将在 <strong>10 分钟</strong>后失效，请尽快完成注册。
-                    </div>
-                    
-                    <p class="info">如果这不是您的操作，请忽略此邮件。</p>
+    # HTML 邮件内容
+    html_content = f"""
+    <!DOCTYPE html>
+    <html lang="zh-CN">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <style>
+            body {{
+                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+                background-color: #f4f4f4;
+                margin: 0;
+                padding: 0;
+            }}
+            .container {{
+                max-width: 600px;
+                margin: 40px auto;
+                background-color: #ffffff;
+                border-radius: 12px;
+                overflow: hidden;
+                box-shadow: 0 4px 20px rgba(0,0,0,0.1);
+            }}
+            .header {{
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                color: white;
+                padding: 30px;
+                text-align: center;
+            }}
+            .header h1 {{
+                margin: 0;
+                font-size: 24px;
+                font-weight: 600;
+            }}
+            .content {{
+                padding: 40px 30px;
+            }}
+            .code-box {{
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                color: white;
+                font-size: 32px;
+                font-weight: bold;
+                text-align: center;
+                padding: 20px;
+                margin: 30px 0;
+                border-radius: 8px;
+                letter-spacing: 8px;
+                font-family: 'Courier New', monospace;
+            }}
+            .info {{
+                color: #666;
+                line-height: 1.6;
+                margin: 20px 0;
+            }}
+            .warning {{
+                background-color: #fff3cd;
+                border-left: 4px solid #ffc107;
+                padding: 12px;
+                margin: 20px 0;
+                color: #856404;
+                border-radius: 4px;
+            }}
+            .footer {{
+                background-color: #f8f9fa;
+                padding: 20px;
+                text-align: center;
+                color: #6c757d;
+                font-size: 14px;
+            }}
+            .brand {{
+                font-weight: 600;
+                color: #667eea;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>🍌 码言 Nano Banana Pro</h1>
+            </div>
+            <div class="content">
+                <p class="info">您好！</p>
+                <p class="info">感谢您注册 <span class="brand">码言 Nano Banana Pro</span>。请使用以下验证码完成注册：</p>
+                
+                <div class="code-box">
+                    {verification_code}
                 </div>
-                <div class="footer">
-                    <p>此邮件由系统自动发送，请勿回复。</p>
-                    <p>© 2026 码言 Nano Banana Pro. All rights reserved.</p>
+                
+                <div class="warning">
+                    ⚠️ 验证码将在 <strong>10 分钟</strong>后失效，请尽快完成注册。
                 </div>
+                
+                <p class="info">如果这不是您的操作，请忽略此邮件。</p>
             </div>
-        </body>
-        </html>
-        """
-        
-        # 纯文本版本（备用）
-        text_content = f"""
-        码言 Nano Banana Pro - 注册验证码
-        
-        您好！
-        
-        感谢您注册码言 Nano Banana Pro。请使用以下验证码完成注册：
-        
-        验证码：{verification_code}
-        
-        验证码将在 10 分钟后失效，请尽快完成注册。
-        
-        如果这不是您的操作，请忽略此邮件。
-        
-        此邮件由系统自动发送，请勿回复。
-        © 2026 码言 Nano Banana Pro. All rights reserved.
-        """
-        
-        # 添加邮件内容
-        part1 = MIMEText(text_content, 'plain', 'utf-8')
-        part2 = MIMEText(html_content, 'html', 'utf-8')
-        message.attach(part1)
-        message.attach(part2)
-        
-        # 连接到 SMTP 服务器并发送邮件
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-            server.send_message(message)
-        
-        logger.info(f"验证码邮件已发送到 {recipient_email}")
-        return True, "success"
+            <div class="footer">
+                <p>此邮件由系统自动发送，请勿回复。</p>
+                <p>© 2026 码言 Nano Banana Pro. All rights reserved.</p>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+    
+    # 纯文本版本（备用）
+    text_content = f"""
+    码言 Nano Banana Pro - 注册验证码
+    
+    您好！
+    
+    感谢您注册码言 Nano Banana Pro。请使用以下验证码完成注册：
+    
+    验证码：{verification_code}
+    
+    验证码将在 10 分钟后失效，请尽快完成注册。
+    
+    如果这不是您的操作，请忽略此邮件。
     
-    except smtplib.SMTPAuthenticationError:
-        logger.error("SMTP 认证失败，请检查邮箱账号和密码")
-        return False, "error_email_auth_failed"
-    except smtplib.SMTPException as e:
-        logger.error(f"发送邮件失败 (SMTP): {str(e)}")
-        return False, "error_email_send_failed"
-    except Exception as e:
-        logger.error(f"发送邮件失败: {str(e)}")
-        return False, "error_email_send_failed"
+    此邮件由系统自动发送，请勿回复。
+    © 2026 码言 Nano Banana Pro. All rights reserved.
+    """
+    
+    # 添加邮件内容
+    part1 = MIMEText(text_content, 'plain', 'utf-8')
+    part2 = MIMEText(html_content, 'html', 'utf-8')
+    message.attach(part1)
+    message.attach(part2)
+    return message
+
+
+# 发件箱中各类邮件的构建函数：payload -> 邮件对象
+MESSAGE_BUILDERS = {
+    "verification_code": lambda recipient, payload: build_verification_message(recipient, payload["code"]),
+}
+
+
+# ==================== 发件箱后台发送 ====================
+
+def notify_outbox():
+    """通知本进程的发送线程立即检查发件箱（写入新邮件后调用）"""
+    _wakeup.set()
+
+
+def _is_permanent_failure(error):
+    """收件人被拒绝或服务器返回 5xx（认证失败除外，属于配置问题，修复后可重试）"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def _retry_at(attempts):
+    """第 attempts 次失败后的下次重试时间（指数退避 + 抖动），超过最大次数返回 None"""
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        return None
+    delay = min(OUTBOX_RETRY_BASE * (2 ** (attempts - 1)), OUTBOX_RETRY_MAX)
+    return time.time() + delay * random.uniform(0.8, 1.2)
+
+
+def _deliver_batch(batch, owner):
+    """通过同一个池化连接依次发送一批邮件"""
+    server = None
+    sent = 0
+    try:
+        for item in batch:
+            payload = item["payload"]
+            expires_at = payload.get("expires_at")
+            if expires_at and time.time() > expires_at:
+                # 验证码已过期，发送已无意义
+                mark_outbox_failed(item["id"], owner, "expired")
+                continue
+
+            builder = MESSAGE_BUILDERS.get(item["kind"])
+            if builder is None:
+                mark_outbox_failed(item["id"], owner, f"unknown kind: {item['kind']}")
+                continue
+
+            try:
+                if server is None:
+                    server, sent = _pool.acquire()
+                server.send_message(builder(item["recipient"], payload))
+                sent += 1
+                mark_outbox_sent(item["id"], owner)
+                logger.info(f"邮件 #{item['id']} 已发送到 {item['recipient']}")
+            except Exception as e:
+                attempts = item["attempts"] + 1
+                retry_at = None if _is_permanent_failure(e) else _retry_at(attempts)
+                mark_outbox_failed(item["id"], owner, str(e) or type(e).__name__, retry_at)
+                if retry_at is None:
+                    logger.error(f"邮件 #{item['id']} 发送失败，已放弃（第 {attempts} 次）: {e}")
+                else:
+                    logger.warning(f"邮件 #{item['id']} 发送失败，将在 {retry_at - time.time():.0f}s 后重试: {e}")
+                if not isinstance(e, smtplib.SMTPResponseException) or isinstance(e, smtplib.SMTPAuthenticationError):
+                    # 连接/认证异常：丢弃连接，本批剩余邮件放回队列稍后重试
+                    if server is not None:
+                        _pool.release(server, sent, healthy=False)
+                        server = None
+                    for rest in batch[batch.index(item) + 1:]:
+                        mark_outbox_failed(rest["id"], owner, "connection unavailable", time.time() + OUTBOX_RETRY_BASE)
+                    return
+    finally:
+        if server is not None:
+            _pool.release(server, sent)
+
+
+def _sender_loop():
+    """后台线程：认领发件箱中的到期邮件并批量发送"""
+    owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    while True:
+        try:
+            if is_configured():
+                batch = claim_outbox_batch(owner, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+                if batch:
+                    _deliver_batch(batch, owner)
+                    continue
+        except Exception as e:
+            logger.error(f"发件箱发送失败: {e}", exc_info=e)
+        _wakeup.wait(OUTBOX_POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start_outbox_sender():
+    """启动当前进程的发件箱发送线程（重复调用只启动一次）"""
+    global _senders_started
+    with _senders_lock:
+        if _senders_started:
+            return
+        _senders_started = True
+    for _ in range(max(1, OUTBOX_SENDERS)):
+        threading.Thread(target=_sender_loop, daemon=True).start()
@@ -0,0 +1,36 @@
+"""
+Gunicorn 配置（预加载模式）
+
+启动方式：
+    gunicorn -c gunicorn.conf.py
+ASGI 异步模式：
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+preload 模式下主进程只导入一次应用（Flask、PIL、genai 等模块），worker 通过写时复制共享这部分内存，
+数据库迁移也只在主进程执行一次；Gemini 客户端、后台线程等进程级资源在 fork 之后由 post_fork 创建。
+"""
+
+import gc
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 3))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+wsgi_app = "app:app"
+
+
+def on_starting(server):
+    """主进程启动（preload 时应用已导入）：在 fork 之前执行数据库迁移"""
+    if not server.cfg.preload_app:
+        return
+    import app
+    app.prepare_runtime()
+    # 冻结主进程中已有的对象，避免 worker 中的垃圾回收写入这些对象的内存页而触发复制
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """worker fork 之后：创建进程级资源（非 preload 模式下应用在此处首次导入）"""
+    import app
+    app.init_worker()
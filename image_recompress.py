@@ -0,0 +1,149 @@
+"""
+原图无损重新压缩模块
+生成图片保存时使用 PIL 默认的 PNG 参数，2K/4K 图片每张数 MB。调度器在后台分批把生成原图重新压缩：
+
+- png：优化后的 PNG（文件名不变，原地替换）
+- webp：无损 WebP（改名为 .webp，会话中的引用在同一次会话写入中更新，完成后删除原 PNG）
+- 新文件写入临时文件后逐像素比对，确认无损且体积至少减小 MIN_SAVING_RATIO 才替换，否则保留原图
+- 替换后的文件保留原修改时间（分层存储按此判断访问时间）
+- 改名后仍可按原文件名访问：图片接口找不到原 PNG 时，永久重定向到新的 WebP 文件
+- 参考图片（用户上传）和已迁移到冷存储的原图不处理；每个原图只处理一次，结果记录在 image_recompression 表中
+
+配置（环境变量）：
+    IMAGE_RECOMPRESS_FORMAT  目标格式（png / webp），默认为空（不处理）
+    IMAGE_RECOMPRESS_EFFORT  压缩力度 0-6，越大越慢、体积越小，默认 4
+    IMAGE_RECOMPRESS_INTERVAL  任务执行间隔（秒），默认 300
+    IMAGE_RECOMPRESS_BATCH_SIZE  每次最多处理的图片数，默认 20
+"""
+
+import os
+import uuid
+import logging
+from datetime import datetime, timedelta
+
+from PIL import Image, PngImagePlugin
+
+import image_storage
+from database import get_recompression_candidates, record_recompression, get_recompressed_image
+
+logger = logging.getLogger(__name__)
+
+IMAGE_RECOMPRESS_FORMAT = os.getenv("IMAGE_RECOMPRESS_FORMAT", "").strip().lower()
+IMAGE_RECOMPRESS_EFFORT = min(max(int(os.getenv("IMAGE_RECOMPRESS_EFFORT", 4)), 0), 6)
+IMAGE_RECOMPRESS_INTERVAL = int(os.getenv("IMAGE_RECOMPRESS_INTERVAL", 300))
+IMAGE_RECOMPRESS_BATCH_SIZE = int(os.getenv("IMAGE_RECOMPRESS_BATCH_SIZE", 20))
+MIN_AGE_SECONDS = 600  # 只处理 10 分钟前生成的图片（进行中的生成已完成保存）
+MIN_SAVING_RATIO = 0.02  # 体积减小不足 2% 时保留原图
+
+_EXTENSIONS = {"png": ".png", "webp": ".webp"}
+
+
+def _encode(img, image_format, effort, target):
+    """按目标格式无损编码（保留 ICC 配置、EXIF，PNG 还保留文本块和透明色）"""
+    params = {}
+    if img.info.get("icc_profile"):
+        params["icc_profile"] = img.info["icc_profile"]
+    if img.info.get("exif"):
+        params["exif"] = img.info["exif"]
+    if image_format == "webp":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        img.save(target, "WEBP", lossless=True, method=effort, quality=100, **params)
+    else:
+        if "transparency" in img.info:
+            params["transparency"] = img.info["transparency"]
+        text = getattr(img, "text", None)
+        if text:
+            pnginfo = PngImagePlugin.PngInfo()
+            for key, value in text.items():
+                pnginfo.add_text(key, value)
+            params["pnginfo"] = pnginfo
+        img.save(target, "PNG", optimize=effort >= 6, compress_level=min(9, effort + 3), **params)
+
+
+def _same_pixels(original, path):
+    """逐像素比对重新编码后的文件与原图"""
+    with Image.open(path) as encoded:
+        encoded.load()
+        reference = original if original.mode == encoded.mode else original.convert(encoded.mode)
+        return encoded.size == reference.size and encoded.tobytes() == reference.tobytes()
+
+
+def recompress_file(path, image_format, effort):
+    """
+    重新压缩一个原图，写入同目录的临时文件
+    返回 (临时文件路径, 新大小)；无法无损压缩或体积减小不足时删除临时文件并返回 None
+    """
+    original_size = os.path.getsize(path)
+    tmp_path = f"{path}.tmp.{uuid.uuid4().hex[:8]}"
+    try:
+        with Image.open(path) as img:
+            img.load()
+            _encode(img, image_format, effort, tmp_path)
+            if not _same_pixels(img, tmp_path):
+                logger.warning(f"重新压缩结果与原图像素不一致，保留原图 {path}")
+                os.remove(tmp_path)
+                return None
+        new_size = os.path.getsize(tmp_path)
+        if new_size > original_size * (1 - MIN_SAVING_RATIO):
+            os.remove(tmp_path)
+            return None
+        return tmp_path, new_size
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def run_batch(images_dir, replace_reference):
+    """
+    处理一批生成原图（由调度器执行），返回本批统计（记录在定时任务执行结果中）
+    replace_reference(user_id, session_id, old_filename, new_filename, new_size) -> bool
+        在会话中把图片引用改为新文件并更新大小，消息已不存在时返回 False
+    """
+    if IMAGE_RECOMPRESS_FORMAT not in _EXTENSIONS:
+        return None
+    before = (datetime.now() - timedelta(seconds=MIN_AGE_SECONDS)).isoformat()
+    candidates = get_recompression_candidates(before, IMAGE_RECOMPRESS_BATCH_SIZE)
+    stats = {"recompressed": 0, "skipped": 0, "failed": 0, "bytes_saved": 0}
+
+    for candidate in candidates:
+        filename = candidate["filename"]
+        path = os.path.join(images_dir, filename)
+        new_filename = os.path.splitext(filename)[0] + _EXTENSIONS[IMAGE_RECOMPRESS_FORMAT]
+        new_path = os.path.join(images_dir, new_filename)
+        status, original_size, new_size = "skipped", None, None
+        try:
+            if os.path.exists(path):
+                st = os.stat(path)
+                original_size = st.st_size
+                result = recompress_file(path, IMAGE_RECOMPRESS_FORMAT, IMAGE_RECOMPRESS_EFFORT)
+                if result is not None:
+                    tmp_path, new_size = result
+                    os.replace(tmp_path, new_path)
+                    if replace_reference(candidate["user_id"], candidate["session_id"], filename, new_filename, new_size):
+                        # 会话引用更新后才恢复原修改时间：之前新文件还未被引用，孤儿清理按修改时间判断宽限期
+                        os.utime(new_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+                        if new_filename != filename:
+                            image_storage.delete(path)
+                        status = "done"
+                    elif new_filename != filename:
+                        # 处理期间消息已被删除：撤销新文件，原图交给保留策略清理
+                        os.remove(new_path)
+        except Exception as e:
+            status = "failed"
+            logger.error(f"重新压缩原图失败 {filename}: {e}")
+
+        record_recompression(filename, new_filename if status == "done" else None, IMAGE_RECOMPRESS_FORMAT,
+                             status, original_size, new_size if status == "done" else None)
+        key = "recompressed" if status == "done" else status
+        stats[key] += 1
+        if status == "done":
+            stats["bytes_saved"] += original_size - new_size
+    return stats
+
+
+def renamed_filename(filename):
+    """按原文件名查找已转换格式的原图的新文件名，没有转换过时返回 None"""
+    record = get_recompressed_image(filename)
+    return record["new_filename"] if record else None
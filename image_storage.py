@@ -0,0 +1,264 @@
+"""
+图片分层存储模块
+原图（生成图片和参考图片）分为本地热存储（IMAGES_DIR）和冷存储两层，本地磁盘占用有上限：
+
+- 调度器定期把长时间未访问的原图复制到冷存储并删除本地文件；本地总大小超过上限时，
+  再按最近访问时间从旧到新迁移，直到低于上限
+- 最近访问时间取文件写入时间和最近一次从冷存储取回的时间中较晚者
+- 访问原图（图片接口、重建聊天历史）时本地不存在则从冷存储取回，并恢复原来的修改时间，ETag 保持不变
+- 取回后保留冷存储副本，再次迁移时只需删除本地文件
+- 缩略图始终保留在本地，不参与迁移
+- 冷存储中的原图记录在 image_archive 表中，删除消息时同时删除冷存储副本
+
+冷存储类型：
+    local  本地归档目录（gzip 压缩），可挂载到更便宜的磁盘，也可作为对象存储的本地替代
+    s3     S3 兼容的对象存储（需要安装 boto3，凭据使用 AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY 等标准环境变量）
+
+配置（环境变量）：
+    IMAGE_COLD_STORAGE  冷存储类型（local / s3），默认为空（不迁移）
+    IMAGE_COLD_DIR  local 类型的归档目录，默认 data/cold_images
+    IMAGE_COLD_S3_BUCKET / IMAGE_COLD_S3_PREFIX / IMAGE_COLD_S3_ENDPOINT  s3 类型的存储桶、键前缀和端点
+    IMAGE_COLD_AFTER_DAYS  超过该天数未访问的原图迁移到冷存储，默认 7
+    IMAGE_HOT_MAX_BYTES  本地原图总大小上限（字节），0 表示只按天数迁移，默认 0
+    IMAGE_TIER_INTERVAL  迁移任务的执行间隔（秒），默认 600
+    IMAGE_TIER_BATCH_SIZE  每次最多迁移的文件数，默认 200
+"""
+
+import os
+import gzip
+import time
+import uuid
+import shutil
+import logging
+from datetime import datetime
+
+from database import (
+    get_archived_image, get_archived_images, record_archived_image, mark_image_rehydrated,
+    delete_archived_image, get_image_archive_stats
+)
+
+logger = logging.getLogger(__name__)
+
+IMAGE_COLD_STORAGE = os.getenv("IMAGE_COLD_STORAGE", "").strip().lower()
+IMAGE_COLD_DIR = os.getenv("IMAGE_COLD_DIR", "data/cold_images")
+IMAGE_COLD_S3_BUCKET = os.getenv("IMAGE_COLD_S3_BUCKET", "")
+IMAGE_COLD_S3_PREFIX = os.getenv("IMAGE_COLD_S3_PREFIX", "images/")
+IMAGE_COLD_S3_ENDPOINT = os.getenv("IMAGE_COLD_S3_ENDPOINT") or None
+IMAGE_COLD_AFTER_DAYS = float(os.getenv("IMAGE_COLD_AFTER_DAYS", 7))
+IMAGE_HOT_MAX_BYTES = int(os.getenv("IMAGE_HOT_MAX_BYTES", 0))
+IMAGE_TIER_INTERVAL = int(os.getenv("IMAGE_TIER_INTERVAL", 600))
+IMAGE_TIER_BATCH_SIZE = int(os.getenv("IMAGE_TIER_BATCH_SIZE", 200))
+MIN_HOT_SECONDS = 3600  # 最近一小时内写入或取回的原图不迁移（可能属于进行中的生成或正在浏览的会话）
+
+
+class LocalArchive:
+    """本地归档目录（gzip 压缩）"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, filename):
+        return os.path.join(self.directory, f"{filename}.gz")
+
+    def put(self, filename, source_path):
+        tmp_path = f"{self._path(filename)}.tmp.{uuid.uuid4().hex[:8]}"
+        with open(source_path, "rb") as src, gzip.open(tmp_path, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, self._path(filename))
+
+    def get(self, filename, target_path):
+        with gzip.open(self._path(filename), "rb") as src, open(target_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+    def delete(self, filename):
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+
+
+class S3Archive:
+    """S3 兼容的对象存储"""
+
+    def __init__(self, bucket, prefix, endpoint_url=None):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("IMAGE_COLD_STORAGE=s3 需要安装 boto3")
+        if not bucket:
+            raise RuntimeError("IMAGE_COLD_STORAGE=s3 需要配置 IMAGE_COLD_S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self._boto3 = boto3
+        self._clients = {}
+
+    def _client(self):
+        # boto3 客户端不能跨 fork 共享，按进程创建
+        pid = os.getpid()
+        if pid not in self._clients:
+            self._clients[pid] = self._boto3.client("s3", endpoint_url=self.endpoint_url)
+        return self._clients[pid]
+
+    def put(self, filename, source_path):
+        self._client().upload_file(source_path, self.bucket, self.prefix + filename)
+
+    def get(self, filename, target_path):
+        self._client().download_file(self.bucket, self.prefix + filename, target_path)
+
+    def delete(self, filename):
+        self._client().delete_object(Bucket=self.bucket, Key=self.prefix + filename)
+
+
+_archive = None
+
+
+def _get_archive():
+    """当前配置的冷存储（未配置时返回 None）"""
+    global _archive
+    if _archive is None and IMAGE_COLD_STORAGE:
+        if IMAGE_COLD_STORAGE == "local":
+            _archive = LocalArchive(IMAGE_COLD_DIR)
+        elif IMAGE_COLD_STORAGE == "s3":
+            _archive = S3Archive(IMAGE_COLD_S3_BUCKET, IMAGE_COLD_S3_PREFIX, IMAGE_COLD_S3_ENDPOINT)
+        else:
+            raise RuntimeError(f"未知的 IMAGE_COLD_STORAGE: {IMAGE_COLD_STORAGE}")
+    return _archive
+
+
+def ensure_hot(path):
+    """
+    确保原图在本地：本地存在直接返回 True；在冷存储中则取回（恢复原修改时间）后返回 True；
+    都不存在时返回 False
+    """
+    if os.path.exists(path):
+        return True
+    filename = os.path.basename(path)
+    record = get_archived_image(filename)
+    if record is None:
+        return False
+    archive = _get_archive()
+    if archive is None:
+        logger.error(f"原图 {filename} 在冷存储中，但未配置 IMAGE_COLD_STORAGE")
+        return False
+
+    tmp_path = f"{path}.rehydrate.{uuid.uuid4().hex[:8]}"
+    try:
+        archive.get(filename, tmp_path)
+        os.utime(tmp_path, ns=(time.time_ns(), record["mtime_ns"]))
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"从冷存储取回原图失败 {filename}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    mark_image_rehydrated(filename)
+    logger.info(f"已从冷存储取回原图 {filename}")
+    return True
+
+
+def archived_size(path):
+    """冷存储中原图的大小（不在冷存储中时返回 None）"""
+    record = get_archived_image(os.path.basename(path))
+    return record["size"] if record else None
+
+
+def delete(path):
+    """删除原图的本地文件和冷存储副本"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    filename = os.path.basename(path)
+    if get_archived_image(filename) is None:
+        return
+    archive = _get_archive()
+    if archive is not None:
+        archive.delete(filename)
+    delete_archived_image(filename)
+
+
+def _hot_files(directory):
+    """本地原图列表 [(文件名, 路径, 大小, 修改时间 ns)]（跳过未完成的临时文件）"""
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file() or ".tmp." in entry.name or ".rehydrate." in entry.name:
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            files.append((entry.name, entry.path, st.st_size, st.st_mtime_ns))
+    return files
+
+
+def migrate(directory):
+    """
+    迁移任务（由调度器执行）：把超过 IMAGE_COLD_AFTER_DAYS 未访问的原图，以及本地总大小超过
+    IMAGE_HOT_MAX_BYTES 时最久未访问的原图迁移到冷存储，每次最多 IMAGE_TIER_BATCH_SIZE 个
+    返回本次迁移的统计（记录在定时任务执行结果中）
+    """
+    archive = _get_archive()
+    if archive is None:
+        return None
+
+    files = _hot_files(directory)
+    records = get_archived_images(name for name, _, _, _ in files)
+    now = time.time()
+
+    def last_access(item):
+        name, _, _, mtime_ns = item
+        accessed = mtime_ns / 1e9
+        rehydrated_at = (records.get(name) or {}).get("rehydrated_at")
+        if rehydrated_at:
+            accessed = max(accessed, datetime.fromisoformat(rehydrated_at).timestamp())
+        return accessed
+
+    files.sort(key=last_access)
+    hot_bytes = sum(size for _, _, size, _ in files)
+    age_cutoff = now - IMAGE_COLD_AFTER_DAYS * 86400
+    stats = {"moved": 0, "moved_bytes": 0, "failed": 0}
+
+    for item in files:
+        if stats["moved"] + stats["failed"] >= IMAGE_TIER_BATCH_SIZE:
+            break
+        name, path, size, mtime_ns = item
+        accessed = last_access(item)
+        over_limit = IMAGE_HOT_MAX_BYTES > 0 and hot_bytes > IMAGE_HOT_MAX_BYTES
+        if accessed > now - MIN_HOT_SECONDS or (accessed > age_cutoff and not over_limit):
+            # 已按最近访问时间排序，之后的文件访问时间更晚
+            break
+        try:
+            record = records.get(name)
+            if record is None or record["size"] != size or record["mtime_ns"] != mtime_ns:
+                archive.put(name, path)
+                record_archived_image(name, size, mtime_ns)
+            os.remove(path)
+        except Exception as e:
+            stats["failed"] += 1
+            logger.error(f"迁移原图到冷存储失败 {name}: {e}")
+            continue
+        stats["moved"] += 1
+        stats["moved_bytes"] += size
+        hot_bytes -= size
+
+    stats["hot_files"] = len(files) - stats["moved"]
+    stats["hot_bytes"] = hot_bytes
+    return stats
+
+
+def status(directory):
+    """分层存储配置、本地原图占用和冷存储统计"""
+    files = _hot_files(directory) if os.path.isdir(directory) else []
+    return dict(
+        get_image_archive_stats(),
+        cold_storage=IMAGE_COLD_STORAGE or None,
+        cold_after_days=IMAGE_COLD_AFTER_DAYS,
+        hot_max_bytes=IMAGE_HOT_MAX_BYTES,
+        hot_files=len(files),
+        hot_bytes=sum(size for _, _, size, _ in files),
+    )
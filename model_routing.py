@@ -0,0 +1,99 @@
+"""
+模型路由模块
+所选模型最近的 p95 耗时或错误率超过阈值（或该模型所有端点都在熔断）时，把生成请求切换到更快的备用模型，
+高峰期 Pro 模型拥堵时尾延迟仍然可控。
+
+- 统计来自 circuit_breaker 的滑动窗口（按模型汇总所有端点），窗口内请求数不足时不切换；
+  切走之后原模型的统计逐渐过期，新请求自然回到原模型
+- 只在开启后生效：新会话（尚未锁定设置）直接切换，已锁定设置的会话只对允许自动切换的用户生效
+- 备用模型本身也不健康时不切换
+- 点数按实际使用的模型计算，每次切换都记录在 model_routing_log 表中
+
+配置（环境变量）：
+    MODEL_ROUTING_ENABLED  是否开启模型路由，默认 false
+    MODEL_ROUTING_FALLBACKS  备用模型，逗号分隔的 模型=备用模型，
+                             默认 gemini-3-pro-image-preview=gemini-3.1-flash-image-preview
+    MODEL_ROUTING_P95_SECONDS  p95 耗时阈值（秒），默认 90
+    MODEL_ROUTING_ERROR_RATE  错误率阈值，默认 0.3
+    MODEL_ROUTING_MIN_REQUESTS  窗口内请求数达到该值才判断，默认 5
+    MODEL_ROUTING_HISTORY_DAYS  路由记录保留天数，默认 30
+"""
+
+import os
+import logging
+
+import circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+MODEL_ROUTING_ENABLED = os.getenv("MODEL_ROUTING_ENABLED", "false").lower() == "true"
+MODEL_ROUTING_P95_SECONDS = float(os.getenv("MODEL_ROUTING_P95_SECONDS", 90))
+MODEL_ROUTING_ERROR_RATE = float(os.getenv("MODEL_ROUTING_ERROR_RATE", 0.3))
+MODEL_ROUTING_MIN_REQUESTS = int(os.getenv("MODEL_ROUTING_MIN_REQUESTS", 5))
+MODEL_ROUTING_HISTORY_DAYS = int(os.getenv("MODEL_ROUTING_HISTORY_DAYS", 30))
+
+
+def _parse_fallbacks():
+    raw = os.getenv("MODEL_ROUTING_FALLBACKS", "gemini-3-pro-image-preview=gemini-3.1-flash-image-preview")
+    fallbacks = {}
+    for item in raw.split(","):
+        model, _, fallback = item.partition("=")
+        if model.strip() and fallback.strip():
+            fallbacks[model.strip()] = fallback.strip()
+    return fallbacks
+
+
+FALLBACKS = _parse_fallbacks()
+
+
+def degradation(model, endpoints):
+    """
+    判断模型是否需要切走，返回 (原因或 None, 统计)
+    原因：circuit_open（所有端点熔断）、error_rate（错误率超过阈值）、p95_latency（p95 耗时超过阈值）
+    """
+    health = circuit_breaker.model_health(model, endpoints)
+    if health["circuit_open"]:
+        return "circuit_open", health
+    if health["requests"] < MODEL_ROUTING_MIN_REQUESTS:
+        return None, health
+    if health["error_rate"] >= MODEL_ROUTING_ERROR_RATE:
+        return "error_rate", health
+    if health["p95_seconds"] is not None and health["p95_seconds"] >= MODEL_ROUTING_P95_SECONDS:
+        return "p95_latency", health
+    return None, health
+
+
+def route(model, endpoints, new_session, opted_in):
+    """
+    选择本次生成实际使用的模型，返回 (模型, 切换原因或 None, 原模型统计)
+    new_session 表示会话尚未锁定设置；已锁定的会话只在用户允许自动切换（opted_in）时切换
+    """
+    fallback = FALLBACKS.get(model)
+    if not MODEL_ROUTING_ENABLED or not fallback or fallback == model:
+        return model, None, None
+    if not new_session and not opted_in:
+        return model, None, None
+    reason, health = degradation(model, endpoints)
+    if reason is None:
+        return model, None, health
+    if degradation(fallback, endpoints)[0] is not None:
+        # 备用模型同样不健康：保持原模型（原模型熔断时由熔断器快速失败）
+        return model, None, health
+    logger.info(f"模型路由：{model} → {fallback}（{reason}，p95={health['p95_seconds']}s，错误率={health['error_rate']}）")
+    return fallback, reason, health
+
+
+def status(endpoints):
+    """返回路由配置和各模型当前的统计与判断结果（管理后台展示用）"""
+    models = {}
+    for model in dict.fromkeys(list(FALLBACKS) + list(FALLBACKS.values())):
+        reason, health = degradation(model, endpoints)
+        models[model] = dict(health, degraded=reason)
+    return {
+        "enabled": MODEL_ROUTING_ENABLED,
+        "fallbacks": FALLBACKS,
+        "p95_seconds_threshold": MODEL_ROUTING_P95_SECONDS,
+        "error_rate_threshold": MODEL_ROUTING_ERROR_RATE,
+        "min_requests": MODEL_ROUTING_MIN_REQUESTS,
+        "models": models,
+    }
@@ -0,0 +1,183 @@
+"""
+凭据哈希模块
+密码、卡密、邮箱验证码的哈希计算与校验。
+
+- 按凭据类型分别配置算法和参数：密码使用内存困难的 scrypt；卡密本身是 16 位高熵随机码，
+  不需要慢哈希；邮箱验证码只有 10 分钟有效期，使用以 SECRET_KEY 为密钥的 HMAC-SHA256
+- 慢哈希在独立的进程池中执行，不占用请求线程的 GIL；等待中的任务数有上限，
+  超出时抛出 HashingBusy，由调用方返回 503，避免登录高峰把所有 worker 拖住
+- 校验成功时如果存储的哈希与当前配置不一致，返回新哈希供调用方透明升级
+
+配置（环境变量）：
+    PASSWORD_HASH_METHOD / CARD_KEY_HASH_METHOD / VERIFICATION_CODE_HASH_METHOD
+        werkzeug 格式（如 scrypt:32768:8:1、pbkdf2:sha256:600000），或 hmac-sha256
+    PASSWORD_HASH_WORKERS  进程池大小，默认 CPU 核数，0 表示在请求线程内计算（不支持 fork 的平台始终在线程内计算）
+    PASSWORD_HASH_MAX_PENDING  排队上限，默认 进程数 × 8
+"""
+
+import os
+import hmac
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+logger = logging.getLogger(__name__)
+
+HMAC_METHOD = "hmac-sha256"
+
+# 各凭据类型的默认哈希方法
+DEFAULT_METHODS = {
+    "password": "scrypt:32768:8:1",
+    "card_key": "pbkdf2:sha256:10000",
+    "verification_code": HMAC_METHOD,
+}
+
+HASH_METHODS = {
+    "password": os.getenv("PASSWORD_HASH_METHOD", DEFAULT_METHODS["password"]),
+    "card_key": os.getenv("CARD_KEY_HASH_METHOD", DEFAULT_METHODS["card_key"]),
+    "verification_code": os.getenv("VERIFICATION_CODE_HASH_METHOD", DEFAULT_METHODS["verification_code"]),
+}
+
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", max(1, HASH_WORKERS) * 8))
+HASH_QUEUE_TIMEOUT = 5  # 排队已满时最多等待的秒数
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(HASH_MAX_PENDING)
+
+
+class HashingBusy(Exception):
+    """哈希进程池排队已满"""
+
+
+def _hmac_key():
+    key = os.getenv("SECRET_KEY")
+    if not key:
+        raise ValueError("使用 hmac-sha256 需要设置 SECRET_KEY")
+    return key.encode("utf-8")
+
+
+def _compute_hash(method, value):
+    """计算哈希（在进程池中执行，必须是模块级函数）"""
+    if method == HMAC_METHOD:
+        digest = hmac.new(_hmac_key(), value.encode("utf-8"), hashlib.sha256).hexdigest()
+        return f"{HMAC_METHOD}${digest}"
+    return generate_password_hash(value, method=method)
+
+
+def _compute_many(method, values):
+    """批量计算哈希（在进程池中执行，一次提交一组以减少进程间通信）"""
+    return [_compute_hash(method, value) for value in values]
+
+
+def _check_hash(stored_hash, value):
+    """校验哈希（在进程池中执行，必须是模块级函数）"""
+    if stored_hash.startswith(HMAC_METHOD + "$"):
+        expected = _compute_hash(HMAC_METHOD, value)
+        return hmac.compare_digest(expected, stored_hash)
+    return check_password_hash(stored_hash, value)
+
+
+def _get_pool():
+    """获取当前进程的哈希进程池（fork 出的子进程会重新创建，不复用父进程的池）"""
+    global _pool, _pool_pid
+    if HASH_WORKERS <= 0:
+        return None
+    if "fork" not in multiprocessing.get_all_start_methods():
+        # spawn 会在子进程中重新导入主模块（python app.py 时即整个应用），不支持 fork 的平台直接在线程内计算
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # 工作进程只执行纯哈希计算，不使用日志、数据库等父进程中可能被其他线程持有的锁，
+            # 因此可以安全地从多线程进程 fork；fork 上下文下首次提交时会一次性启动全部工作进程
+            _pool = ProcessPoolExecutor(
+                max_workers=HASH_WORKERS,
+                mp_context=multiprocessing.get_context("fork")
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _run(func, *args):
+    """在进程池中执行哈希计算，排队已满时抛出 HashingBusy"""
+    pool = _get_pool()
+    if pool is None:
+        return func(*args)
+    if not _pending.acquire(timeout=HASH_QUEUE_TIMEOUT):
+        raise HashingBusy()
+    try:
+        return pool.submit(func, *args).result()
+    finally:
+        _pending.release()
+
+
+_normalized_methods = {}
+
+
+def _normalized_method(kind):
+    """配置的方法补全默认参数后的形式（如 scrypt -> scrypt:32768:8:1），与存储哈希的前缀可直接比较"""
+    method = HASH_METHODS[kind]
+    if method == HMAC_METHOD or method.count(":") >= 2:
+        return method
+    if method not in _normalized_methods:
+        _normalized_methods[method] = _compute_hash(method, "").split("$", 1)[0]
+    return _normalized_methods[method]
+
+
+def needs_rehash(kind, stored_hash):
+    """存储的哈希方法/参数与当前配置不一致时返回 True"""
+    return stored_hash.split("$", 1)[0] != _normalized_method(kind)
+
+
+def hash_secret(kind, value, offload=True):
+    """按凭据类型计算哈希（HMAC 足够快，直接在当前线程计算；offload=False 时也不使用进程池）"""
+    method = HASH_METHODS[kind]
+    if method == HMAC_METHOD or not offload:
+        return _compute_hash(method, value)
+    return _run(_compute_hash, method, value)
+
+
+def hash_many(kind, values, chunk_size=64):
+    """
+    批量计算哈希，结果顺序与 values 一致
+    按组分发到进程池并行计算；同时在途的组数不超过进程数，登录等单次哈希可以插在组之间执行
+    """
+    method = HASH_METHODS[kind]
+    values = list(values)
+    pool = None if method == HMAC_METHOD else _get_pool()
+    if pool is None:
+        return _compute_many(method, values)
+
+    results = []
+    in_flight = deque()
+    for start in range(0, len(values), chunk_size):
+        in_flight.append(pool.submit(_compute_many, method, values[start:start + chunk_size]))
+        if len(in_flight) >= HASH_WORKERS:
+            results.extend(in_flight.popleft().result())
+    while in_flight:
+        results.extend(in_flight.popleft().result())
+    return results
+
+
+def verify_secret(kind, stored_hash, value):
+    """
+    校验凭据
+    返回: (是否匹配, 新哈希或 None)，匹配且需要升级哈希参数时返回新哈希
+    """
+    if not stored_hash:
+        return False, None
+    if stored_hash.startswith(HMAC_METHOD + "$"):
+        matched = _check_hash(stored_hash, value)
+    else:
+        matched = _run(_check_hash, stored_hash, value)
+    if not matched:
+        return False, None
+    if needs_rehash(kind, stored_hash):
+        return True, hash_secret(kind, value)
+    return True, None
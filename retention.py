@@ -0,0 +1,245 @@
+"""
+数据保留（Retention）模块
+按会话时间索引和媒体文件索引，分批、可恢复地清理过期消息和孤儿文件。
+
+清理以任务形式记录在 retention_jobs 表中，由每个进程的后台线程认领执行：
+- 任务按批次推进，每批结束后保存游标和统计并续约，进程退出后由其他进程从游标处继续
+- 管理员手动提交截止日期，或配置 RETENTION_DAYS 由调度器（scheduler.py）按固定间隔自动创建保留任务
+- 孤儿文件只有在媒体索引回填完成后才会清理，且跳过最近写入的文件（宽限期内可能属于进行中的生成）
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from database import (
+    get_meta, get_expired_session_batch, count_expired_sessions, get_referenced_media,
+    create_retention_job, claim_retention_job, update_retention_job, get_recent_retention_jobs
+)
+
+logger = logging.getLogger(__name__)
+
+# 自动保留策略：保留最近 N 天的数据（0 表示不自动清理，只允许管理员手动提交）
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 0))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 86400))  # 自动清理间隔（秒）
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 50))  # 每批处理的会话数
+RETENTION_FILE_BATCH_SIZE = int(os.getenv("RETENTION_FILE_BATCH_SIZE", 500))  # 每批检查的文件数
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", 0.2))  # 批次间隔（秒），降低对在线请求的影响
+RETENTION_POLL_INTERVAL = int(os.getenv("RETENTION_POLL_INTERVAL", 5))  # 空闲时检查新任务的间隔（秒）
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", 3600))  # 孤儿文件宽限期（秒）
+LEASE_SECONDS = 120  # 任务租约时长，执行进程每批续约
+
+# 媒体索引回填完成标记（回填前索引不完整，不能据此判断孤儿文件）
+MEDIA_INDEX_READY_KEY = "media_index_ready"
+
+# 任务阶段顺序：过期消息 -> 孤儿图片 -> 孤儿缩略图
+PHASES = ["messages", "images", "thumbnails", "done"]
+
+_worker_started = False
+_worker_lock = threading.Lock()
+
+
+def _empty_stats():
+    return {
+        "processed_sessions": 0,
+        "sessions": 0,
+        "messages": 0,
+        "images": 0,
+        "scanned_files": 0,
+        "orphan_images": 0,
+        "orphan_thumbnails": 0,
+        "orphans_skipped": False
+    }
+
+
+def enqueue(cutoff_date, created_by=None):
+    """提交一次手动清理任务，返回任务 ID"""
+    return create_retention_job("manual", cutoff_date.isoformat(), created_by)
+
+
+def policy_info():
+    """返回当前自动保留策略（管理后台展示用）"""
+    last = get_recent_retention_jobs(limit=1, kind="policy")
+    return {
+        "enabled": RETENTION_DAYS > 0,
+        "retention_days": RETENTION_DAYS,
+        "interval_seconds": RETENTION_INTERVAL,
+        "last_run": last[0] if last else None
+    }
+
+
+def schedule_policy():
+    """
+    按保留策略创建一次清理任务（由调度器每 RETENTION_INTERVAL 秒在主节点执行一次，
+    已有排队/运行中的策略任务时不重复创建）
+    返回: 新任务 ID，未创建时返回 None
+    """
+    if RETENTION_DAYS <= 0:
+        return None
+    cutoff = datetime.now() - timedelta(days=RETENTION_DAYS)
+    job_id = create_retention_job("policy", cutoff.isoformat(), only_if_idle=True)
+    if job_id:
+        logger.info(f"已按保留策略创建清理任务 #{job_id}（保留 {RETENTION_DAYS} 天）")
+    return job_id
+
+
+def _run_messages_batch(job, expire_sessions):
+    """处理一批过期会话，返回 (新游标, 是否已处理完)"""
+    after = json.loads(job["cursor"]) if job["cursor"] else None
+    rows = get_expired_session_batch(job["cutoff"], after, RETENTION_BATCH_SIZE)
+    if not rows:
+        return None, True
+
+    cutoff_date = datetime.fromisoformat(job["cutoff"])
+    by_user = {}
+    for _, user_id, session_id in rows:
+        by_user.setdefault(user_id, []).append(session_id)
+
+    stats = job["stats"]
+    for user_id, session_ids in by_user.items():
+        result = expire_sessions(user_id, session_ids, cutoff_date)
+        stats["sessions"] += result["sessions"]
+        stats["messages"] += result["messages"]
+        stats["images"] += result["images"]
+    stats["processed_sessions"] += len(rows)
+
+    return json.dumps(list(rows[-1])), len(rows) < RETENTION_BATCH_SIZE
+
+
+def _run_files_batch(job, directory, kind, names):
+    """检查一批文件，删除未被任何会话引用且超过宽限期的文件，返回 (新游标, 是否已处理完)"""
+    cursor = job["cursor"] or ""
+    start = 0
+    if cursor:
+        # names 已排序，二分定位到游标之后
+        lo, hi = 0, len(names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if names[mid] <= cursor:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+    batch = names[start:start + RETENTION_FILE_BATCH_SIZE]
+    if not batch:
+        return cursor, True
+
+    referenced = get_referenced_media(kind, batch)
+    grace_deadline = time.time() - ORPHAN_GRACE_SECONDS
+    stats = job["stats"]
+    stat_key = "orphan_images" if kind == "image" else "orphan_thumbnails"
+
+    for filename in batch:
+        # 未完成的临时文件（重新压缩、冷存储取回）由写入方负责替换或删除
+        if filename in referenced or ".tmp." in filename or ".rehydrate." in filename:
+            continue
+        file_path = os.path.join(directory, filename)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue
+        if st.st_mtime > grace_deadline or not os.path.isfile(file_path):
+            continue
+        try:
+            os.remove(file_path)
+            stats[stat_key] += 1
+        except OSError as e:
+            logger.error(f"删除孤儿文件失败 {file_path}: {e}")
+
+    stats["scanned_files"] += len(batch)
+    return batch[-1], start + len(batch) >= len(names)
+
+
+def run_job(job, owner, expire_sessions, media_dirs):
+    """
+    执行（或从游标处继续执行）一个保留任务
+    expire_sessions(user_id, session_ids, cutoff_date) -> {"sessions", "messages", "images"}
+    media_dirs: {"image": IMAGES_DIR, "thumbnail": THUMBNAILS_DIR}
+    """
+    job_id = job["id"]
+    stats = _empty_stats()
+    stats.update(job["stats"] or {})
+    job["stats"] = stats
+
+    if job["phase"] == "messages" and not job["cursor"]:
+        job["total"] = count_expired_sessions(job["cutoff"])
+        if not update_retention_job(job_id, owner, LEASE_SECONDS, total=job["total"]):
+            return
+
+    file_names = {}
+    logger.info(f"开始执行清理任务 #{job_id}（阶段: {job['phase']}, 截止: {job['cutoff']}）")
+
+    while job["phase"] != "done":
+        phase = job["phase"]
+        if phase == "messages":
+            cursor, finished = _run_messages_batch(job, expire_sessions)
+        else:
+            if get_meta(MEDIA_INDEX_READY_KEY) != "1":
+                # 媒体索引尚未回填完成，无法可靠判断孤儿文件，跳过（下次任务再处理）
+                stats["orphans_skipped"] = True
+                cursor, finished = None, True
+                job["phase"] = "thumbnails"
+            else:
+                kind = "image" if phase == "images" else "thumbnail"
+                directory = media_dirs[kind]
+                if phase not in file_names:
+                    file_names[phase] = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+                cursor, finished = _run_files_batch(job, directory, kind, file_names[phase])
+
+        if finished:
+            job["phase"] = PHASES[PHASES.index(job["phase"]) + 1]
+            job["cursor"] = None
+        else:
+            job["cursor"] = cursor
+
+        fields = {"phase": job["phase"], "cursor": job["cursor"], "stats": stats}
+        if job["phase"] == "done":
+            fields.update(status="completed", finished_at=datetime.now().isoformat())
+        if not update_retention_job(job_id, owner, LEASE_SECONDS, **fields):
+            logger.info(f"清理任务 #{job_id} 已取消或租约已失效，停止执行")
+            return
+        if job["phase"] != "done":
+            time.sleep(RETENTION_BATCH_PAUSE)
+
+    logger.info(
+        f"清理任务 #{job_id} 完成：会话 {stats['sessions']}，消息 {stats['messages']}，"
+        f"图片 {stats['images']}，孤儿图片 {stats['orphan_images']}，孤儿缩略图 {stats['orphan_thumbnails']}"
+    )
+
+
+def _worker_loop(expire_sessions, media_dirs):
+    """后台线程：认领并执行保留任务（策略任务由调度器创建）"""
+    owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    while True:
+        job = None
+        try:
+            job = claim_retention_job(owner, LEASE_SECONDS)
+            if job:
+                run_job(job, owner, expire_sessions, media_dirs)
+                continue
+        except Exception as e:
+            logger.error(f"清理任务执行失败: {e}", exc_info=e)
+            if job:
+                try:
+                    update_retention_job(job["id"], owner, LEASE_SECONDS, status="failed",
+                                         error=str(e)[:500], finished_at=datetime.now().isoformat())
+                except Exception as update_error:
+                    logger.error(f"更新清理任务状态失败: {update_error}")
+        time.sleep(RETENTION_POLL_INTERVAL)
+
+
+def start_worker(expire_sessions, media_dirs):
+    """启动当前进程的保留任务后台线程（重复调用只启动一次）"""
+    global _worker_started
+    with _worker_lock:
+        if _worker_started:
+            return
+        _worker_started = True
+    thread = threading.Thread(target=_worker_loop, args=(expire_sessions, media_dirs), daemon=True)
+    thread.start()
+    if RETENTION_DAYS > 0:
+        logger.info(f"数据保留策略已启用（保留 {RETENTION_DAYS} 天，间隔 {RETENTION_INTERVAL}s）")
@@ -0,0 +1,156 @@
+"""
+后台调度器模块
+注册周期性维护任务（清理过期验证码、发件箱记录、按保留策略创建清理任务等），
+整个部署中只由一个进程（主节点）按间隔执行，每次执行的耗时和结果记录在 scheduler_runs 表中。
+
+- 主节点通过数据库中的租约选举：每个进程的调度线程定期尝试获取/续约租约，
+  主节点进程退出后租约过期（或退出时主动释放），由其他进程接管
+- 任务执行期间由心跳线程按租约时长的三分之一续约，耗时超过租约的任务不会让其他进程中途接管
+- 每次执行前用一条 UPDATE 认领任务（距上次开始已超过间隔），主节点切换期间也不会重复执行
+- 任务函数的返回值（如删除条数）作为执行结果记录，抛出异常时记录为失败，下个间隔再执行
+
+配置（环境变量）：
+    SCHEDULER_ENABLED  是否在当前进程启动调度线程，默认 true
+    SCHEDULER_TICK  检查到期任务的间隔（秒），默认 5
+    SCHEDULER_LEASE_SECONDS  主节点租约时长（秒），默认 30
+    SCHEDULER_HISTORY_DAYS  执行记录保留天数，默认 30
+"""
+
+import os
+import time
+import uuid
+import atexit
+import logging
+import threading
+
+from database import (
+    acquire_scheduler_lease, release_scheduler_lease, get_scheduler_leader, claim_scheduled_job,
+    record_scheduler_run, get_scheduler_jobs, get_scheduler_runs, purge_scheduler_runs
+)
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", 5))
+SCHEDULER_LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", 30))
+SCHEDULER_HISTORY_DAYS = int(os.getenv("SCHEDULER_HISTORY_DAYS", 30))
+
+# 已注册的任务：{任务名: {"interval": 秒, "func": 函数, "description": 说明}}，按注册顺序执行
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+_owner = None
+_is_leader = False
+_started = False
+_start_lock = threading.Lock()
+
+
+def register(name, interval, func, description=""):
+    """注册周期任务（同名任务重复注册时覆盖），func 无参数，返回值作为执行结果记录"""
+    with _jobs_lock:
+        _jobs[name] = {"interval": interval, "func": func, "description": description}
+
+
+def _run_job(name, job):
+    """执行一次任务并记录耗时和结果"""
+    started_at = time.time()
+    start = time.perf_counter()
+    status, result, error = "success", None, None
+    try:
+        result = job["func"]()
+    except Exception as e:
+        status, error = "failed", str(e) or type(e).__name__
+        logger.error(f"定时任务 {name} 执行失败: {e}", exc_info=e)
+    duration_ms = int((time.perf_counter() - start) * 1000)
+    record_scheduler_run(name, _owner, started_at, duration_ms, status, result, error)
+    if status == "success" and result:
+        logger.info(f"定时任务 {name} 完成（{duration_ms}ms）: {result}")
+
+
+def _renew_lease(stop):
+    """心跳线程：任务执行期间定期续约，直到 stop 被设置或租约丢失"""
+    while not stop.wait(SCHEDULER_LEASE_SECONDS / 3):
+        try:
+            if not acquire_scheduler_lease(_owner, SCHEDULER_LEASE_SECONDS):
+                logger.warning("定时任务执行期间调度器主节点租约已失效")
+                return
+        except Exception as e:
+            logger.error(f"调度器续约失败: {e}", exc_info=e)
+
+
+def _run_due_jobs():
+    """主节点：依次执行到期的任务，每个任务执行前续约，租约丢失时停止"""
+    global _is_leader
+    with _jobs_lock:
+        jobs = list(_jobs.items())
+    for name, job in jobs:
+        if not acquire_scheduler_lease(_owner, SCHEDULER_LEASE_SECONDS):
+            _is_leader = False
+            logger.info("调度器主节点租约已失效，停止执行定时任务")
+            return
+        if claim_scheduled_job(name, job["interval"], _owner):
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=_renew_lease, args=(stop,), daemon=True)
+            heartbeat.start()
+            try:
+                _run_job(name, job)
+            finally:
+                stop.set()
+                heartbeat.join()
+
+
+def _scheduler_loop():
+    """后台线程：竞选主节点，当选后执行到期任务"""
+    global _is_leader
+    while True:
+        try:
+            leader = acquire_scheduler_lease(_owner, SCHEDULER_LEASE_SECONDS)
+            if leader != _is_leader:
+                logger.info(f"进程 {os.getpid()} {'成为' if leader else '不再是'}调度器主节点")
+            _is_leader = leader
+            if leader:
+                _run_due_jobs()
+        except Exception as e:
+            logger.error(f"调度器错误: {e}", exc_info=e)
+        time.sleep(SCHEDULER_TICK)
+
+
+def _release():
+    if _is_leader:
+        try:
+            release_scheduler_lease(_owner)
+        except Exception:
+            pass
+
+
+def start():
+    """启动当前进程的调度线程（重复调用只启动一次）"""
+    global _started, _owner
+    if not SCHEDULER_ENABLED:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    _owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    register("scheduler_history", 86400, lambda: purge_scheduler_runs(SCHEDULER_HISTORY_DAYS),
+             f"删除 {SCHEDULER_HISTORY_DAYS} 天前的定时任务执行记录")
+    atexit.register(_release)
+    threading.Thread(target=_scheduler_loop, daemon=True).start()
+
+
+def status(limit=50, job=None):
+    """返回调度器状态：主节点、各任务的间隔与最近执行情况、最近的执行记录（管理后台展示用）"""
+    states = get_scheduler_jobs()
+    with _jobs_lock:
+        jobs = [
+            dict(states.get(name, {}), name=name, interval_seconds=item["interval"], description=item["description"])
+            for name, item in _jobs.items()
+        ]
+    return {
+        "enabled": SCHEDULER_ENABLED,
+        "leader": get_scheduler_leader(),
+        "is_leader": _is_leader,
+        "jobs": jobs,
+        "runs": get_scheduler_runs(limit=limit, job=job)
+    }
@@ -0,0 +1,109 @@
+"""
+会话数据序列化模块
+会话文件的编码格式可配置，读取时按文件头自动识别，切换格式后已有文件照常读取，下次写入该会话时转换为新格式：
+
+- json：紧凑 JSON（不缩进），安装 orjson 时使用其编解码，否则使用标准库；不压缩时没有文件头，
+  与旧版缩进 JSON 一样可以直接用文本工具查看
+- msgpack：MessagePack 二进制格式（需要安装 msgpack），体积更小、解析更快
+- 两种格式都可以再用 zstd 压缩（需要安装 zstandard），适合历史很长的会话
+- 二进制格式和压缩后的数据以 MAGIC + 格式标记 + 压缩标记开头；没有文件头的按 JSON 解析（兼容旧文件）
+
+文件名仍为 <session_id>.json，会话存储的其他逻辑不受格式影响。
+
+配置（环境变量）：
+    SESSION_FORMAT  写入格式（json / msgpack），默认 json
+    SESSION_COMPRESSION  压缩方式（none / zstd），默认 none
+    SESSION_ZSTD_LEVEL  zstd 压缩级别，默认 3
+"""
+
+import os
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，缺失时使用标准库 json
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # SESSION_FORMAT=msgpack 或读取 msgpack 文件时需要
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # SESSION_COMPRESSION=zstd 或读取压缩文件时需要
+    zstandard = None
+
+SESSION_FORMAT = os.getenv("SESSION_FORMAT", "json").strip().lower()
+SESSION_COMPRESSION = os.getenv("SESSION_COMPRESSION", "none").strip().lower()
+SESSION_ZSTD_LEVEL = int(os.getenv("SESSION_ZSTD_LEVEL", 3))
+
+MAGIC = b"NBS\x01"
+_FORMAT_MARKS = {"json": b"j", "msgpack": b"m"}
+_COMPRESSION_MARKS = {"none": b"-", "zstd": b"z"}
+_HEADER_SIZE = len(MAGIC) + 2
+
+
+def _require(module, name, setting):
+    if module is None:
+        raise RuntimeError(f"{setting}需要安装 {name}")
+    return module
+
+
+def _encode(data, fmt):
+    if fmt == "msgpack":
+        return _require(msgpack, "msgpack", "msgpack 格式").packb(data, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _decode(raw, fmt):
+    if fmt == "msgpack":
+        _require(msgpack, "msgpack", "msgpack 格式")
+        try:
+            return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"msgpack 数据无效: {e}") from e
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+
+def dumps(data, fmt=None, compression=None):
+    """按配置（或指定的格式和压缩方式）编码会话数据，返回字节串"""
+    fmt = fmt or SESSION_FORMAT
+    compression = compression or SESSION_COMPRESSION
+    if fmt not in _FORMAT_MARKS:
+        raise RuntimeError(f"未知的 SESSION_FORMAT: {fmt}")
+    if compression not in _COMPRESSION_MARKS:
+        raise RuntimeError(f"未知的 SESSION_COMPRESSION: {compression}")
+    body = _encode(data, fmt)
+    if compression == "zstd":
+        body = _require(zstandard, "zstandard", "zstd 压缩").ZstdCompressor(level=SESSION_ZSTD_LEVEL).compress(body)
+    elif fmt == "json":
+        return body
+    return MAGIC + _FORMAT_MARKS[fmt] + _COMPRESSION_MARKS[compression] + body
+
+
+def loads(raw):
+    """
+    解码会话数据（按文件头自动识别格式），数据损坏时抛出 ValueError
+    读取需要未安装的可选依赖时抛出 RuntimeError（不能当作损坏处理）
+    """
+    if not raw.startswith(MAGIC):
+        return _decode(raw, "json")
+    format_mark = raw[len(MAGIC):len(MAGIC) + 1]
+    compression_mark = raw[len(MAGIC) + 1:_HEADER_SIZE]
+    fmt = next((name for name, mark in _FORMAT_MARKS.items() if mark == format_mark), None)
+    compression = next((name for name, mark in _COMPRESSION_MARKS.items() if mark == compression_mark), None)
+    if fmt is None or compression is None:
+        raise ValueError(f"未知的会话数据格式标记: {raw[:_HEADER_SIZE]!r}")
+    body = raw[_HEADER_SIZE:]
+    if compression == "zstd":
+        _require(zstandard, "zstandard", "zstd 压缩")
+        try:
+            body = zstandard.ZstdDecompressor().decompress(body)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"zstd 数据无效: {e}") from e
+    return _decode(body, fmt)
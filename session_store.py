@@ -0,0 +1,642 @@
+"""
+会话存储模块
+每个会话单独保存为 data/sessions/user_<id>/<session_id>.json，并使用各自的文件锁：
+- 同一用户不同会话的读写互不阻塞，可以在多个标签页中同时生成
+- 写入基于修订号（revision）做乐观并发控制：读取时记下修订号，写入时在锁内比对，
+  不一致说明期间有其他请求修改过该会话，update_session 会重新读取最新数据并重放修改
+- 文件锁只在比对和写入的瞬间持有，不会在等待上游生成期间阻塞其他请求
+- 每次写入都在锁内同步数据库中的会话索引、媒体文件索引、消息搜索索引、生成图片索引和用户用量计数
+- 新建会话和修改标题只写入数据库中的延迟写入记录（同时更新会话索引），合并 SESSION_WRITE_DELAY 秒内的
+  多次修改后由后台线程写入会话文件；读取时叠加未写入的修改，其他写入也会顺带写入；
+  记录随数据库事务提交，进程崩溃后由调度器补写，进程退出时写入全部未完成的记录
+
+旧版本的 user_<id>.json（每个用户一个文件）会在首次访问或后台回填时自动拆分。
+
+配置（环境变量）：
+    SESSION_WRITE_BEHIND  新建会话和修改标题是否延迟写入会话文件，默认 true
+    SESSION_WRITE_DELAY  延迟写入的合并窗口（秒），默认 2
+"""
+
+import os
+import re
+import json
+import time
+import atexit
+import shutil
+import logging
+import threading
+from filelock import FileLock
+from PIL import Image
+
+from database import (
+    sync_session_data, remove_session_data, get_user_session_list, get_meta, set_meta,
+    queue_session_write, get_session_pending_write, get_pending_session_creates, get_due_session_writes,
+    clear_session_pending_write
+)
+import image_storage
+import serializer
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_DIR = "data/sessions"  # 每个用户一个子目录，每个会话一个文件
+IMAGES_DIR = "static/images"
+THUMBNAILS_DIR = "static/thumbnails"
+
+LOCK_TIMEOUT = 10
+MAX_UPDATE_RETRIES = 5
+SESSION_WRITE_BEHIND = os.getenv("SESSION_WRITE_BEHIND", "true").lower() == "true"
+SESSION_WRITE_DELAY = float(os.getenv("SESSION_WRITE_DELAY", 2))
+FLUSH_BATCH_SIZE = 200
+
+# 会话 ID 为标准 36 位 UUID 字符串（路由校验和文件路径使用同一规则）
+_SESSION_ID_PATTERN = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+_LEGACY_FILE_PATTERN = re.compile(r'^user_(\d+)\.json$')
+_USER_DIR_PATTERN = re.compile(r'^user_(\d+)$')
+
+# 由会话文件派生、需要对已有会话回填的索引版本（app_meta 中记录已回填完成的版本）
+# 新增一种派生索引时递增 SESSION_INDEX_VERSION，后台回填会重新同步全部用户
+SEARCH_INDEX_VERSION = 1  # 消息搜索索引
+IMAGE_INDEX_VERSION = 2  # 生成图片索引
+SESSION_INDEX_VERSION = IMAGE_INDEX_VERSION
+SESSION_INDEX_VERSION_KEY = "session_index_version"
+SESSION_INDEX_CURSOR_KEY = f"session_index_backfill_cursor_v{SESSION_INDEX_VERSION}"
+
+# 已确认没有旧版会话文件的用户（进程内缓存，避免每次访问都检查）
+_migrated_users = set()
+
+
+class SessionConflict(Exception):
+    """会话在读取之后被其他请求修改（修订号不一致）"""
+
+
+def is_valid_session_id(session_id):
+    """会话 ID 是否为标准 36 位 UUID 字符串"""
+    return isinstance(session_id, str) and _SESSION_ID_PATTERN.fullmatch(session_id) is not None
+
+
+def _user_dir(user_id):
+    return os.path.join(SESSIONS_DIR, f"user_{int(user_id)}")
+
+
+def _session_path(user_id, session_id):
+    if not is_valid_session_id(session_id):
+        raise ValueError(f"无效的会话ID: {session_id}")
+    return os.path.join(_user_dir(user_id), f"{session_id}.json")
+
+
+def _legacy_file(user_id):
+    return os.path.join(SESSIONS_DIR, f"user_{int(user_id)}.json")
+
+
+def _session_lock(user_id, session_id):
+    return FileLock(_session_path(user_id, session_id) + ".lock", timeout=LOCK_TIMEOUT)
+
+
+def _read_json(path):
+    """读取会话文件（按文件头识别格式），不存在返回 None；文件损坏时备份并删除，返回 None"""
+    try:
+        with open(path, "rb") as f:
+            return serializer.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.error(f"会话文件损坏 ({path}): {e}")
+        backup_file = f"{path}.corrupt.{int(time.time())}"
+        try:
+            shutil.copy2(path, backup_file)
+            logger.info(f"已备份损坏的会话文件到: {backup_file}")
+        except Exception as backup_error:
+            logger.error(f"备份失败: {backup_error}")
+        try:
+            os.remove(path)
+        except Exception as remove_error:
+            logger.error(f"删除损坏文件失败: {remove_error}")
+        return None
+
+
+def _write_json(path, data):
+    """原子写入会话文件（格式由 SESSION_FORMAT / SESSION_COMPRESSION 决定）"""
+    tmp_file = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_file, "wb") as f:
+        f.write(serializer.dumps(data))
+    os.replace(tmp_file, path)
+
+
+# ========== 用量与索引 ==========
+
+def message_image_files(msg):
+    """返回消息关联的所有图片文件路径（生成图片、缩略图、参考图片）"""
+    paths = []
+    if msg.get("image"):
+        paths.append(os.path.join(IMAGES_DIR, os.path.basename(msg["image"])))
+    if msg.get("thumbnail"):
+        paths.append(os.path.join(THUMBNAILS_DIR, os.path.basename(msg["thumbnail"])))
+    for ref_img in msg.get("reference_images") or []:
+        paths.append(os.path.join(IMAGES_DIR, os.path.basename(ref_img)))
+    return paths
+
+
+def _message_image_bytes(msg):
+    """获取消息关联图片的总字节数（结果缓存在消息的 image_bytes 字段，旧消息首次保存时补全）"""
+    if "image_bytes" not in msg:
+        total = 0
+        for path in message_image_files(msg):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                # 原图可能已迁移到冷存储
+                total += image_storage.archived_size(path) or 0
+        msg["image_bytes"] = total
+    return msg["image_bytes"]
+
+
+def read_image_info(path):
+    """读取图片尺寸（只解析文件头，不解码像素）和文件大小，无法读取时返回 None"""
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+        return {"width": width, "height": height, "size": os.path.getsize(path)}
+    except (OSError, ValueError):
+        return None
+
+
+def _message_image_info(msg):
+    """获取生成图片的尺寸和大小（结果缓存在消息的 image_info 字段，旧消息首次保存时补全）"""
+    if "image_info" not in msg:
+        msg["image_info"] = read_image_info(os.path.join(IMAGES_DIR, os.path.basename(msg["image"])))
+    return msg["image_info"] or {}
+
+
+def summarize_session(session_data):
+    """
+    由会话数据计算索引记录、媒体文件列表、搜索索引条目和生成图片索引条目
+    返回: (entry: dict, media_entries: [(filename, kind, created_at)], search_entries: [dict], image_entries: [dict])
+    """
+    messages = session_data.get("messages", [])
+    # 旧消息没有记录模型，会话设置在首次生成后锁定，可以代表会话中所有图片的模型
+    session_model = (session_data.get("settings") or {}).get("model")
+    image_count = 0
+    image_bytes = 0
+    timestamps = []
+    media_entries = []
+    search_entries = []
+    image_entries = []
+    for position, msg in enumerate(messages):
+        timestamp = msg.get("timestamp")
+        if timestamp:
+            timestamps.append(timestamp)
+        if msg.get("image"):
+            image_count += 1
+            media_entries.append((os.path.basename(msg["image"]), "image", timestamp))
+            info = _message_image_info(msg)
+            image_entries.append({
+                "filename": os.path.basename(msg["image"]),
+                "position": position,
+                "image": msg["image"],
+                "thumbnail": msg.get("thumbnail"),
+                "width": info.get("width"),
+                "height": info.get("height"),
+                "size": info.get("size"),
+                "model": msg.get("model") or session_model,
+                "created_at": timestamp or session_data.get("created_at") or ""
+            })
+        if msg.get("thumbnail"):
+            media_entries.append((os.path.basename(msg["thumbnail"]), "thumbnail", timestamp))
+        for ref_img in msg.get("reference_images") or []:
+            image_count += 1
+            media_entries.append((os.path.basename(ref_img), "image", timestamp))
+        image_bytes += _message_image_bytes(msg)
+        content = (msg.get("content") or "").strip()
+        if content:
+            # 提示词没有自己的图片，搜索结果展示同一轮模型回复生成的图片
+            result = msg if msg.get("image") else None
+            if result is None and msg.get("role") == "user" and position + 1 < len(messages):
+                result = messages[position + 1]
+            search_entries.append({
+                "position": position,
+                "role": msg.get("role", "user"),
+                "content": content,
+                "timestamp": timestamp,
+                "image": (result or {}).get("image"),
+                "thumbnail": (result or {}).get("thumbnail")
+            })
+
+    # 空会话按最后更新时间参与保留策略；消息都没有时间戳的会话不会过期
+    if timestamps:
+        oldest_at = min(timestamps)
+    elif not messages:
+        oldest_at = session_data.get("updated_at") or ""
+    else:
+        oldest_at = None
+
+    entry = {
+        "title": session_data.get("title", "新对话"),
+        "created_at": session_data.get("created_at"),
+        "updated_at": session_data.get("updated_at"),
+        "oldest_at": oldest_at,
+        "message_count": len(messages),
+        "image_count": image_count,
+        "image_bytes": image_bytes
+    }
+    return entry, media_entries, search_entries, image_entries
+
+
+def _sync_index(user_id, session_id, summary):
+    """同步会话索引（失败只记录日志，下次写入会以完整数据重新计算）"""
+    try:
+        sync_session_data(user_id, session_id, *summary)
+    except Exception as e:
+        logger.error(f"同步会话索引失败 (user {user_id}, session {session_id}): {e}")
+
+
+def _remove_index(user_id, session_id):
+    try:
+        remove_session_data(user_id, session_id)
+    except Exception as e:
+        logger.error(f"删除会话索引失败 (user {user_id}, session {session_id}): {e}")
+
+
+def _write_session_locked(user_id, session_id, session_data):
+    """写入会话文件并同步索引（调用方需持有该会话的文件锁）"""
+    summary = summarize_session(session_data)
+    _write_json(_session_path(user_id, session_id), session_data)
+    _sync_index(user_id, session_id, summary)
+
+
+# ========== 旧版数据迁移 ==========
+
+def migrate_legacy(user_id):
+    """把旧版 user_<id>.json 拆分为每个会话一个文件，原文件改名为 .migrated 保留备份"""
+    legacy_file = _legacy_file(user_id)
+    if not os.path.exists(legacy_file):
+        _migrated_users.add(user_id)
+        return 0
+
+    migrated = 0
+    with FileLock(legacy_file + ".lock", timeout=LOCK_TIMEOUT):
+        if not os.path.exists(legacy_file):
+            _migrated_users.add(user_id)
+            return 0
+        sessions = _read_json(legacy_file) or {}
+        os.makedirs(_user_dir(user_id), exist_ok=True)
+        for session_id, session_data in sessions.items():
+            if not is_valid_session_id(session_id):
+                logger.warning(f"跳过无效的会话ID (user {user_id}): {session_id}")
+                continue
+            with _session_lock(user_id, session_id):
+                # 已经存在新格式文件时以其为准，不覆盖
+                if not os.path.exists(_session_path(user_id, session_id)):
+                    _write_session_locked(user_id, session_id, session_data)
+                    migrated += 1
+        if os.path.exists(legacy_file):
+            os.replace(legacy_file, legacy_file + ".migrated")
+    try:
+        os.remove(legacy_file + ".lock")
+    except OSError:
+        pass
+
+    _migrated_users.add(user_id)
+    logger.info(f"已将用户 {user_id} 的 {migrated} 个会话迁移为独立文件")
+    return migrated
+
+
+def _ensure_migrated(user_id):
+    if user_id not in _migrated_users:
+        migrate_legacy(user_id)
+
+
+def legacy_user_ids():
+    """列出仍有旧版会话文件的用户 ID"""
+    if not os.path.isdir(SESSIONS_DIR):
+        return []
+    user_ids = []
+    for filename in os.listdir(SESSIONS_DIR):
+        match = _LEGACY_FILE_PATTERN.match(filename)
+        if match:
+            user_ids.append(int(match.group(1)))
+    return sorted(user_ids)
+
+
+def session_user_ids():
+    """列出有会话目录的用户 ID（升序）"""
+    if not os.path.isdir(SESSIONS_DIR):
+        return []
+    user_ids = []
+    for filename in os.listdir(SESSIONS_DIR):
+        match = _USER_DIR_PATTERN.match(filename)
+        if match:
+            user_ids.append(int(match.group(1)))
+    return sorted(user_ids)
+
+
+def index_version():
+    """已对全部已有会话回填完成的派生索引版本"""
+    return int(get_meta(SESSION_INDEX_VERSION_KEY, 0))
+
+
+def backfill_session_indexes(time_budget=20):
+    """
+    为派生索引上线前已有的会话补建索引（由调度器在主节点定期执行，回填到最新版本后不再处理）
+    按用户 ID 顺序重新同步每个用户的会话，进度保存在 app_meta 中，
+    每次最多执行 time_budget 秒，未完成的部分下次从游标处继续
+    返回: 本次处理情况，已是最新版本时返回 None
+    """
+    if index_version() >= SESSION_INDEX_VERSION:
+        return None
+    deadline = time.monotonic() + time_budget
+    after = int(get_meta(SESSION_INDEX_CURSOR_KEY, 0))
+    user_ids = sorted(set(session_user_ids()) | set(legacy_user_ids()))
+    processed = 0
+    for user_id in user_ids:
+        if user_id <= after:
+            continue
+        if time.monotonic() > deadline:
+            return {"users": processed, "cursor": after, "finished": False}
+        resync_user(user_id)
+        after = user_id
+        set_meta(SESSION_INDEX_CURSOR_KEY, after)
+        processed += 1
+    set_meta(SESSION_INDEX_VERSION_KEY, SESSION_INDEX_VERSION)
+    logger.info(f"会话派生索引已回填到版本 {SESSION_INDEX_VERSION}")
+    return {"users": processed, "cursor": after, "finished": True}
+
+
+# ========== 读写接口 ==========
+
+def _apply_pending(session_data, pending):
+    """把未写入文件的元数据修改叠加到会话数据"""
+    if pending["title"] is not None:
+        session_data["title"] = pending["title"]
+    if pending["updated_at"] is not None:
+        session_data["updated_at"] = pending["updated_at"]
+
+
+def _read_session(user_id, session_id):
+    """
+    读取会话文件和延迟写入记录，返回 (会话数据, 延迟写入记录)
+    先读记录再读文件：期间记录被写入文件时叠加的是相同的修改
+    """
+    pending = get_session_pending_write(user_id, session_id)
+    session_data = _read_json(_session_path(user_id, session_id))
+    if session_data is None:
+        if pending is None or pending["created"] is None:
+            return None, None
+        session_data = json.loads(pending["created"])
+    return session_data, pending
+
+
+def get_session(user_id, session_id):
+    """
+    读取单个会话，不存在返回 None（读取不加锁，写入是原子替换，不会读到半个文件）
+    有未写入文件的元数据修改时叠加到结果中，并在 pending_stamp 字段中返回其版本戳（用于 ETag）
+    """
+    _ensure_migrated(user_id)
+    session_data, pending = _read_session(user_id, session_id)
+    if pending is not None:
+        _apply_pending(session_data, pending)
+        session_data["pending_stamp"] = pending["stamp"]
+    return session_data
+
+
+def create_session(user_id, session_id, session_data, deferred=False):
+    """
+    创建新会话，会话已存在时抛出 SessionConflict
+    deferred=True 时（且开启了 SESSION_WRITE_BEHIND）只写入延迟写入记录和会话索引，会话文件稍后写入
+    """
+    _ensure_migrated(user_id)
+    if deferred and SESSION_WRITE_BEHIND:
+        if os.path.exists(_session_path(user_id, session_id)):
+            raise SessionConflict(session_id)
+        queue_session_write(user_id, session_id, created=json.dumps(session_data, ensure_ascii=False),
+                            index_entry=summarize_session(session_data)[0])
+        _schedule_flush()
+        return
+    os.makedirs(_user_dir(user_id), exist_ok=True)
+    with _session_lock(user_id, session_id):
+        if os.path.exists(_session_path(user_id, session_id)):
+            raise SessionConflict(session_id)
+        _write_session_locked(user_id, session_id, session_data)
+
+
+def update_session_metadata(user_id, session_id, title=None, updated_at=None):
+    """
+    修改会话标题和更新时间（None 表示不修改），会话不存在时返回 False
+    开启 SESSION_WRITE_BEHIND 时只写入延迟写入记录和会话索引，同一会话短时间内的多次修改合并为一次文件写入
+    """
+    if not SESSION_WRITE_BEHIND:
+        def apply(session_data):
+            _apply_pending(session_data, {"title": title, "updated_at": updated_at})
+            session_data["revision"] = session_data.get("revision", 0) + 1
+
+        session_data, _ = update_session(user_id, session_id, apply)
+        return session_data is not None
+
+    _ensure_migrated(user_id)
+    if not os.path.exists(_session_path(user_id, session_id)):
+        pending = get_session_pending_write(user_id, session_id)
+        if pending is None or pending["created"] is None:
+            return False
+    queue_session_write(user_id, session_id, title=title, updated_at=updated_at)
+    _schedule_flush()
+    return True
+
+
+def save_session(user_id, session_id, session_data, expected_revision, pending_stamp=None):
+    """
+    保存会话（比较并交换）：只有文件中的修订号仍等于 expected_revision 时才写入
+    否则抛出 SessionConflict；会话已被删除时返回 False
+    expected_revision 为 None 表示写入延迟创建的会话（文件必须还不存在）
+    pending_stamp: 已合并到 session_data 中的延迟写入记录的版本戳，写入后删除该记录（期间有新的修改时保留）
+    """
+    path = _session_path(user_id, session_id)
+    os.makedirs(_user_dir(user_id), exist_ok=True)
+    with _session_lock(user_id, session_id):
+        current = _read_json(path)
+        if expected_revision is None:
+            if current is not None:
+                raise SessionConflict(session_id)
+            pending = get_session_pending_write(user_id, session_id)
+            if pending is None or pending["created"] is None:
+                return False
+        elif current is None:
+            return False
+        elif current.get("revision", 0) != expected_revision:
+            raise SessionConflict(session_id)
+        _write_session_locked(user_id, session_id, session_data)
+        if pending_stamp is not None:
+            clear_session_pending_write(user_id, session_id, pending_stamp)
+    return True
+
+
+def update_session(user_id, session_id, mutate):
+    """
+    读取-修改-写入会话：mutate(session_data) 原地修改并返回任意结果
+    写入时修订号冲突则重新读取最新数据并重放 mutate（mutate 必须可重复执行，且不能有外部副作用）
+    mutate 需要在修改内容时递增修订号，修订号未变化视为没有修改，不写入文件
+    未写入文件的元数据修改在 mutate 之前合并（递增一次修订号），随本次写入一起写入文件
+    返回: (session_data, mutate 的返回值)，会话不存在时返回 (None, None)
+    """
+    _ensure_migrated(user_id)
+    for attempt in range(MAX_UPDATE_RETRIES):
+        session_data, pending = _read_session(user_id, session_id)
+        if session_data is None:
+            return None, None
+        base_revision = session_data.get("revision", 0) if os.path.exists(_session_path(user_id, session_id)) else None
+        if pending is not None:
+            _apply_pending(session_data, pending)
+            session_data["revision"] = session_data.get("revision", 0) + 1
+        revision = session_data.get("revision", 0)
+        result = mutate(session_data)
+        if pending is None and session_data.get("revision", 0) == revision:
+            return session_data, result
+        try:
+            if not save_session(user_id, session_id, session_data, base_revision,
+                                pending["stamp"] if pending else None):
+                return None, None
+            return session_data, result
+        except SessionConflict:
+            logger.info(f"会话写入冲突，重试 (user {user_id}, session {session_id}, 第 {attempt + 1} 次)")
+            time.sleep(0.01 * (attempt + 1))
+    raise SessionConflict(session_id)
+
+
+def delete_session(user_id, session_id, expected_revision=None):
+    """
+    删除会话，返回被删除的会话数据（调用方负责删除图片文件），不存在返回 None
+    指定 expected_revision 时，只有修订号未变化才删除，否则抛出 SessionConflict
+    """
+    _ensure_migrated(user_id)
+    path = _session_path(user_id, session_id)
+    os.makedirs(_user_dir(user_id), exist_ok=True)
+    with _session_lock(user_id, session_id):
+        current, pending = _read_session(user_id, session_id)
+        if current is None:
+            return None
+        if expected_revision is not None and current.get("revision", 0) != expected_revision:
+            raise SessionConflict(session_id)
+        if pending is not None:
+            _apply_pending(current, pending)
+            clear_session_pending_write(user_id, session_id)
+        if os.path.exists(path):
+            os.remove(path)
+        _remove_index(user_id, session_id)
+    try:
+        os.remove(path + ".lock")
+    except OSError:
+        pass
+    return current
+
+
+def list_sessions(user_id):
+    """获取用户的会话列表（来自数据库中的会话索引，不读取会话文件）"""
+    _ensure_migrated(user_id)
+    return get_user_session_list(user_id)
+
+
+def list_session_ids(user_id):
+    """列出用户所有会话 ID（读取目录，不读取文件内容；包括延迟创建、尚未写入文件的会话）"""
+    _ensure_migrated(user_id)
+    session_ids = set(get_pending_session_creates(user_id))
+    user_dir = _user_dir(user_id)
+    if os.path.isdir(user_dir):
+        session_ids.update(filename[:-len(".json")] for filename in os.listdir(user_dir)
+                           if filename.endswith(".json") and is_valid_session_id(filename[:-len(".json")]))
+    return list(session_ids)
+
+
+def load_user_sessions(user_id):
+    """读取用户的全部会话（管理员删除用户、索引回填等低频操作使用）"""
+    sessions = {}
+    for session_id in list_session_ids(user_id):
+        session_data = get_session(user_id, session_id)
+        if session_data is not None:
+            session_data.pop("pending_stamp", None)
+            sessions[session_id] = session_data
+    return sessions
+
+
+def resync_user(user_id):
+    """按会话文件重新同步用户的全部索引和用量计数（不改写会话文件）"""
+    for session_id in list_session_ids(user_id):
+        os.makedirs(_user_dir(user_id), exist_ok=True)
+        with _session_lock(user_id, session_id):
+            session_data, pending = _read_session(user_id, session_id)
+            if session_data is not None:
+                if pending is not None:
+                    _apply_pending(session_data, pending)
+                _sync_index(user_id, session_id, summarize_session(session_data))
+
+
+def delete_user_sessions(user_id):
+    """删除用户的全部会话文件和目录，返回被删除的会话数据（调用方负责删除图片文件）"""
+    sessions = {}
+    for session_id in list_session_ids(user_id):
+        session_data = delete_session(user_id, session_id)
+        if session_data is not None:
+            sessions[session_id] = session_data
+    shutil.rmtree(_user_dir(user_id), ignore_errors=True)
+    for suffix in (".migrated", ".lock"):
+        try:
+            os.remove(_legacy_file(user_id) + suffix)
+        except OSError:
+            pass
+    _migrated_users.discard(user_id)
+    return sessions
+
+
+# ========== 延迟写入 ==========
+
+_flush_wakeup = None
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _schedule_flush():
+    """唤醒当前进程的后台写入线程（按进程启动，进程退出时写入全部未完成的记录）"""
+    global _flush_wakeup, _flusher_pid
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            _flush_wakeup = threading.Event()
+            _flusher_pid = os.getpid()
+            threading.Thread(target=_flush_loop, args=(_flush_wakeup,), name="session-write-behind",
+                             daemon=True).start()
+            atexit.register(flush_pending_writes)
+    _flush_wakeup.set()
+
+
+def _flush_loop(wakeup):
+    while True:
+        wakeup.wait()
+        wakeup.clear()
+        # 等待合并窗口结束，期间的修改合并为一次写入
+        time.sleep(SESSION_WRITE_DELAY)
+        try:
+            flush_pending_writes(SESSION_WRITE_DELAY)
+        except Exception as e:
+            logger.error(f"写入延迟的会话修改失败: {e}")
+
+
+def flush_pending_writes(min_age=0):
+    """
+    把排队超过 min_age 秒的延迟写入记录写入会话文件（后台线程、调度器和进程退出时调用）
+    返回: 写入的会话数
+    """
+    flushed = 0
+    failed = set()
+    while True:
+        due = [key for key in get_due_session_writes(time.time() - min_age, FLUSH_BATCH_SIZE + len(failed))
+               if key not in failed]
+        if not due:
+            return flushed
+        for user_id, session_id in due:
+            try:
+                session_data, _ = update_session(user_id, session_id, lambda data: None)
+            except Exception as e:
+                failed.add((user_id, session_id))
+                logger.error(f"写入延迟的会话修改失败 (user {user_id}, session {session_id}): {e}")
+                continue
+            if session_data is None:
+                # 会话已被删除，丢弃残留的记录
+                clear_session_pending_write(user_id, session_id)
+            else:
+                flushed += 1
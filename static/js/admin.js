@@ -3,16 +3,52 @@
 // ========================================
 
 let users = [];
+let usersTotal = 0;
+let usersStats = null;
+// 用户列表查询状态（键集分页、排序、筛选均在服务端完成）
+const userQuery = {
+    pageSize: 50,
+    sort: 'created_at',
+    order: 'desc',
+    q: '',
+    role: '',
+    createdFrom: '',
+    createdTo: '',
+    cursor: null,       // 当前页的游标（第一页为 null）
+    history: [],        // 之前各页的游标，用于返回上一页
+    nextCursor: null
+};
 let currentSessions = []; // Store current user sessions (list only)
 let currentViewUserId = null; // Track which user's sessions are being viewed
 
 // 加载用户数据
 async function loadUsers() {
+    const params = new URLSearchParams({
+        page_size: userQuery.pageSize,
+        sort: userQuery.sort,
+        order: userQuery.order
+    });
+    if (userQuery.q) params.set('q', userQuery.q);
+    if (userQuery.role) params.set('role', userQuery.role);
+    if (userQuery.createdFrom) params.set('created_from', userQuery.createdFrom);
+    if (userQuery.createdTo) params.set('created_to', userQuery.createdTo);
+    if (userQuery.cursor) params.set('cursor', userQuery.cursor);
+
     try {
-        const response = await fetch('/api/admin/users');
+        const response = await fetch(`/api/admin/users?${params}`);
         if (response.ok) {
-            users = await response.json();
+            const result = await response.json();
+            users = result.users;
+            usersTotal = result.total;
+            usersStats = result.stats;
+            userQuery.nextCursor = result.next_cursor;
+            // 删除用户后当前页可能已为空，回退到上一页
+            if (users.length === 0 && userQuery.history.length > 0) {
+                userQuery.cursor = userQuery.history.pop();
+                return loadUsers();
+            }
             renderUsers();
+            renderPagination();
             updateStats();
         } else if (response.status === 401) {
             window.location.href = '/login';
@@ -30,7 +66,7 @@ async function loadUsers() {
 function renderUsers() {
     const tbody = document.getElementById('userTableBody');
     if (users.length === 0) {
-        tbody.innerHTML = `<tr><td colspan="8" class="empty-cell">${I18n.t('no_users')}</td></tr>`;
+        tbody.innerHTML = `<tr><td colspan="12" class="empty-cell">${I18n.t('no_users')}</td></tr>`;
         return;
     }
 
@@ -49,6 +85,10 @@ function renderUsers() {
             <td>${user.credits !== undefined ? user.credits : '-'}</td>
             <td>${user.session_count || 0}</td>
             <td>${user.message_count || 0}</td>
+            <td>${user.image_count || 0}</td>
+            <td>${formatBytes(user.image_bytes || 0)}</td>
+            <td>${user.generation_count || 0}</td>
+            <td>${user.credits_spent || 0}</td>
             <td>${formatDate(user.created_at)}</td>
             <td class="action-cell">
                 <button class="btn-action btn-view" onclick="viewSessions(${user.id}, '${user.username}')">
@@ -70,12 +110,74 @@ function renderUsers() {
     `).join('');
 }
 
-// 更新统计数据
+// 渲染分页信息
+function renderPagination() {
+    const totalPages = Math.max(1, Math.ceil(usersTotal / userQuery.pageSize));
+    document.getElementById('userPageInfo').textContent =
+        I18n.t('page_info', userQuery.history.length + 1, totalPages, usersTotal);
+    document.getElementById('userPrevPage').disabled = userQuery.history.length === 0;
+    document.getElementById('userNextPage').disabled = !userQuery.nextCursor;
+
+    // 更新表头排序指示
+    document.querySelectorAll('.user-table th.sortable').forEach(th => {
+        th.classList.remove('sort-asc', 'sort-desc');
+        if (th.dataset.sort === userQuery.sort) {
+            th.classList.add(userQuery.order === 'asc' ? 'sort-asc' : 'sort-desc');
+        }
+    });
+}
+
+// 翻页
+function changeUserPage(delta) {
+    if (delta > 0) {
+        if (!userQuery.nextCursor) return;
+        userQuery.history.push(userQuery.cursor);
+        userQuery.cursor = userQuery.nextCursor;
+    } else {
+        if (userQuery.history.length === 0) return;
+        userQuery.cursor = userQuery.history.pop();
+    }
+    loadUsers();
+}
+
+// 排序或筛选条件变化后回到第一页
+function resetUserPaging() {
+    userQuery.cursor = null;
+    userQuery.history = [];
+}
+
+// 点击表头切换排序（同一列再次点击切换升/降序）
+function sortUsers(column) {
+    if (userQuery.sort === column) {
+        userQuery.order = userQuery.order === 'asc' ? 'desc' : 'asc';
+    } else {
+        userQuery.sort = column;
+        userQuery.order = column === 'username' ? 'asc' : 'desc';
+    }
+    resetUserPaging();
+    loadUsers();
+}
+
+// 更新统计数据（服务端汇总，不依赖当前页）
 function updateStats() {
-    document.getElementById('totalUsers').textContent = users.length;
-    document.getElementById('totalSessions').textContent = users.reduce((sum, u) => sum + (u.session_count || 0), 0);
-    document.getElementById('totalMessages').textContent = users.reduce((sum, u) => sum + (u.message_count || 0), 0);
-    document.getElementById('totalAdmins').textContent = users.filter(u => u.is_admin).length;
+    if (!usersStats) return;
+    document.getElementById('totalUsers').textContent = usersStats.total_users;
+    document.getElementById('totalSessions').textContent = usersStats.total_sessions;
+    document.getElementById('totalMessages').textContent = usersStats.total_messages;
+    document.getElementById('totalAdmins').textContent = usersStats.total_admins;
+}
+
+// 格式化字节数
+function formatBytes(bytes) {
+    if (bytes < 1024) return `${bytes} B`;
+    const units = ['KB', 'MB', 'GB', 'TB'];
+    let value = bytes / 1024;
+    let unit = 0;
+    while (value >= 1024 && unit < units.length - 1) {
+        value /= 1024;
+        unit++;
+    }
+    return `${value.toFixed(1)} ${units[unit]}`;
 }
 
 // 格式化日期
@@ -348,18 +450,58 @@ async function performCleanup(cutoffDate) {
         const data = await response.json();
 
         if (response.ok) {
-            const stats = data.deleted_stats;
+            Modal.toast(I18n.t('cleanup_submitted'), 'info');
+            await waitForCleanupJob(data.job.id);
+        } else {
+            Modal.alert(I18n.t('cleanup_failed'), I18n.translateError(data.error, 'operation_failed'), 'error');
+        }
+    } catch (error) {
+        Modal.alert(I18n.t('network_error'), I18n.t('connect_error'), 'error');
+    }
+}
+
+// 轮询清理任务进度，完成后展示统计结果
+async function waitForCleanupJob(jobId) {
+    const progressEl = document.getElementById('cleanupProgress');
+    progressEl.hidden = false;
+
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 1500));
+        const response = await fetch(`/api/admin/cleanup/jobs/${jobId}`);
+        if (!response.ok) {
+            progressEl.hidden = true;
+            Modal.alert(I18n.t('cleanup_failed'), I18n.t('operation_failed'), 'error');
+            return;
+        }
+        const job = await response.json();
+        const stats = job.stats || {};
+
+        if (job.status === 'pending' || job.status === 'running') {
+            const percent = job.total > 0 ? Math.min(100, Math.round((stats.processed_sessions || 0) * 100 / job.total)) : 0;
+            progressEl.textContent = job.phase === 'messages'
+                ? I18n.t('cleanup_progress_messages', percent, stats.messages || 0)
+                : I18n.t('cleanup_progress_files', stats.scanned_files || 0);
+            continue;
+        }
+
+        progressEl.hidden = true;
+        if (job.status === 'completed') {
             let message = `${I18n.t('cleanup_complete')}!\nMessages: ${stats.messages}\nImages: ${stats.images}\nSessions: ${stats.sessions}`;
             if (stats.orphan_images > 0 || stats.orphan_thumbnails > 0) {
                 message += `\n\nOrphan files:\n- Images: ${stats.orphan_images}\n- Thumbnails: ${stats.orphan_thumbnails}`;
             }
+            if (stats.orphans_skipped) {
+                message += `\n\n${I18n.t('cleanup_orphans_skipped')}`;
+            }
             await Modal.alert(I18n.t('cleanup_complete'), message, 'success');
             loadUsers();
+        } else if (job.status === 'cancelled') {
+            Modal.toast(I18n.t('cleanup_cancelled'), 'warning');
+            loadUsers();
         } else {
-            Modal.alert(I18n.t('cleanup_failed'), I18n.translateError(data.error, 'operation_failed'), 'error');
+            Modal.alert(I18n.t('cleanup_failed'), job.error || I18n.t('operation_failed'), 'error');
         }
-    } catch (error) {
-        Modal.alert(I18n.t('network_error'), I18n.t('connect_error'), 'error');
+        return;
     }
 }
 
@@ -385,12 +527,45 @@ function closeImagePreview() {
 // 卡密管理功能
 // ========================================
 let cardKeys = [];
+let cardKeysTotal = 0;
+let cardKeyStats = null;
+// 卡密列表查询状态（键集分页，筛选在服务端完成）
+const cardKeyQuery = {
+    limit: 50,
+    status: '',
+    batchId: '',
+    prefix: '',
+    redeemer: '',
+    createdFrom: '',
+    createdTo: '',
+    cursor: null,
+    history: [],
+    nextCursor: null
+};
 
 async function loadCardKeys() {
+    const params = new URLSearchParams({ limit: cardKeyQuery.limit });
+    const filters = {
+        status: cardKeyQuery.status,
+        batch_id: cardKeyQuery.batchId,
+        prefix: cardKeyQuery.prefix,
+        redeemer: cardKeyQuery.redeemer,
+        created_from: cardKeyQuery.createdFrom,
+        created_to: cardKeyQuery.createdTo,
+        cursor: cardKeyQuery.cursor
+    };
+    Object.entries(filters).forEach(([key, value]) => {
+        if (value) params.set(key, value);
+    });
+
     try {
-        const response = await fetch('/api/admin/card-keys');
+        const response = await fetch(`/api/admin/card-keys?${params}`);
         if (response.ok) {
-            cardKeys = await response.json();
+            const result = await response.json();
+            cardKeys = result.keys;
+            cardKeysTotal = result.total;
+            cardKeyStats = result.stats;
+            cardKeyQuery.nextCursor = result.next_cursor;
             renderCardKeys();
         }
     } catch (error) {
@@ -398,22 +573,62 @@ async function loadCardKeys() {
     }
 }
 
+function renderCardKeyPagination() {
+    const totalPages = Math.max(1, Math.ceil(cardKeysTotal / cardKeyQuery.limit));
+    document.getElementById('cardKeyPageInfo').textContent =
+        I18n.t('card_page_info', cardKeyQuery.history.length + 1, totalPages, cardKeysTotal);
+    document.getElementById('cardKeyPrevPage').disabled = cardKeyQuery.history.length === 0;
+    document.getElementById('cardKeyNextPage').disabled = !cardKeyQuery.nextCursor;
+    if (cardKeyStats) {
+        document.getElementById('cardKeyStats').textContent = I18n.t(
+            'card_key_stats', cardKeyStats.total, cardKeyStats.unused, cardKeyStats.used,
+            cardKeyStats.revoked, cardKeyStats.unused_credits
+        );
+    }
+}
+
+function changeCardKeyPage(delta) {
+    if (delta > 0) {
+        if (!cardKeyQuery.nextCursor) return;
+        cardKeyQuery.history.push(cardKeyQuery.cursor);
+        cardKeyQuery.cursor = cardKeyQuery.nextCursor;
+    } else {
+        if (cardKeyQuery.history.length === 0) return;
+        cardKeyQuery.cursor = cardKeyQuery.history.pop();
+    }
+    loadCardKeys();
+}
+
+function resetCardKeyPaging() {
+    cardKeyQuery.cursor = null;
+    cardKeyQuery.history = [];
+}
+
+// 点击批次编号：筛选该批次的卡密
+function filterCardKeysByBatch(batchId) {
+    document.getElementById('cardKeyBatchFilter').value = batchId;
+    cardKeyQuery.batchId = String(batchId);
+    resetCardKeyPaging();
+    loadCardKeys();
+}
+
 function renderCardKeys() {
     const tbody = document.getElementById('cardKeyTableBody');
+    renderCardKeyPagination();
     if (cardKeys.length === 0) {
         tbody.innerHTML = `<tr><td colspan="6" class="empty-cell">${I18n.t('no_cards')}</td></tr>`;
         return;
     }
 
     tbody.innerHTML = cardKeys.map(key => `
-        <tr class="${key.is_used ? 'used-row' : ''}">
+        <tr class="${key.is_used || key.is_revoked ? 'used-row' : ''}">
             <td>
                 <code class="card-key-code">${key.code_prefix}****-****-****</code>
             </td>
             <td><span class="credits-badge">🪙 ${key.credits}</span></td>
             <td>
-                <span class="badge ${key.is_used ? 'badge-used' : 'badge-available'}">
-                    ${key.is_used ? I18n.t('used') : I18n.t('available')}
+                <span class="badge ${cardKeyStatusClass(key)}">
+                    ${key.is_used ? I18n.t('used') : (key.is_revoked ? I18n.t('revoked') : I18n.t('available'))}
                 </span>
             </td>
             <td>${key.used_by_username || '-'}</td>
@@ -423,6 +638,11 @@ function renderCardKeys() {
     `).join('');
 }
 
+function cardKeyStatusClass(key) {
+    if (key.is_used) return 'badge-used';
+    return key.is_revoked ? 'badge-revoked' : 'badge-available';
+}
+
 async function generateCardKeys() {
     const credits = parseInt(document.getElementById('cardKeyCredits').value);
     const count = parseInt(document.getElementById('cardKeyCount').value);
@@ -440,7 +660,7 @@ async function generateCardKeys() {
         const response = await fetch('/api/admin/card-keys', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ credits, count })
+            body: JSON.stringify({ credits, count, label: document.getElementById('cardKeyLabel').value })
         });
 
         const data = await response.json();
@@ -461,7 +681,9 @@ async function generateCardKeys() {
                 </div>`,
                 'success'
             );
+            resetCardKeyPaging();
             loadCardKeys();
+            loadCardKeyBatches();
         } else {
             Modal.alert(I18n.t('generate_failed_msg'), I18n.translateError(data.error, 'operation_failed'), 'error');
         }
@@ -470,6 +692,128 @@ async function generateCardKeys() {
     }
 }
 
+// 批量生成并以 CSV 下载（服务端边生成边输出）
+async function exportCardKeys() {
+    const credits = parseInt(document.getElementById('cardKeyCredits').value);
+    const count = parseInt(document.getElementById('cardKeyCount').value);
+    const label = document.getElementById('cardKeyLabel').value;
+
+    if (isNaN(credits) || credits <= 0) {
+        Modal.toast(I18n.t('invalid_credits'), 'warning');
+        return;
+    }
+    if (isNaN(count) || count <= 0 || count > 50000) {
+        Modal.toast(I18n.t('export_count_range'), 'warning');
+        return;
+    }
+
+    const button = document.querySelector('.btn-export-keys');
+    button.disabled = true;
+    Modal.toast(I18n.t('exporting_keys'), 'info');
+    try {
+        const response = await fetch('/api/admin/card-keys/export', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ credits, count, label })
+        });
+
+        if (!response.ok) {
+            const data = await response.json();
+            Modal.alert(I18n.t('generate_failed_msg'), I18n.translateError(data.error, 'operation_failed'), 'error');
+            return;
+        }
+
+        const blob = await response.blob();
+        const link = document.createElement('a');
+        link.href = URL.createObjectURL(blob);
+        link.download = `card_keys_batch_${response.headers.get('X-Card-Key-Batch')}.csv`;
+        link.click();
+        URL.revokeObjectURL(link.href);
+        Modal.toast(I18n.t('keys_exported'), 'success');
+    } catch (error) {
+        Modal.alert(I18n.t('network_error'), I18n.t('connect_error'), 'error');
+    } finally {
+        button.disabled = false;
+        resetCardKeyPaging();
+        loadCardKeys();
+        loadCardKeyBatches();
+    }
+}
+
+let cardKeyBatches = [];
+
+async function loadCardKeyBatches() {
+    try {
+        const response = await fetch('/api/admin/card-key-batches');
+        if (response.ok) {
+            cardKeyBatches = await response.json();
+            renderCardKeyBatches();
+        }
+    } catch (error) {
+        console.error('加载卡密批次失败:', error);
+    }
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+function renderCardKeyBatches() {
+    const tbody = document.getElementById('cardKeyBatchTableBody');
+    if (cardKeyBatches.length === 0) {
+        tbody.innerHTML = `<tr><td colspan="9" class="empty-cell">${I18n.t('no_batches')}</td></tr>`;
+        return;
+    }
+
+    tbody.innerHTML = cardKeyBatches.map(batch => {
+        const status = batch.revoked_at
+            ? `<span class="badge badge-revoked">${I18n.t(batch.status === 'incomplete' ? 'batch_incomplete' : 'revoked')}</span>`
+            : `<span class="badge ${batch.status === 'completed' ? 'badge-available' : 'badge-used'}">${I18n.t('batch_' + batch.status)}</span>`;
+        return `
+        <tr class="${batch.revoked_at ? 'used-row' : ''}">
+            <td><a href="#" class="batch-link" onclick="filterCardKeysByBatch(${batch.id}); return false;">#${batch.id}</a></td>
+            <td>${batch.label ? escapeHtml(batch.label) : '-'}</td>
+            <td><span class="credits-badge">🪙 ${batch.credits}</span></td>
+            <td>${batch.generated_count} / ${batch.requested_count}</td>
+            <td>${batch.used_count}</td>
+            <td>${status}</td>
+            <td>${batch.created_by_username || '-'}</td>
+            <td>${formatDate(batch.created_at)}</td>
+            <td>
+                ${batch.revoked_at ? '-' : `<button class="btn-action btn-delete" onclick="revokeCardKeyBatch(${batch.id})">${I18n.t('revoke_batch')}</button>`}
+            </td>
+        </tr>`;
+    }).join('');
+}
+
+async function revokeCardKeyBatch(batchId) {
+    const confirmed = await Modal.confirm(I18n.t('revoke_batch_title'), I18n.t('confirm_revoke_batch', batchId), 'warning');
+    if (!confirmed) {
+        return;
+    }
+
+    try {
+        const response = await fetch(`/api/admin/card-key-batches/${batchId}/revoke`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({})
+        });
+        const data = await response.json();
+        if (response.ok) {
+            Modal.toast(I18n.t('batch_revoked', data.revoked), 'success');
+            resetCardKeyPaging();
+            loadCardKeys();
+            loadCardKeyBatches();
+        } else {
+            Modal.alert(I18n.t('operation_failed'), I18n.translateError(data.error, 'operation_failed'), 'error');
+        }
+    } catch (error) {
+        Modal.alert(I18n.t('network_error'), I18n.t('connect_error'), 'error');
+    }
+}
+
 function copyCardKey(code) {
     navigator.clipboard.writeText(code).then(() => {
         Modal.toast(I18n.t('key_copied'), 'success');
@@ -478,6 +822,176 @@ function copyCardKey(code) {
     });
 }
 
+// ========================================
+// 上游服务状态（熔断器、API 密钥池）
+// ========================================
+let upstreamStatus = { circuits: null, keys: null, routing: null };
+const UPSTREAM_REFRESH_INTERVAL = 15000;
+
+async function loadUpstreamStatus() {
+    try {
+        const [circuitResponse, keyResponse, routingResponse] = await Promise.all([
+            fetch('/api/admin/circuits'),
+            fetch('/api/admin/api-keys'),
+            fetch('/api/admin/model-routing')
+        ]);
+        if (circuitResponse.ok) upstreamStatus.circuits = await circuitResponse.json();
+        if (keyResponse.ok) upstreamStatus.keys = await keyResponse.json();
+        if (routingResponse.ok) upstreamStatus.routing = await routingResponse.json();
+        renderUpstreamStatus();
+    } catch (error) {
+        console.error('加载上游服务状态失败:', error);
+    }
+}
+
+function formatSeconds(value) {
+    return value === null || value === undefined ? '-' : `${value.toFixed(1)}s`;
+}
+
+function formatFailure(message, timestamp) {
+    if (!message) return '-';
+    const time = new Date(timestamp * 1000).toLocaleTimeString();
+    return `<span title="${escapeHtml(message)}">${time}</span>`;
+}
+
+function renderUpstreamStatus() {
+    const { circuits, keys } = upstreamStatus;
+    if (!circuits || !keys) return;
+    document.getElementById('upstreamSummary').textContent = I18n.t('upstream_summary', circuits.pid);
+
+    const circuitBody = document.getElementById('circuitTableBody');
+    if (circuits.circuits.length === 0) {
+        circuitBody.innerHTML = `<tr><td colspan="7" class="empty-cell">${I18n.t('no_circuits')}</td></tr>`;
+    } else {
+        const badges = { closed: 'badge-available', half_open: 'badge-used', open: 'badge-revoked' };
+        circuitBody.innerHTML = circuits.circuits.map(circuit => `
+        <tr>
+            <td>${escapeHtml(circuit.model)}</td>
+            <td>${escapeHtml(circuit.endpoint === 'default' ? I18n.t('official_endpoint') : circuit.endpoint)}</td>
+            <td>
+                <span class="badge ${badges[circuit.state]}">${I18n.t('circuit_' + circuit.state)}</span>
+                ${circuit.rejecting ? I18n.t('circuit_retry_in', circuit.retry_after) : ''}
+            </td>
+            <td>${circuit.requests} / ${circuit.failures}</td>
+            <td>${(circuit.error_rate * 100).toFixed(1)}%</td>
+            <td>${formatSeconds(circuit.latency_p50)} / ${formatSeconds(circuit.latency_p95)}</td>
+            <td>${formatFailure(circuit.last_failure, circuit.last_failure_at)}</td>
+        </tr>`).join('');
+    }
+
+    const keyBadges = { healthy: 'badge-available', cooling: 'badge-used', disabled: 'badge-revoked' };
+    document.getElementById('apiKeyTableBody').innerHTML = keys.keys.map(key => `
+        <tr>
+            <td><span class="card-key-code">${escapeHtml(key.key)}</span></td>
+            <td>${escapeHtml(key.base_url || I18n.t('official_endpoint'))}</td>
+            <td>
+                <span class="badge ${keyBadges[key.state]}">${I18n.t('key_' + key.state)}</span>
+                ${key.cooldown_remaining ? I18n.t('circuit_retry_in', Math.ceil(key.cooldown_remaining)) : ''}
+            </td>
+            <td>${key.inflight}</td>
+            <td>${key.requests_last_minute}${key.rpm ? ` / ${key.rpm}` : ''}</td>
+            <td>${key.requests} / ${key.failures}</td>
+            <td>${formatFailure(key.last_error, key.last_error_at)}</td>
+        </tr>`).join('');
+
+    renderModelRouting();
+}
+
+function renderModelRouting() {
+    const routing = upstreamStatus.routing;
+    if (!routing) return;
+    const summary = routing.last_24h.map(item =>
+        `${item.requested_model} → ${item.routed_model}: ${item.count}`).join('，');
+    document.getElementById('modelRoutingSummary').textContent = routing.enabled
+        ? I18n.t('routing_summary', routing.p95_seconds_threshold, (routing.error_rate_threshold * 100).toFixed(0), summary || '0')
+        : I18n.t('routing_disabled');
+
+    const tbody = document.getElementById('modelRoutingTableBody');
+    if (routing.decisions.length === 0) {
+        tbody.innerHTML = `<tr><td colspan="6" class="empty-cell">${I18n.t('no_routing_decisions')}</td></tr>`;
+        return;
+    }
+    tbody.innerHTML = routing.decisions.map(decision => `
+        <tr>
+            <td>${formatDate(decision.created_at)}</td>
+            <td>${decision.user_id}</td>
+            <td>${escapeHtml(decision.requested_model)} → ${escapeHtml(decision.routed_model)}</td>
+            <td>${I18n.t('routing_reason_' + decision.reason)}</td>
+            <td>${formatSeconds(decision.p95_seconds)}</td>
+            <td>${decision.error_rate === null ? '-' : (decision.error_rate * 100).toFixed(1) + '%'}</td>
+        </tr>`).join('');
+}
+
+// ========================================
+// 生成统计（服务端只读取汇总表）
+// ========================================
+let generationAnalytics = null;
+
+async function loadGenerationAnalytics() {
+    const [period, days] = document.getElementById('analyticsRange').value.split(':');
+    try {
+        const response = await fetch(`/api/admin/analytics/generations?period=${period}&days=${days}`);
+        if (!response.ok) return;
+        generationAnalytics = await response.json();
+        renderGenerationAnalytics();
+    } catch (error) {
+        console.error('加载生成统计失败:', error);
+    }
+}
+
+function renderGenerationAnalytics() {
+    const analytics = generationAnalytics;
+    if (!analytics) return;
+    const totals = analytics.totals;
+    document.getElementById('analyticsSummary').textContent = I18n.t('analytics_summary',
+        totals.requests, totals.errors, (totals.error_rate * 100).toFixed(1), totals.credits, formatSeconds(totals.p95_seconds));
+
+    // 柱状图：柱高为请求数，红色部分为失败数
+    const chart = document.getElementById('analyticsChart');
+    const maxRequests = Math.max(1, ...analytics.series.map(item => item.requests));
+    chart.innerHTML = analytics.series.map(item => {
+        const label = analytics.period === 'hour' ? item.bucket.replace('T', ' ') + ':00' : item.bucket;
+        const title = I18n.t('analytics_chart_title', label, item.requests, item.errors, item.credits);
+        return `
+        <div class="analytics-bar" title="${escapeHtml(title)}">
+            <div class="analytics-bar-fill" style="height: ${(item.requests / maxRequests * 100).toFixed(1)}%">
+                <div class="analytics-bar-errors" style="height: ${(item.errors / Math.max(1, item.requests) * 100).toFixed(1)}%"></div>
+            </div>
+        </div>`;
+    }).join('');
+
+    const modelBody = document.getElementById('analyticsModelTableBody');
+    if (analytics.breakdown.length === 0) {
+        modelBody.innerHTML = `<tr><td colspan="7" class="empty-cell">${I18n.t('no_generations')}</td></tr>`;
+    } else {
+        modelBody.innerHTML = analytics.breakdown.map(item => `
+        <tr>
+            <td>${escapeHtml(item.model)}</td>
+            <td>${escapeHtml(item.image_size)}</td>
+            <td>${item.requests} / ${item.errors}</td>
+            <td>${item.credits}</td>
+            <td>${formatSeconds(item.avg_seconds)} / ${formatSeconds(item.p95_seconds)}</td>
+            <td>${formatSeconds(item.avg_upstream_seconds)}</td>
+            <td>${formatBytes(item.image_bytes)}</td>
+        </tr>`).join('');
+    }
+
+    const userBody = document.getElementById('analyticsUserTableBody');
+    if (analytics.top_users.length === 0) {
+        userBody.innerHTML = `<tr><td colspan="4" class="empty-cell">${I18n.t('no_generations')}</td></tr>`;
+    } else {
+        userBody.innerHTML = analytics.top_users.map(user => `
+        <tr>
+            <td>${user.username ? escapeHtml(user.username) : '#' + user.user_id}</td>
+            <td>${user.requests} / ${user.errors}</td>
+            <td>${user.credits}</td>
+            <td>${formatSeconds(user.upstream_seconds)}</td>
+        </tr>`).join('');
+    }
+}
+
+document.getElementById('analyticsRange').addEventListener('change', loadGenerationAnalytics);
+
 // ========================================
 // Flatpickr 日期选择器初始化
 // ========================================
@@ -502,15 +1016,64 @@ function initDatePicker() {
     });
 }
 
+// 用户搜索（输入停止 300ms 后查询）
+let userSearchTimer = null;
+document.getElementById('userSearchInput').addEventListener('input', (e) => {
+    clearTimeout(userSearchTimer);
+    userSearchTimer = setTimeout(() => {
+        userQuery.q = e.target.value.trim();
+        resetUserPaging();
+        loadUsers();
+    }, 300);
+});
+
+[['userRoleFilter', 'role'], ['userCreatedFrom', 'createdFrom'], ['userCreatedTo', 'createdTo']].forEach(([id, key]) => {
+    document.getElementById(id).addEventListener('change', (e) => {
+        userQuery[key] = e.target.value;
+        resetUserPaging();
+        loadUsers();
+    });
+});
+
+// 卡密筛选（文本输入停止 300ms 后查询）
+let cardKeyFilterTimer = null;
+[
+    ['cardKeyStatusFilter', 'status'], ['cardKeyBatchFilter', 'batchId'], ['cardKeyPrefixFilter', 'prefix'],
+    ['cardKeyRedeemerFilter', 'redeemer'], ['cardKeyCreatedFrom', 'createdFrom'], ['cardKeyCreatedTo', 'createdTo']
+].forEach(([id, key]) => {
+    const el = document.getElementById(id);
+    const eventName = el.tagName === 'SELECT' || el.type === 'date' ? 'change' : 'input';
+    el.addEventListener(eventName, () => {
+        clearTimeout(cardKeyFilterTimer);
+        cardKeyFilterTimer = setTimeout(() => {
+            cardKeyQuery[key] = el.value.trim();
+            resetCardKeyPaging();
+            loadCardKeys();
+        }, eventName === 'input' ? 300 : 0);
+    });
+});
+
+document.querySelectorAll('.user-table th.sortable').forEach(th => {
+    th.addEventListener('click', () => sortUsers(th.dataset.sort));
+});
+
 // 监听语言切换
 I18n.onLangChange(() => {
     initDatePicker();
     // 重新渲染用户表格和卡密表格以更新翻译
     renderUsers();
+    renderPagination();
     renderCardKeys();
+    renderCardKeyBatches();
+    renderUpstreamStatus();
+    renderGenerationAnalytics();
 });
 
 // 初始化
 initDatePicker();
 loadUsers();
 loadCardKeys();
+loadCardKeyBatches();
+loadUpstreamStatus();
+loadGenerationAnalytics();
+setInterval(loadUpstreamStatus, UPSTREAM_REFRESH_INTERVAL);
@@ -35,6 +35,10 @@ const translations = {
         sidebar_brand: '码言旗下',
         new_chat: '新对话',
         messages_count: '条消息',
+        search_placeholder: '搜索提示词和回复',
+        search_no_results: '没有找到匹配的消息',
+        search_index_building: '搜索索引正在建立，部分旧会话暂时搜索不到',
+        search_failed: '搜索失败',
         close_menu: '关闭菜单',
         open_menu: '打开菜单',
 
@@ -54,6 +58,10 @@ const translations = {
         model_nano_banana_pro_desc: '专业创作',
         model_nano_banana_2: 'Nano Banana 2',
         model_nano_banana_2_desc: '最新模型',
+        model_fallback_label: '所选模型繁忙时，已有对话也自动切换到更快的模型',
+        model_routed: '{0} 当前繁忙，本次已使用 {1} 生成，按 {1} 计费',
+        preference_saved: '设置已保存',
+        preference_save_failed: '保存设置失败',
         aspect_auto: 'auto 自适应',
         aspect_square: '1:1 方形',
         aspect_16_9: '16:9 横版',
@@ -68,6 +76,13 @@ const translations = {
 
         // 预览区
         chat_area: '聊天区',
+        gallery: '图库',
+        gallery_empty: '还没有生成过图片',
+        gallery_loading: '加载中…',
+        gallery_end: '已经到底了',
+        gallery_failed: '图库加载失败',
+        gallery_index_building: '图片索引正在建立，部分旧图片暂时不显示',
+        gallery_open_session: '打开所在会话',
         empty_state_title: '对话内容与生成的图片将在这里显示',
         empty_state_hint: '在左侧输入提示词，点击生成按钮开始创作',
         click_to_view: '✨ 点击图片查看高清大图或下载',
@@ -140,6 +155,7 @@ const translations = {
         error_timeout: '图片生成超时，服务器繁忙，请稍后重试',
         error_quota_exceeded: 'API 配额已用尽，请稍后重试',
         error_service_unavailable: '服务暂时不可用，请稍后重试',
+        error_upstream_unavailable: '图片生成服务暂时故障，已暂停请求，请稍后重试',
         error_server_busy: '服务器繁忙，请稍后重试',
         error_invalid_request: '请求参数无效，请检查提示词或图片',
         error_permission_denied: 'API 权限被拒绝，请联系管理员',
@@ -204,6 +220,22 @@ const translations = {
         role: '角色',
         session_count: '会话数',
         message_count: '消息数',
+        image_count: '图片数',
+        image_bytes: '占用空间',
+        generation_count: '生成次数',
+        credits_spent: '消耗点数',
+        user_search_placeholder: '搜索用户名 / 邮箱前缀或用户 ID',
+        prev_page: '上一页',
+        next_page: '下一页',
+        page_info: '第 {0} / {1} 页，共 {2} 个用户',
+        card_page_info: '第 {0} / {1} 页，共 {2} 张卡密',
+        card_key_stats: '共 {0} 张：可用 {1}，已使用 {2}，已作废 {3}；未使用点数 {4}',
+        filter_all_roles: '全部角色',
+        filter_all_status: '全部状态',
+        filter_prefix: '卡密前缀',
+        filter_redeemer: '使用者用户名 / ID',
+        filter_date_from: '起始日期',
+        filter_date_to: '结束日期',
         register_time: '注册时间',
         main_admin: '主管理员',
         admin: '管理员',
@@ -244,6 +276,11 @@ const translations = {
         custom_cleanup_msg: '确定要清理 {0} 之前的所有数据吗？<br>此操作无法撤销！',
         cleanup_complete: '清理完成',
         cleanup_failed: '清理失败',
+        cleanup_submitted: '清理任务已提交，正在后台执行',
+        cleanup_progress_messages: '正在清理过期消息：{0}%（已删除 {1} 条）',
+        cleanup_progress_files: '正在检查孤儿文件：已检查 {0} 个',
+        cleanup_orphans_skipped: '媒体索引尚未建立完成，本次跳过了孤儿文件清理',
+        cleanup_cancelled: '清理任务已取消',
         keys_generated: '🎫 卡密生成成功',
         save_keys_warning: '⚠️ 请立即保存这些卡密，关闭后将无法再查看完整卡密！',
         copy: '📋 复制',
@@ -252,8 +289,73 @@ const translations = {
         key_copied: '卡密已复制到剪贴板',
         copy_failed: '复制失败，请手动复制',
         credits_must_range: '数量必须在1-100之间',
+        export_keys: '📥 批量导出 CSV',
+        export_count_range: '导出数量必须在1-50000之间',
+        exporting_keys: '正在生成并导出卡密，请勿关闭页面...',
+        keys_exported: '卡密已导出，请妥善保存 CSV 文件',
+        batch_label: '批次备注',
+        card_key_batches: '卡密批次',
+        batch: '批次',
+        batch_generated: '已生成',
+        created_by: '创建者',
+        revoked: '已作废',
+        batch_generating: '生成中',
+        batch_completed: '已完成',
+        batch_incomplete: '导出中断',
+        no_batches: '暂无批次',
+        revoke_batch: '作废',
+        revoke_batch_title: '作废批次',
+        confirm_revoke_batch: '确定要作废批次 #{0} 中所有未使用的卡密吗？此操作不可恢复！',
+        batch_revoked: '已作废 {0} 张卡密',
         invalid_credits: '请输入有效的点数',
-        connect_error: '无法连接到服务器'
+        connect_error: '无法连接到服务器',
+        upstream_status: '📡 上游服务状态',
+        upstream_summary: '进程 {0} 的统计（每个 worker 分别统计），每 15 秒刷新',
+        circuit_model: '模型',
+        circuit_endpoint: '端点',
+        circuit_requests: '请求 / 失败',
+        circuit_error_rate: '错误率',
+        circuit_latency: '耗时 p50 / p95',
+        circuit_last_failure: '最近失败',
+        circuit_closed: '正常',
+        circuit_open: '熔断中',
+        circuit_half_open: '探测中',
+        circuit_retry_in: '{0} 秒后重试',
+        no_circuits: '暂无上游调用',
+        api_key_pool: 'API 密钥池',
+        api_key: '密钥',
+        key_inflight: '进行中',
+        key_last_minute: '最近一分钟',
+        key_healthy: '正常',
+        key_cooling: '冷却中',
+        key_disabled: '已停用',
+        official_endpoint: '官方',
+        model_routing: '模型路由',
+        routing_summary: 'p95 耗时超过 {0} 秒或错误率超过 {1}% 时切换到备用模型；最近 24 小时：{2}',
+        routing_disabled: '模型路由未开启（MODEL_ROUTING_ENABLED）',
+        routing_user: '用户 ID',
+        routing_models: '请求模型 → 实际模型',
+        routing_reason: '原因',
+        routing_p95: 'p95 耗时',
+        routing_reason_p95_latency: '耗时过长',
+        routing_reason_error_rate: '错误率过高',
+        routing_reason_circuit_open: '熔断中',
+        no_routing_decisions: '暂无路由记录',
+        generation_analytics: '📊 生成统计',
+        analytics_last_48h: '最近 48 小时（按小时）',
+        analytics_last_30d: '最近 30 天（按天）',
+        analytics_last_90d: '最近 90 天（按天）',
+        analytics_summary: '共 {0} 次生成，失败 {1} 次（{2}%），消耗 {3} 点，p95 耗时 {4}',
+        analytics_by_model: '按模型和分辨率',
+        analytics_size: '分辨率',
+        analytics_credits: '消耗点数',
+        analytics_latency: '平均 / p95 耗时',
+        analytics_upstream: '平均上游耗时',
+        analytics_image_bytes: '图片大小',
+        analytics_top_users: '消耗最多的用户',
+        analytics_upstream_total: '上游总耗时',
+        analytics_chart_title: '{0}：{1} 次，失败 {2} 次，{3} 点',
+        no_generations: '暂无生成记录'
     },
     en: {
         // Page title
@@ -278,6 +380,10 @@ const translations = {
         sidebar_brand: 'GitSay',
         new_chat: 'New Chat',
         messages_count: 'messages',
+        search_placeholder: 'Search prompts and replies',
+        search_no_results: 'No matching messages',
+        search_index_building: 'Search index is still building; some older chats may be missing',
+        search_failed: 'Search failed',
         close_menu: 'Close menu',
         open_menu: 'Open menu',
 
@@ -297,6 +403,10 @@ const translations = {
         model_nano_banana_pro_desc: 'Professional',
         model_nano_banana_2: 'Nano Banana 2',
         model_nano_banana_2_desc: 'Latest Model',
+        model_fallback_label: 'When the chosen model is busy, switch existing chats to a faster model too',
+        model_routed: '{0} is busy, so this image was generated and billed with {1}',
+        preference_saved: 'Settings saved',
+        preference_save_failed: 'Failed to save settings',
         aspect_auto: 'auto Adaptive',
         aspect_square: '1:1 Square',
         aspect_16_9: '16:9 Landscape',
@@ -311,6 +421,13 @@ const translations = {
 
         // Preview area
         chat_area: 'Chat Area',
+        gallery: 'Gallery',
+        gallery_empty: 'No generated images yet',
+        gallery_loading: 'Loading…',
+        gallery_end: 'You have reached the end',
+        gallery_failed: 'Failed to load gallery',
+        gallery_index_building: 'Image index is still building; some older images may be missing',
+        gallery_open_session: 'Open chat',
         empty_state_title: 'Chat content and generated images will appear here',
         empty_state_hint: 'Enter a prompt on the left, click generate to start creating',
         click_to_view: '✨ Click image to view HD or download',
@@ -383,6 +500,7 @@ const translations = {
         error_timeout: 'Image generation timed out, server busy, please try again later',
         error_quota_exceeded: 'API quota exceeded, please try again later',
         error_service_unavailable: 'Service temporarily unavailable, please try again later',
+        error_upstream_unavailable: 'The image generation service is having problems and requests are paused, please try again later',
         error_server_busy: 'Server busy, please try again later',
         error_invalid_request: 'Invalid request parameters, please check prompt or image',
         error_permission_denied: 'API permission denied, please contact administrator',
@@ -447,6 +565,22 @@ const translations = {
         role: 'Role',
         session_count: 'Sessions',
         message_count: 'Messages',
+        image_count: 'Images',
+        image_bytes: 'Storage',
+        generation_count: 'Generations',
+        credits_spent: 'Credits Spent',
+        user_search_placeholder: 'Search by username / email prefix or user ID',
+        prev_page: 'Previous',
+        next_page: 'Next',
+        page_info: 'Page {0} / {1}, {2} users total',
+        card_page_info: 'Page {0} / {1}, {2} card keys',
+        card_key_stats: '{0} total: {1} available, {2} used, {3} revoked; {4} unredeemed credits',
+        filter_all_roles: 'All roles',
+        filter_all_status: 'All statuses',
+        filter_prefix: 'Key prefix',
+        filter_redeemer: 'Redeemer username / ID',
+        filter_date_from: 'From date',
+        filter_date_to: 'To date',
         register_time: 'Registered',
         main_admin: 'Main Admin',
         admin: 'Admin',
@@ -487,6 +621,11 @@ const translations = {
         custom_cleanup_msg: 'Are you sure you want to clean all data before {0}?<br>This action cannot be undone!',
         cleanup_complete: 'Cleanup Complete',
         cleanup_failed: 'Cleanup failed',
+        cleanup_submitted: 'Cleanup job submitted and running in the background',
+        cleanup_progress_messages: 'Removing expired messages: {0}% ({1} deleted)',
+        cleanup_progress_files: 'Checking orphan files: {0} scanned',
+        cleanup_orphans_skipped: 'Media index is still being built; orphan file cleanup was skipped this time',
+        cleanup_cancelled: 'Cleanup job cancelled',
         keys_generated: '🎫 Card Keys Generated',
         save_keys_warning: '⚠️ Please save these keys immediately, they will not be shown again!',
         copy: '📋 Copy',
@@ -495,8 +634,73 @@ const translations = {
         key_copied: 'Card key copied to clipboard',
         copy_failed: 'Copy failed, please copy manually',
         credits_must_range: 'Quantity must be between 1-100',
+        export_keys: '📥 Bulk Export CSV',
+        export_count_range: 'Export quantity must be between 1-50000',
+        exporting_keys: 'Generating and exporting card keys, please keep this page open...',
+        keys_exported: 'Card keys exported, please keep the CSV file safe',
+        batch_label: 'Batch Note',
+        card_key_batches: 'Card Key Batches',
+        batch: 'Batch',
+        batch_generated: 'Generated',
+        created_by: 'Created By',
+        revoked: 'Revoked',
+        batch_generating: 'Generating',
+        batch_completed: 'Completed',
+        batch_incomplete: 'Export Interrupted',
+        no_batches: 'No batches',
+        revoke_batch: 'Revoke',
+        revoke_batch_title: 'Revoke Batch',
+        confirm_revoke_batch: 'Revoke all unused card keys in batch #{0}? This cannot be undone!',
+        batch_revoked: '{0} card keys revoked',
         invalid_credits: 'Please enter valid credits',
-        connect_error: 'Cannot connect to server'
+        connect_error: 'Cannot connect to server',
+        upstream_status: '📡 Upstream Status',
+        upstream_summary: 'Stats from process {0} (each worker counts separately), refreshed every 15 seconds',
+        circuit_model: 'Model',
+        circuit_endpoint: 'Endpoint',
+        circuit_requests: 'Requests / Failed',
+        circuit_error_rate: 'Error Rate',
+        circuit_latency: 'Latency p50 / p95',
+        circuit_last_failure: 'Last Failure',
+        circuit_closed: 'Healthy',
+        circuit_open: 'Open',
+        circuit_half_open: 'Probing',
+        circuit_retry_in: 'retry in {0}s',
+        no_circuits: 'No upstream calls yet',
+        api_key_pool: 'API Key Pool',
+        api_key: 'Key',
+        key_inflight: 'In Flight',
+        key_last_minute: 'Last Minute',
+        key_healthy: 'Healthy',
+        key_cooling: 'Cooling Down',
+        key_disabled: 'Disabled',
+        official_endpoint: 'Official',
+        model_routing: 'Model Routing',
+        routing_summary: 'Switches to the fallback model when p95 latency exceeds {0}s or the error rate exceeds {1}%; last 24 hours: {2}',
+        routing_disabled: 'Model routing is off (MODEL_ROUTING_ENABLED)',
+        routing_user: 'User ID',
+        routing_models: 'Requested → Used Model',
+        routing_reason: 'Reason',
+        routing_p95: 'p95 Latency',
+        routing_reason_p95_latency: 'Slow',
+        routing_reason_error_rate: 'High error rate',
+        routing_reason_circuit_open: 'Circuit open',
+        no_routing_decisions: 'No routing decisions yet',
+        generation_analytics: '📊 Generation Analytics',
+        analytics_last_48h: 'Last 48 hours (hourly)',
+        analytics_last_30d: 'Last 30 days (daily)',
+        analytics_last_90d: 'Last 90 days (daily)',
+        analytics_summary: '{0} generations, {1} failed ({2}%), {3} credits spent, p95 latency {4}',
+        analytics_by_model: 'By model and resolution',
+        analytics_size: 'Resolution',
+        analytics_credits: 'Credits spent',
+        analytics_latency: 'Avg / p95 latency',
+        analytics_upstream: 'Avg upstream latency',
+        analytics_image_bytes: 'Image size',
+        analytics_top_users: 'Top users by credits',
+        analytics_upstream_total: 'Total upstream time',
+        analytics_chart_title: '{0}: {1} generations, {2} failed, {3} credits',
+        no_generations: 'No generations yet'
     }
 };
 
@@ -12,7 +12,17 @@ const state = {
     selectedModel: window.DEFAULT_MODEL || 'gemini-3.1-flash-image-preview',  // 从后端环境变量读取默认模型
     isGenerating: false,
     isSettingsLocked: false,  // 会话生成后锁定设置
-    isLoadingSession: false   // 会话历史加载中
+    isLoadingSession: false,  // 会话历史加载中
+    searchTimer: null         // 搜索输入防抖
+};
+
+// 图库分页状态（切换到图库时首次加载，生成新图片后下次打开时重新加载）
+const galleryState = {
+    cursor: null,
+    loading: false,
+    done: false,
+    loaded: false,
+    observer: null
 };
 
 // 会话数据缓存（避免重复加载，LRU 策略限制最多 50 个）
@@ -33,6 +43,7 @@ const elements = {
     // 侧边栏
     btnNewChat: document.getElementById('btnNewChat'),
     sessionList: document.getElementById('sessionList'),
+    sessionSearch: document.getElementById('sessionSearch'),
     sidebar: document.getElementById('sidebar'),
     sidebarOverlay: document.getElementById('sidebarOverlay'),
     hamburgerBtn: document.getElementById('hamburgerBtn'),
@@ -53,6 +64,12 @@ const elements = {
     previewContent: document.getElementById('previewContent'),
     emptyState: document.getElementById('emptyState'),
     messageList: document.getElementById('messageList'),
+    tabChat: document.getElementById('tabChat'),
+    tabGallery: document.getElementById('tabGallery'),
+    gallery: document.getElementById('gallery'),
+    galleryGrid: document.getElementById('galleryGrid'),
+    galleryStatus: document.getElementById('galleryStatus'),
+    gallerySentinel: document.getElementById('gallerySentinel'),
 
     // 加载和模态框
     loadingOverlay: document.getElementById('loadingOverlay'),
@@ -78,6 +95,20 @@ async function fetchSessions() {
     }
 }
 
+async function searchSessions(query) {
+    const response = await fetch(`/api/search?q=${encodeURIComponent(query)}`);
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    return await response.json();
+}
+
+async function fetchGallery(cursor) {
+    const params = new URLSearchParams();
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`/api/gallery?${params}`);
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    return await response.json();
+}
+
 async function createSession() {
     try {
         const response = await fetch('/api/sessions', { method: 'POST' });
@@ -88,16 +119,58 @@ async function createSession() {
     }
 }
 
+/**
+ * 取消会话的聊天预热（离开会话时调用，页面关闭时也能发出）
+ */
+function cancelSessionPrewarm(sessionId) {
+    if (!sessionId) return;
+    fetch(`/api/sessions/${sessionId}/prewarm`, { method: 'DELETE', keepalive: true }).catch(() => {});
+}
+
 async function getSession(sessionId) {
     try {
         const response = await fetch(`/api/sessions/${sessionId}`);
-        return await response.json();
+        const session = await response.json();
+        session.etag = response.headers.get('ETag');
+        return session;
     } catch (error) {
         console.error('获取会话详情失败:', error);
         return null;
     }
 }
 
+/**
+ * 增量同步已缓存的会话：未变化时服务端返回 304，否则只返回新增消息
+ * 返回 true 表示缓存内容有更新
+ */
+async function syncSession(sessionId, cached) {
+    try {
+        // 缓存没有修订号基准时（如本地追加过消息），完整拉取一次
+        let url = `/api/sessions/${sessionId}`;
+        const headers = {};
+        if (cached.revision !== undefined) {
+            const params = new URLSearchParams({
+                since: cached.messages.length,
+                since_revision: cached.revision
+            });
+            url += `?${params}`;
+            if (cached.etag) headers['If-None-Match'] = cached.etag;
+        }
+        const response = await fetch(url, { headers, cache: 'no-store' });
+        if (response.status === 304 || !response.ok) return false;
+
+        const session = await response.json();
+        cached.messages = session.delta ? cached.messages.concat(session.messages) : session.messages;
+        cached.settings = session.settings;
+        cached.revision = session.revision;
+        cached.etag = response.headers.get('ETag');
+        return true;
+    } catch (error) {
+        console.error('同步会话失败:', error);
+        return false;
+    }
+}
+
 async function deleteSession(sessionId) {
     try {
         await fetch(`/api/sessions/${sessionId}`, { method: 'DELETE' });
@@ -198,6 +271,148 @@ function renderSessionList() {
     });
 }
 
+function renderSearchResults(data) {
+    // snippet 由后端转义并用 <mark> 标记匹配部分，其余字段需要转义
+    let html = data.results.map(result => {
+        const title = result.session_title === '新对话' ? I18n.t('new_chat') : result.session_title;
+        const thumb = result.thumbnail || result.image;
+        return `
+        <div class="session-item search-result" data-id="${escapeHtml(result.session_id)}" data-position="${result.position}">
+            ${thumb ? `<img class="search-result-thumb" src="${escapeHtml(thumb)}" alt="" loading="lazy">` : ''}
+            <div class="search-result-body">
+                <div class="search-result-snippet">${result.snippet}</div>
+                <div class="session-meta">${escapeHtml(title)}</div>
+            </div>
+        </div>
+    `}).join('');
+    if (data.results.length === 0) {
+        html = `<div class="search-status">${I18n.t('search_no_results')}</div>`;
+    }
+    if (!data.index_ready) {
+        html += `<div class="search-status">${I18n.t('search_index_building')}</div>`;
+    }
+    elements.sessionList.innerHTML = html;
+
+    elements.sessionList.querySelectorAll('.search-result').forEach(item => {
+        item.addEventListener('click', async () => {
+            // 清空搜索框，恢复会话列表并定位到匹配的消息
+            elements.sessionSearch.value = '';
+            await selectSession(item.dataset.id);
+            scrollToMessage(Number(item.dataset.position));
+        });
+    });
+}
+
+function scrollToMessage(position) {
+    const message = elements.messageList.querySelectorAll('.chat-message')[position];
+    if (message) {
+        setTimeout(() => message.scrollIntoView({ block: 'center' }), 0);
+    }
+}
+
+async function handleSearchInput() {
+    const query = elements.sessionSearch.value.trim();
+    clearTimeout(state.searchTimer);
+    if (!query) {
+        renderSessionList();
+        return;
+    }
+    state.searchTimer = setTimeout(async () => {
+        try {
+            const data = await searchSessions(query);
+            // 输入已变化时丢弃过期的结果
+            if (elements.sessionSearch.value.trim() === query) {
+                renderSearchResults(data);
+            }
+        } catch (error) {
+            console.error('搜索失败:', error);
+            elements.sessionList.innerHTML = `<div class="search-status">${I18n.t('search_failed')}</div>`;
+        }
+    }, 300);
+}
+
+function showView(view) {
+    const isGallery = view === 'gallery';
+    elements.tabChat.classList.toggle('active', !isGallery);
+    elements.tabGallery.classList.toggle('active', isGallery);
+    elements.previewContent.classList.toggle('gallery-mode', isGallery);
+    elements.gallery.hidden = !isGallery;
+    if (isGallery) {
+        if (!galleryState.loaded) {
+            resetGallery();
+        }
+        elements.previewContent.scrollTop = 0;
+    }
+}
+
+function resetGallery() {
+    galleryState.cursor = null;
+    galleryState.done = false;
+    galleryState.loaded = true;
+    elements.galleryGrid.innerHTML = '';
+    elements.galleryStatus.textContent = '';
+    if (!galleryState.observer) {
+        // 哨兵元素接近可视区域时加载下一页
+        galleryState.observer = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) loadGalleryPage();
+        }, { root: elements.previewContent, rootMargin: '600px' });
+        galleryState.observer.observe(elements.gallerySentinel);
+    }
+    loadGalleryPage();
+}
+
+function renderGalleryItems(images) {
+    // 只加载缩略图，点击后才打开原图
+    const html = images.map(img => {
+        const title = img.session_title === '新对话' ? I18n.t('new_chat') : img.session_title;
+        const size = img.width && img.height ? `${img.width}×${img.height}` : '';
+        return `
+        <figure class="gallery-item">
+            <img src="${escapeHtml(img.thumbnail || img.image)}" data-src="${escapeHtml(img.image)}"
+                 alt="${escapeHtml(title)}" loading="lazy">
+            <figcaption>
+                <button class="gallery-session" data-id="${escapeHtml(img.session_id)}" data-position="${img.position}"
+                        title="${I18n.t('gallery_open_session')}">${escapeHtml(title)}</button>
+                <span>${size}</span>
+            </figcaption>
+        </figure>
+    `}).join('');
+    elements.galleryGrid.insertAdjacentHTML('beforeend', html);
+}
+
+async function loadGalleryPage() {
+    if (galleryState.loading || galleryState.done || elements.gallery.hidden) return;
+    galleryState.loading = true;
+    elements.galleryStatus.textContent = I18n.t('gallery_loading');
+    try {
+        const data = await fetchGallery(galleryState.cursor);
+        renderGalleryItems(data.images);
+        galleryState.cursor = data.next_cursor;
+        galleryState.done = !data.next_cursor;
+        let status = '';
+        if (galleryState.done) {
+            status = elements.galleryGrid.children.length === 0 ? I18n.t('gallery_empty') : I18n.t('gallery_end');
+        }
+        if (!data.index_ready) {
+            status = `${status} ${I18n.t('gallery_index_building')}`.trim();
+        }
+        elements.galleryStatus.textContent = status;
+    } catch (error) {
+        console.error('加载图库失败:', error);
+        elements.galleryStatus.textContent = I18n.t('gallery_failed');
+        galleryState.loaded = false;
+        return;
+    } finally {
+        galleryState.loading = false;
+    }
+
+    // 一页没有填满可视区域时哨兵仍然可见，观察器不会再次触发，继续加载
+    const sentinelTop = elements.gallerySentinel.getBoundingClientRect().top;
+    if (!galleryState.done && sentinelTop < elements.previewContent.getBoundingClientRect().bottom + 600) {
+        loadGalleryPage();
+    }
+}
+
 function renderMessages(messages) {
     if (!messages || messages.length === 0) {
         showEmptyState();
@@ -335,6 +550,7 @@ async function loadSessions() {
 
 async function selectSession(sessionId) {
     if (state.isLoadingSession) return;
+    showView('chat');
 
     state.currentSessionId = sessionId;
     renderSessionList();
@@ -350,6 +566,17 @@ async function selectSession(sessionId) {
         } else {
             unlockSettings();
         }
+
+        // 后台增量同步（其他标签页/设备可能追加了消息），有更新时重新渲染
+        syncSession(sessionId, cached).then(changed => {
+            if (changed && state.currentSessionId === sessionId) {
+                renderMessages(cached.messages);
+                if (cached.settings) {
+                    applyLockedSettings(cached.settings);
+                    lockSettings();
+                }
+            }
+        });
     } else {
         // 缓存未命中，从服务器加载
         showSessionLoadingBar();
@@ -380,9 +607,12 @@ async function selectSession(sessionId) {
 async function handleNewChat() {
     const session = await createSession();
     if (session) {
+        cancelSessionPrewarm(state.currentSessionId);
+        sessionCacheSet(session.id, { messages: [], settings: null, revision: 0, etag: null });
         state.sessions.unshift(session);
         state.currentSessionId = session.id;
         renderSessionList();
+        showView('chat');
         showEmptyState();
         elements.promptInput.value = '';
         clearReferenceImages();
@@ -511,6 +741,11 @@ async function handleGenerate() {
             renderSessionList();
         }
 
+        // 所选模型繁忙，本次由更快的模型生成
+        if (result.routed_from) {
+            Modal.toast(I18n.t('model_routed', modelDisplayName(result.routed_from), modelDisplayName(result.model)), 'warning');
+        }
+
         // 更新点数显示
         if (result.credits_remaining !== undefined && result.credits_remaining !== 'admin') {
             const creditEl = document.getElementById('userCredits');
@@ -526,15 +761,18 @@ async function handleGenerate() {
             sessionCacheSet(state.currentSessionId, cached);
         }
 
-        // 追加用户消息
+        // 追加用户消息（参考图文件名以服务端返回为准）
         cached.messages.push({
             role: 'user',
             content: prompt,
-            reference_images: currentRefImages.length > 0 ? currentRefImages.map((_, i) =>
-                `ref_${state.currentSessionId}_${cached.messages.length}_${i}.png`
-            ) : null
+            reference_images: currentRefImages.length > 0 ? result.reference_images : null
         });
 
+        // 图库下次打开时重新加载，包含新生成的图片
+        if (result.image) {
+            galleryState.loaded = false;
+        }
+
         // 追加 AI 响应
         cached.messages.push({
             role: 'assistant',
@@ -543,6 +781,16 @@ async function handleGenerate() {
             thumbnail: result.thumbnail
         });
 
+        // 同步修订号，后续增量同步以此为基准
+        if (result.revision !== undefined && cached.revision !== undefined && result.revision === cached.revision + 1) {
+            cached.revision = result.revision;
+            cached.etag = `"${state.currentSessionId}.${result.revision}"`;
+        } else {
+            // 期间会话有其他变更（或缓存无修订号），下次打开时完整同步
+            cached.revision = undefined;
+            cached.etag = null;
+        }
+
         // 更新设置锁定
         if (result.settings) {
             cached.settings = result.settings;
@@ -579,6 +827,9 @@ function setupOptionButtons(container, stateKey) {
             container.querySelectorAll('.option-btn').forEach(b => b.classList.remove('active'));
             btn.classList.add('active');
             state[stateKey] = btn.dataset.value;
+            if (stateKey === 'selectedModel') {
+                updateResolutionCosts();
+            }
         });
     });
 }
@@ -676,6 +927,42 @@ function setActiveOption(container, value) {
     container.querySelectorAll('.option-btn').forEach(btn => {
         btn.classList.toggle('active', btn.dataset.value === value);
     });
+    if (container === elements.modelButtons) {
+        updateResolutionCosts();
+    }
+}
+
+// 分辨率按钮上的点数按当前选中的模型显示
+function updateResolutionCosts() {
+    const costs = (window.MODEL_COSTS || {})[state.selectedModel];
+    if (!costs) return;
+    elements.resolutionButtons.querySelectorAll('.resolution-btn').forEach(btn => {
+        const tag = btn.querySelector('.res-cost-tag');
+        if (tag && costs[btn.dataset.value] !== undefined) {
+            tag.textContent = `🪙 ${costs[btn.dataset.value]}`;
+        }
+    });
+}
+
+function modelDisplayName(model) {
+    const btn = elements.modelButtons.querySelector(`[data-value="${model}"] .model-name`);
+    return btn ? btn.textContent : model;
+}
+
+// 模型繁忙时自动切换（用户偏好，保存在服务端）
+async function saveModelFallback(enabled) {
+    try {
+        const response = await fetch('/api/user/preferences', {
+            method: 'PUT',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ model_fallback: enabled })
+        });
+        if (!response.ok) throw new Error();
+        Modal.toast(I18n.t('preference_saved'), 'success');
+    } catch (error) {
+        Modal.toast(I18n.t('preference_save_failed'), 'error');
+        document.getElementById('modelFallbackToggle').checked = !enabled;
+    }
 }
 
 // ========================================
@@ -686,6 +973,26 @@ function bindEvents() {
     // 新建对话
     elements.btnNewChat.addEventListener('click', handleNewChat);
 
+    // 搜索会话
+    elements.sessionSearch.addEventListener('input', handleSearchInput);
+
+    // 聊天区 / 图库切换
+    elements.tabChat.addEventListener('click', () => showView('chat'));
+    elements.tabGallery.addEventListener('click', () => showView('gallery'));
+
+    // 图库：点击缩略图查看原图，点击会话名打开所在会话
+    elements.galleryGrid.addEventListener('click', async (e) => {
+        const sessionBtn = e.target.closest('.gallery-session');
+        if (sessionBtn) {
+            await selectSession(sessionBtn.dataset.id);
+            scrollToMessage(Number(sessionBtn.dataset.position));
+            return;
+        }
+        if (e.target.tagName === 'IMG') {
+            openImageModal(e.target.dataset.src);
+        }
+    });
+
     // 生成按钮
     elements.btnGenerate.addEventListener('click', handleGenerate);
 
@@ -721,6 +1028,9 @@ function bindEvents() {
         handleImageUpload(e.dataTransfer.files);  // 传入整个files对象
     });
 
+    // 离开页面时取消当前会话的聊天预热
+    window.addEventListener('pagehide', () => cancelSessionPrewarm(state.currentSessionId));
+
     // 粘贴图片
     document.addEventListener('paste', (e) => {
         const items = e.clipboardData?.items;
@@ -742,6 +1052,11 @@ function bindEvents() {
     setupOptionButtons(elements.aspectRatioButtons, 'selectedAspectRatio');
     setupOptionButtons(elements.modelButtons, 'selectedModel');
 
+    const modelFallbackToggle = document.getElementById('modelFallbackToggle');
+    if (modelFallbackToggle) {
+        modelFallbackToggle.addEventListener('change', (e) => saveModelFallback(e.target.checked));
+    }
+
     // 模态框
     elements.modalBackdrop.addEventListener('click', closeImageModal);
     elements.btnCloseModal.addEventListener('click', closeImageModal);